@@ -1,22 +1,536 @@
-from flask import Flask, request
-from twilio.twiml.messaging_response import MessagingResponse
+from flask import Flask, Response, request, g, jsonify
 import sqlite3
+import csv
+import io
+import itertools
 import os
 import datetime
 import re
 import json
+import hashlib
+import importlib
 import random
-import numpy as np
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import defaultdict, namedtuple, OrderedDict, deque
 import math
+import sys
+import bisect
+import contextlib
+import threading
+import atexit
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
+import click
+
+# Módulos pesados importados no primeiro uso, não na inicialização do worker: o numpy
+# só é preciso quando um modelo é carregado ou treinado e a TwiML só ao responder. Na
+# primeira consulta de atributo o proxy importa o módulo e se troca por ele no módulo.
+class _ModuloTardio:
+    def __init__(self, nome, apelido):
+        self._nome = nome
+        self._apelido = apelido
+    
+    def __getattr__(self, atributo):
+        modulo = importlib.import_module(self._nome)
+        globals()[self._apelido] = modulo
+        return getattr(modulo, atributo)
+
+np = _ModuloTardio("numpy", "np")
+twiml = _ModuloTardio("twilio.twiml.messaging_response", "twiml")
 
 app = Flask(__name__)
-db_file = "gastos_ml.db"
+db_file = os.environ.get("GASTOS_DB", "gastos_ml.db")
+
+# Pragmas aplicados a cada conexão persistente: WAL permite leituras concorrentes
+# com um escritor, busy_timeout espera o lock em vez de falhar com "database is locked"
+SQLITE_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",  # ~16 MB de cache de páginas
+    "PRAGMA mmap_size=268435456",  # 256 MB mapeados em memória
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=10000",
+]
+SQLITE_CACHED_STATEMENTS = 256
+
+# Instrumentação: histogramas de latência das etapas do webhook, dos métodos de ML e das
+# consultas SQL, expostos em /metrics no formato texto do Prometheus (valores de cada
+# processo). Com METRICAS=0 os cronômetros viram um contexto nulo e as conexões novas
+# não são instrumentadas.
+app.config.setdefault("METRICAS", os.environ.get("METRICAS", "1") == "1")
+LIMITES_SEGUNDOS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LIMITES_CONSULTAS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+class Histograma:
+    def __init__(self, nome, ajuda, rotulo, limites=LIMITES_SEGUNDOS):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.rotulo = rotulo
+        self.limites = limites
+        self.series = {}  # valor do rótulo -> [contagens por faixa (+Inf no fim), soma]
+        self.lock = threading.Lock()
+    
+    def observar(self, valor_rotulo, valor):
+        faixa = bisect.bisect_left(self.limites, valor)
+        with self.lock:
+            serie = self.series.get(valor_rotulo)
+            if serie is None:
+                serie = self.series[valor_rotulo] = [[0] * (len(self.limites) + 1), 0.0]
+            serie[0][faixa] += 1
+            serie[1] += valor
+    
+    def exportar(self):
+        with self.lock:
+            series = [(rotulo, list(contagens), soma) for rotulo, (contagens, soma) in self.series.items()]
+        linhas = [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} histogram"]
+        for valor_rotulo, contagens, soma in sorted(series):
+            rotulo = f'{self.rotulo}="{valor_rotulo}"'
+            acumulado = 0
+            for limite, contagem in zip(self.limites + (None,), contagens):
+                acumulado += contagem
+                le = "+Inf" if limite is None else repr(limite)
+                linhas.append(f'{self.nome}_bucket{{{rotulo},le="{le}"}} {acumulado}')
+            linhas.append(f"{self.nome}_sum{{{rotulo}}} {soma}")
+            linhas.append(f"{self.nome}_count{{{rotulo}}} {acumulado}")
+        return linhas
+
+HIST_REQUISICAO = Histograma("whatsbot_requisicao_segundos", "Tempo total do webhook por intencao", "intencao")
+HIST_ETAPA = Histograma("whatsbot_etapa_segundos", "Tempo de cada etapa do webhook", "etapa")
+HIST_ML = Histograma("whatsbot_ml_segundos", "Tempo dos metodos de ML", "metodo")
+HIST_SQL = Histograma("whatsbot_sql_segundos", "Tempo de cada comando SQL", "comando")
+HIST_SQL_CONSULTAS = Histograma("whatsbot_sql_consultas_por_requisicao", "Comandos SQL por requisicao do webhook",
+                                "intencao", LIMITES_CONSULTAS)
+HIST_SQL_REQUISICAO = Histograma("whatsbot_sql_segundos_por_requisicao", "Tempo em SQL por requisicao do webhook",
+                                 "intencao")
+HISTOGRAMAS = (HIST_REQUISICAO, HIST_ETAPA, HIST_ML, HIST_SQL, HIST_SQL_CONSULTAS, HIST_SQL_REQUISICAO)
+
+_CONTEXTO_NULO = contextlib.nullcontext()
+_sql_requisicao = threading.local()  # consultas e tempo em SQL da requisição atual da thread
+
+class _Cronometro:
+    __slots__ = ("histograma", "rotulo", "inicio")
+    
+    def __init__(self, histograma, rotulo):
+        self.histograma = histograma
+        self.rotulo = rotulo
+    
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc):
+        self.histograma.observar(self.rotulo, time.perf_counter() - self.inicio)
+
+def etapa(nome):
+    return _Cronometro(HIST_ETAPA, nome) if app.config["METRICAS"] else _CONTEXTO_NULO
+
+def cronometrado(nome):
+    def decorador(funcao):
+        @wraps(funcao)
+        def cronometrada(*args, **kwargs):
+            if not app.config["METRICAS"]:
+                return funcao(*args, **kwargs)
+            inicio = time.perf_counter()
+            try:
+                return funcao(*args, **kwargs)
+            finally:
+                HIST_ML.observar(nome, time.perf_counter() - inicio)
+        return cronometrada
+    return decorador
 
-# Inicializa o banco com tabelas para ML
+@lru_cache(maxsize=512)
+def _comando_sql(sql):
+    partes = sql.split(None, 1)
+    return partes[0].upper() if partes else ""
+
+def _registrar_sql(sql, duracao):
+    HIST_SQL.observar(_comando_sql(sql), duracao)
+    if getattr(_sql_requisicao, "ativo", False):
+        _sql_requisicao.consultas += 1
+        _sql_requisicao.segundos += duracao
+
+# Conexão SQLite que cronometra cada execute/executemany (usada com METRICAS ligado)
+class _CursorInstrumentado(sqlite3.Cursor):
+    def execute(self, sql, parametros=()):
+        inicio = time.perf_counter()
+        try:
+            return super().execute(sql, parametros)
+        finally:
+            _registrar_sql(sql, time.perf_counter() - inicio)
+    
+    def executemany(self, sql, sequencia):
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(sql, sequencia)
+        finally:
+            _registrar_sql(sql, time.perf_counter() - inicio)
+
+class _ConexaoInstrumentada(sqlite3.Connection):
+    def cursor(self, factory=_CursorInstrumentado):
+        return super().cursor(factory)
+    
+    # sqlite3.Connection.execute não passa por cursor()
+    def execute(self, sql, parametros=()):
+        return self.cursor().execute(sql, parametros)
+    
+    def executemany(self, sql, sequencia):
+        return self.cursor().executemany(sql, sequencia)
+
+# Alternativa ao arquivo SQLite: Postgres com pool de conexões, usado quando DATABASE_URL
+# aponta para um servidor (postgres://...), para que vários processos e hosts
+# compartilhem os mesmos dados. As consultas do app continuam escritas com '?'.
+DATABASE_URL = os.environ.get("DATABASE_URL", "")
+USAR_POSTGRES = DATABASE_URL.startswith(("postgres://", "postgresql://"))
+PG_POOL_MIN = int(os.environ.get("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.environ.get("PG_POOL_MAX", "10"))
+
+_pool_postgres = None
+_pool_pid = None
+_lock_pool = threading.Lock()
+
+@lru_cache(maxsize=512)
+def _sql_postgres(sql, com_parametros):
+    # Placeholders '?' do sqlite3 viram '%s' do psycopg2
+    if com_parametros:
+        sql = sql.replace("%", "%%")
+    return sql.replace("?", "%s")
+
+# Cursor psycopg2 com a mesma interface do sqlite3 usada pelo app
+class _CursorPostgres:
+    def __init__(self, cursor):
+        self._cursor = cursor
+    
+    def execute(self, sql, parametros=()):
+        parametros = tuple(parametros)
+        inicio = time.perf_counter()
+        self._cursor.execute(_sql_postgres(sql, bool(parametros)), parametros or None)
+        if app.config["METRICAS"]:
+            _registrar_sql(sql, time.perf_counter() - inicio)
+        return self
+    
+    def executemany(self, sql, sequencia):
+        from psycopg2.extras import execute_batch
+        inicio = time.perf_counter()
+        execute_batch(self._cursor, _sql_postgres(sql, True), list(sequencia))
+        if app.config["METRICAS"]:
+            _registrar_sql(sql, time.perf_counter() - inicio)
+        return self
+    
+    def fetchone(self):
+        return self._cursor.fetchone()
+    
+    def fetchall(self):
+        return self._cursor.fetchall()
+    
+    def fetchmany(self, tamanho):
+        return self._cursor.fetchmany(tamanho)
+    
+    def __iter__(self):
+        return iter(self._cursor)
+    
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+class _ConexaoPostgres:
+    def __init__(self, bruta):
+        self.bruta = bruta
+    
+    def cursor(self):
+        return _CursorPostgres(self.bruta.cursor())
+    
+    def execute(self, sql, parametros=()):
+        return self.cursor().execute(sql, parametros)
+    
+    def executemany(self, sql, sequencia):
+        return self.cursor().executemany(sql, sequencia)
+    
+    def commit(self):
+        self.bruta.commit()
+    
+    def rollback(self):
+        self.bruta.rollback()
+
+def _pool():
+    global _pool_postgres, _pool_pid
+    with _lock_pool:
+        # Pool criado no próprio worker: conexões não podem atravessar o fork
+        if _pool_postgres is None or _pool_pid != os.getpid():
+            import psycopg2.pool
+            _pool_postgres = psycopg2.pool.ThreadedConnectionPool(PG_POOL_MIN, PG_POOL_MAX, DATABASE_URL)
+            _pool_pid = os.getpid()
+        return _pool_postgres
+
+# Uma conexão por thread de cada worker, reaproveitada entre requisições
+_conexoes = threading.local()
+
+def _nova_conexao():
+    if USAR_POSTGRES:
+        return _ConexaoPostgres(_pool().getconn())
+    
+    fabrica = _ConexaoInstrumentada if app.config["METRICAS"] else sqlite3.Connection
+    conn = sqlite3.connect(db_file, timeout=10, cached_statements=SQLITE_CACHED_STATEMENTS, factory=fabrica)
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def obter_conexao():
+    conn = getattr(_conexoes, "conn", None)
+    # Conexões herdadas de outro processo (fork do gunicorn) não podem ser reutilizadas
+    if conn is None or _conexoes.pid != os.getpid():
+        conn = _nova_conexao()
+        _conexoes.conn = conn
+        _conexoes.pid = os.getpid()
+    return conn
+
+# Devolve ao pool a conexão Postgres da thread (com rollback do que não foi confirmado);
+# a conexão SQLite é persistente e continua com a thread
+def liberar_conexao():
+    conn = getattr(_conexoes, "conn", None)
+    if USAR_POSTGRES and conn is not None and _conexoes.pid == os.getpid():
+        _conexoes.conn = None
+        _pool().putconn(conn.bruta)
+
+# Datas dos gastos também são guardadas como número do dia (dias desde 1970-01-01),
+# que permite filtros por período com intervalos indexáveis em vez de substr(data, ...)
+_EPOCA = datetime(1970, 1, 1).toordinal()
+_SQL_DIA = "CAST(julianday(substr(data, 1, 10)) - 2440587.5 AS INTEGER)"
+
+def dia_numero(data_str):
+    return datetime.strptime(data_str[:10], "%Y-%m-%d").toordinal() - _EPOCA
+
+# Resumo materializado número x mês x categoria, mantido na mesma transação que
+# insere ou remove o gasto; quantidade=-1 desconta um gasto removido
+_SQL_RESUMO_MENSAL = """INSERT INTO resumo_mensal (numero, mes_ano, categoria, total, quantidade) VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(numero, mes_ano, categoria) DO UPDATE SET
+                        total = resumo_mensal.total + excluded.total,
+                        quantidade = resumo_mensal.quantidade + excluded.quantidade"""
+
+def atualizar_resumo_mensal(c, numero, data, categoria, valor, quantidade=1):
+    mes_ano, categoria = data[:7], categoria or "outros"
+    c.execute(_SQL_RESUMO_MENSAL, (numero, mes_ano, categoria, valor * quantidade, quantidade))
+    if quantidade < 0:
+        c.execute("DELETE FROM resumo_mensal WHERE numero = ? AND mes_ano = ? AND categoria = ? AND quantidade <= 0",
+                 (numero, mes_ano, categoria))
+
+# Recalcula o resumo inteiro a partir de gastos (reparo de divergências)
+def reconstruir_resumo_mensal(conn):
+    c = conn.cursor()
+    c.execute("DELETE FROM resumo_mensal")
+    c.execute("""INSERT INTO resumo_mensal (numero, mes_ano, categoria, total, quantidade)
+                 SELECT numero, substr(data, 1, 7), COALESCE(categoria, 'outros'), SUM(valor), COUNT(*)
+                 FROM gastos_historico WHERE data IS NOT NULL AND numero IS NOT NULL GROUP BY 1, 2, 3""")
+    conn.commit()
+    c.execute("SELECT COUNT(*) FROM resumo_mensal")
+    return c.fetchone()[0]
+
+# Gastos anteriores ao particionamento por número não têm dono: ficam com o número
+# de NUMERO_DONO_LEGADO ou, se o bot só conversou com um número, com ele. Retorna o
+# dono atribuído (None se não havia o que migrar ou não há dono definido).
+NUMERO_DONO_LEGADO = os.environ.get("NUMERO_DONO_LEGADO")
+
+def _migrar_dono_legado(c):
+    c.execute("""SELECT EXISTS(SELECT 1 FROM gastos WHERE numero IS NULL)
+                 OR EXISTS(SELECT 1 FROM orcamentos WHERE numero IS NULL)
+                 OR EXISTS(SELECT 1 FROM metas WHERE numero IS NULL)""")
+    if not c.fetchone()[0]:
+        return None
+    dono = NUMERO_DONO_LEGADO
+    if not dono:
+        c.execute("SELECT DISTINCT numero FROM contexto WHERE numero IS NOT NULL LIMIT 2")
+        numeros = c.fetchall()
+        if len(numeros) != 1:
+            return None
+        dono = numeros[0][0]
+    for tabela in ("gastos", "orcamentos", "metas"):
+        c.execute(f"UPDATE {tabela} SET numero = ? WHERE numero IS NULL", (dono,))
+    return dono
+
+# Roda a cada inicialização, fora da migração versionada: NUMERO_DONO_LEGADO pode ser
+# definido depois que o esquema já está na versão atual. A conferência é uma busca por
+# numero IS NULL nos índices que começam pelo número. Os snapshots do dono são
+# descartados porque a marca d'água deles já passou dos ids antigos.
+def aplicar_dono_legado(conn):
+    c = conn.cursor()
+    if USAR_POSTGRES:
+        c.execute("SELECT pg_advisory_xact_lock(hashtext('whats-bot-esquema'))")
+    dono = _migrar_dono_legado(c)
+    if dono:
+        c.execute("DELETE FROM ml_model WHERE numero = ?", (dono,))
+    conn.commit()
+    if dono:
+        reconstruir_resumo_mensal(conn)
+    return dono
+
+FTS_DISPONIVEL = False  # Definido por init_db conforme o suporte a FTS5 do SQLite
+
+# Versão do esquema criado por init_db (PRAGMA user_version no SQLite, tabela
+# versao_esquema no Postgres): só o primeiro processo que encontra o banco numa versão
+# anterior roda a migração, os demais workers apenas conferem a versão. Toda mudança em
+# init_db/_init_db_postgres precisa incrementá-la; do contrário os bancos já migrados
+# nunca executam o DDL novo. Migrações de dados que dependem de configuração (como
+# aplicar_dono_legado) não entram aqui e rodam a cada inicialização.
+VERSAO_ESQUEMA = 5
+
+def versao_esquema(conn):
+    c = conn.cursor()
+    if not USAR_POSTGRES:
+        c.execute("PRAGMA user_version")
+        return c.fetchone()[0]
+    c.execute("SELECT to_regclass('versao_esquema') IS NOT NULL")
+    if not c.fetchone()[0]:
+        return 0
+    c.execute("SELECT COALESCE(MAX(versao), 0) FROM versao_esquema")
+    return c.fetchone()[0]
+
+# Colunas copiadas para gastos_arquivo e visão gastos + arquivo (histórico completo)
+_COLUNAS_ARQUIVO = "id, valor, descricao, categoria, data, localizacao, metodo_pagamento, tags, dia, numero, meta_id"
+_SQL_GASTOS_HISTORICO = f"""SELECT {_COLUNAS_ARQUIVO} FROM gastos
+                            UNION ALL SELECT {_COLUNAS_ARQUIVO} FROM gastos_arquivo"""
+
+# Esquema equivalente no Postgres, com tipos e índices próprios
+def _init_db_postgres():
+    conn = obter_conexao()
+    c = conn.cursor()
+    
+    # Serializa a criação do esquema entre processos que iniciam juntos; quem esperou
+    # o lock encontra o esquema já migrado
+    c.execute("SELECT pg_advisory_xact_lock(hashtext('whats-bot-esquema'))")
+    if versao_esquema(conn) >= VERSAO_ESQUEMA:
+        conn.commit()
+        liberar_conexao()
+        return
+    c.execute("""CREATE TABLE IF NOT EXISTS gastos (
+                 id BIGSERIAL PRIMARY KEY,
+                 valor DOUBLE PRECISION,
+                 descricao TEXT,
+                 categoria TEXT,
+                 data TEXT,
+                 localizacao TEXT,
+                 metodo_pagamento TEXT,
+                 tags TEXT,
+                 dia INTEGER,
+                 numero TEXT
+                 )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS orcamentos (
+                 id BIGSERIAL PRIMARY KEY,
+                 categoria TEXT,
+                 limite_mensal DOUBLE PRECISION,
+                 mes_ano TEXT,
+                 numero TEXT
+                 )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS metas (
+                 id BIGSERIAL PRIMARY KEY,
+                 objetivo TEXT,
+                 valor_alvo DOUBLE PRECISION,
+                 valor_atual DOUBLE PRECISION,
+                 data_limite TEXT,
+                 concluida INTEGER DEFAULT 0,
+                 numero TEXT
+                 )""")
+    # Migração: dono de cada linha; os índices começam pelo número
+    for tabela in ("gastos", "orcamentos", "metas"):
+        c.execute(f"ALTER TABLE {tabela} ADD COLUMN IF NOT EXISTS numero TEXT")
+    c.execute("ALTER TABLE gastos ADD COLUMN IF NOT EXISTS meta_id BIGINT")
+    c.execute("DROP INDEX IF EXISTS idx_gastos_dia_categoria")
+    c.execute("DROP INDEX IF EXISTS idx_gastos_data")
+    c.execute("DROP INDEX IF EXISTS idx_gastos_numero_dia")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_gastos_numero_data ON gastos (numero, data, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_gastos_numero_id ON gastos (numero, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_gastos_dia ON gastos (dia)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orcamentos_numero ON orcamentos (numero, mes_ano, categoria)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_metas_numero ON metas (numero)")
+    c.execute("""CREATE TABLE IF NOT EXISTS gastos_arquivo (
+                 id BIGINT PRIMARY KEY,
+                 valor DOUBLE PRECISION,
+                 descricao TEXT,
+                 categoria TEXT,
+                 data TEXT,
+                 localizacao TEXT,
+                 metodo_pagamento TEXT,
+                 tags TEXT,
+                 dia INTEGER,
+                 numero TEXT,
+                 meta_id BIGINT,
+                 arquivado_em TEXT
+                 )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_gastos_arquivo_numero_id ON gastos_arquivo (numero, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_gastos_arquivo_numero_dia ON gastos_arquivo (numero, dia)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_gastos_arquivo_numero_data ON gastos_arquivo (numero, data, id)")
+    # Recriada (não substituída) porque as colunas da visão mudaram de ordem na versão 2
+    c.execute("DROP VIEW IF EXISTS gastos_historico")
+    c.execute(f"CREATE VIEW gastos_historico AS {_SQL_GASTOS_HISTORICO}")
+    c.execute("""CREATE TABLE IF NOT EXISTS contexto (
+                 id BIGSERIAL PRIMARY KEY,
+                 numero TEXT,
+                 ultima_intencao TEXT,
+                 dados_contexto TEXT,
+                 timestamp TEXT,
+                 intencoes_recentes TEXT
+                 )""")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_contexto_numero ON contexto (numero)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_contexto_timestamp ON contexto (timestamp)")
+    migrou_dono = _migrar_dono_legado(c)
+    c.execute("""CREATE TABLE IF NOT EXISTS ml_model (
+                 id BIGSERIAL PRIMARY KEY,
+                 tipo TEXT,
+                 parametros TEXT,
+                 precisao DOUBLE PRECISION,
+                 data_treinamento TEXT,
+                 numero TEXT
+                 )""")
+    c.execute("ALTER TABLE ml_model ADD COLUMN IF NOT EXISTS numero TEXT")
+    c.execute("DELETE FROM ml_model WHERE numero IS NULL")  # snapshots globais anteriores
+    c.execute("CREATE INDEX IF NOT EXISTS idx_ml_model_numero ON ml_model (numero, tipo)")
+    c.execute("""CREATE TABLE IF NOT EXISTS geracao_modelos (
+                 numero TEXT PRIMARY KEY,
+                 geracao BIGINT NOT NULL
+                 )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS padroes_usuario (
+                 id BIGSERIAL PRIMARY KEY,
+                 padrao_type TEXT,
+                 padrao_dados TEXT,
+                 confianca DOUBLE PRECISION,
+                 ultima_atualizacao TEXT
+                 )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS mensagens_processadas (
+                 message_sid TEXT PRIMARY KEY,
+                 numero TEXT,
+                 resposta TEXT,
+                 criado_em DOUBLE PRECISION
+                 )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_mensagens_criado_em ON mensagens_processadas (criado_em)")
+    # O resumo é derivado de gastos: sem a coluna numero, é recriado e reconstruído
+    c.execute("""SELECT EXISTS(SELECT 1 FROM information_schema.columns
+                 WHERE table_name = 'resumo_mensal' AND column_name = 'numero')""")
+    if not c.fetchone()[0]:
+        c.execute("DROP TABLE IF EXISTS resumo_mensal")
+    c.execute("""CREATE TABLE IF NOT EXISTS resumo_mensal (
+                 numero TEXT,
+                 mes_ano TEXT,
+                 categoria TEXT,
+                 total DOUBLE PRECISION,
+                 quantidade INTEGER,
+                 PRIMARY KEY (numero, mes_ano, categoria)
+                 )""")
+    c.execute("SELECT EXISTS(SELECT 1 FROM resumo_mensal), EXISTS(SELECT 1 FROM gastos)")
+    resumo_preenchido, tem_gastos = c.fetchone()
+    c.execute("CREATE TABLE IF NOT EXISTS versao_esquema (versao INTEGER)")
+    c.execute("DELETE FROM versao_esquema")
+    c.execute("INSERT INTO versao_esquema (versao) VALUES (?)", (VERSAO_ESQUEMA,))
+    conn.commit()
+    if tem_gastos and (migrou_dono or not resumo_preenchido):
+        reconstruir_resumo_mensal(conn)
+    liberar_conexao()
+
+# Inicializa o banco com tabelas para ML. Ao mudar o esquema aqui ou em
+# _init_db_postgres, incremente VERSAO_ESQUEMA.
 def init_db():
-    conn = sqlite3.connect(db_file)
+    if USAR_POSTGRES:
+        return _init_db_postgres()
+    
+    conn = _nova_conexao()
     c = conn.cursor()
     
     # Tabela de gastos
@@ -31,6 +545,49 @@ def init_db():
                  tags TEXT
                  )""")
     
+    # Migração: coluna 'dia' preenchida a partir do texto ISO de 'data', dono ('numero')
+    # e meta para a qual o gasto contribuiu ('meta_id')
+    colunas = {coluna[1] for coluna in c.execute("PRAGMA table_info(gastos)")}
+    if 'dia' not in colunas:
+        c.execute("ALTER TABLE gastos ADD COLUMN dia INTEGER")
+    if 'numero' not in colunas:
+        c.execute("ALTER TABLE gastos ADD COLUMN numero TEXT")
+    if 'meta_id' not in colunas:
+        c.execute("ALTER TABLE gastos ADD COLUMN meta_id INTEGER")
+    # Índices começando pelo número: recência (o id vai junto na chave) e marca d'água
+    # dos modelos (numero, id). Os agregados por mês/categoria vêm de resumo_mensal,
+    # então o antigo (numero, dia, categoria, valor) só encarecia as inserções.
+    c.execute("DROP INDEX IF EXISTS idx_gastos_dia_categoria")
+    c.execute("DROP INDEX IF EXISTS idx_gastos_data")
+    c.execute("DROP INDEX IF EXISTS idx_gastos_numero_dia")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_gastos_numero_data ON gastos (numero, data)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_gastos_numero_id ON gastos (numero, id)")
+    # Gastos mais antigos que o horizonte de retenção, para o arquivamento
+    c.execute("CREATE INDEX IF NOT EXISTS idx_gastos_dia ON gastos (dia)")
+    c.execute(f"UPDATE gastos SET dia = {_SQL_DIA} WHERE dia IS NULL AND data IS NOT NULL")
+    
+    # Gastos arquivados pela manutenção (mesmo id) e a visão com o histórico completo,
+    # usada pelos modelos e pela reconstrução do resumo
+    c.execute("""CREATE TABLE IF NOT EXISTS gastos_arquivo (
+                 id INTEGER PRIMARY KEY,
+                 valor REAL,
+                 descricao TEXT,
+                 categoria TEXT,
+                 data TEXT,
+                 localizacao TEXT,
+                 metodo_pagamento TEXT,
+                 tags TEXT,
+                 dia INTEGER,
+                 numero TEXT,
+                 meta_id INTEGER,
+                 arquivado_em TEXT
+                 )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_gastos_arquivo_numero_id ON gastos_arquivo (numero, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_gastos_arquivo_numero_dia ON gastos_arquivo (numero, dia)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_gastos_arquivo_numero_data ON gastos_arquivo (numero, data)")
+    c.execute("DROP VIEW IF EXISTS gastos_historico")
+    c.execute(f"CREATE VIEW gastos_historico AS {_SQL_GASTOS_HISTORICO}")
+    
     # Tabela de orçamentos
     c.execute("""CREATE TABLE IF NOT EXISTS orcamentos (
                  id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -49,16 +606,34 @@ def init_db():
                  concluida INTEGER DEFAULT 0
                  )""")
     
+    for tabela in ("orcamentos", "metas"):
+        if 'numero' not in {coluna[1] for coluna in c.execute(f"PRAGMA table_info({tabela})")}:
+            c.execute(f"ALTER TABLE {tabela} ADD COLUMN numero TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orcamentos_numero ON orcamentos (numero, mes_ano, categoria)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_metas_numero ON metas (numero)")
+    
     # Tabela de contexto da conversa
     c.execute("""CREATE TABLE IF NOT EXISTS contexto (
                  id INTEGER PRIMARY KEY AUTOINCREMENT,
                  numero TEXT,
                  ultima_intencao TEXT,
                  dados_contexto TEXT,
-                 timestamp TEXT
+                 timestamp TEXT,
+                 intencoes_recentes TEXT
                  )""")
     
-    # Tabela para aprendizado de ML
+    # Migração: um registro por número (upsert) e histórico das últimas intenções
+    colunas = {coluna[1] for coluna in c.execute("PRAGMA table_info(contexto)")}
+    if 'intencoes_recentes' not in colunas:
+        c.execute("ALTER TABLE contexto ADD COLUMN intencoes_recentes TEXT")
+    c.execute("SELECT 1 FROM sqlite_master WHERE name = 'idx_contexto_numero'")
+    if c.fetchone() is None:
+        c.execute("DELETE FROM contexto WHERE id NOT IN (SELECT MAX(id) FROM contexto GROUP BY numero)")
+        c.execute("CREATE UNIQUE INDEX idx_contexto_numero ON contexto (numero)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_contexto_timestamp ON contexto (timestamp)")
+    migrou_dono = _migrar_dono_legado(c)
+    
+    # Tabela para aprendizado de ML (snapshots por número)
     c.execute("""CREATE TABLE IF NOT EXISTS ml_model (
                  id INTEGER PRIMARY KEY AUTOINCREMENT,
                  tipo TEXT,
@@ -66,6 +641,15 @@ def init_db():
                  precisao REAL,
                  data_treinamento TEXT
                  )""")
+    if 'numero' not in {coluna[1] for coluna in c.execute("PRAGMA table_info(ml_model)")}:
+        c.execute("ALTER TABLE ml_model ADD COLUMN numero TEXT")
+    c.execute("DELETE FROM ml_model WHERE numero IS NULL")  # snapshots globais anteriores
+    c.execute("CREATE INDEX IF NOT EXISTS idx_ml_model_numero ON ml_model (numero, tipo)")
+    # Geração dos gastos de cada número, incrementada a cada remoção (ver geracao_modelos)
+    c.execute("""CREATE TABLE IF NOT EXISTS geracao_modelos (
+                 numero TEXT PRIMARY KEY,
+                 geracao INTEGER NOT NULL
+                 )""")
     
     # Tabela para padrões de gastos do usuário
     c.execute("""CREATE TABLE IF NOT EXISTS padroes_usuario (
@@ -76,33 +660,232 @@ def init_db():
                  ultima_atualizacao TEXT
                  )""")
     
+    # Entregas do webhook já atendidas (MessageSid do Twilio) e a TwiML respondida
+    c.execute("""CREATE TABLE IF NOT EXISTS mensagens_processadas (
+                 message_sid TEXT PRIMARY KEY,
+                 numero TEXT,
+                 resposta TEXT,
+                 criado_em REAL
+                 )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_mensagens_criado_em ON mensagens_processadas (criado_em)")
+    
+    # Tabela de totais por número, mês e categoria; derivada de gastos, então a
+    # versão sem número é descartada e reconstruída
+    colunas = {coluna[1] for coluna in c.execute("PRAGMA table_info(resumo_mensal)")}
+    if colunas and 'numero' not in colunas:
+        c.execute("DROP TABLE resumo_mensal")
+    c.execute("""CREATE TABLE IF NOT EXISTS resumo_mensal (
+                 numero TEXT,
+                 mes_ano TEXT,
+                 categoria TEXT,
+                 total REAL,
+                 quantidade INTEGER,
+                 PRIMARY KEY (numero, mes_ano, categoria)
+                 )""")
+    # Índice de texto completo sobre descrição/categoria, sem acentos ("orçamento" = "orcamento"),
+    # com o número como coluna de filtro e sincronizado com gastos por triggers
+    global FTS_DISPONIVEL
+    try:
+        c.execute("SELECT sql FROM sqlite_master WHERE name = 'gastos_fts'")
+        linha = c.fetchone()
+        fts_existia = linha is not None
+        if fts_existia and 'numero' not in linha[0]:
+            # Índice anterior ao particionamento: recriado com a coluna numero
+            for gatilho in ("insert", "delete", "update"):
+                c.execute(f"DROP TRIGGER IF EXISTS gastos_fts_{gatilho}")
+            c.execute("DROP TABLE gastos_fts")
+            fts_existia = False
+        c.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS gastos_fts USING fts5(
+                     descricao, categoria, numero, content='gastos', content_rowid='id',
+                     tokenize='unicode61 remove_diacritics 2'
+                     )""")
+        c.execute("""CREATE TRIGGER IF NOT EXISTS gastos_fts_insert AFTER INSERT ON gastos BEGIN
+                     INSERT INTO gastos_fts (rowid, descricao, categoria, numero)
+                     VALUES (new.id, new.descricao, new.categoria, new.numero);
+                     END""")
+        c.execute("""CREATE TRIGGER IF NOT EXISTS gastos_fts_delete AFTER DELETE ON gastos BEGIN
+                     INSERT INTO gastos_fts (gastos_fts, rowid, descricao, categoria, numero)
+                     VALUES ('delete', old.id, old.descricao, old.categoria, old.numero);
+                     END""")
+        c.execute("""CREATE TRIGGER IF NOT EXISTS gastos_fts_update AFTER UPDATE OF descricao, categoria, numero ON gastos BEGIN
+                     INSERT INTO gastos_fts (gastos_fts, rowid, descricao, categoria, numero)
+                     VALUES ('delete', old.id, old.descricao, old.categoria, old.numero);
+                     INSERT INTO gastos_fts (rowid, descricao, categoria, numero)
+                     VALUES (new.id, new.descricao, new.categoria, new.numero);
+                     END""")
+        if not fts_existia:
+            c.execute("INSERT INTO gastos_fts (gastos_fts) VALUES ('rebuild')")
+        FTS_DISPONIVEL = True
+    except sqlite3.OperationalError:
+        # SQLite compilado sem FTS5: a busca usa LIKE
+        FTS_DISPONIVEL = False
+    
+    c.execute("SELECT EXISTS(SELECT 1 FROM resumo_mensal), EXISTS(SELECT 1 FROM gastos)")
+    resumo_preenchido, tem_gastos = c.fetchone()
+    if tem_gastos and (migrou_dono or not resumo_preenchido):
+        reconstruir_resumo_mensal(conn)
+    
+    c.execute(f"PRAGMA user_version = {VERSAO_ESQUEMA}")
+    c.execute("PRAGMA optimize")
     conn.commit()
     conn.close()
 
-init_db()
+# Chamado na importação: roda init_db só se o banco estiver numa versão anterior do
+# esquema (no SQLite, sob flock para que workers iniciando juntos não migrem em dobro);
+# a atribuição de dono aos dados legados é conferida sempre
+def preparar_banco():
+    global FTS_DISPONIVEL
+    if USAR_POSTGRES:
+        conn = obter_conexao()
+        try:
+            desatualizado = versao_esquema(conn) < VERSAO_ESQUEMA
+            conn.commit()
+        finally:
+            liberar_conexao()
+        if desatualizado:
+            init_db()
+        try:
+            aplicar_dono_legado(obter_conexao())
+        finally:
+            liberar_conexao()
+        return
+    
+    conn = _nova_conexao()
+    try:
+        if versao_esquema(conn) < VERSAO_ESQUEMA:
+            import fcntl
+            with open(f"{db_file}.migracao.lock", "w") as trava:
+                fcntl.flock(trava, fcntl.LOCK_EX)
+                if versao_esquema(conn) < VERSAO_ESQUEMA:
+                    init_db()
+        aplicar_dono_legado(conn)
+        c = conn.cursor()
+        c.execute("SELECT EXISTS(SELECT 1 FROM sqlite_master WHERE name = 'gastos_fts')")
+        FTS_DISPONIVEL = bool(c.fetchone()[0])
+    finally:
+        conn.close()
 
-# Sistema de ML para categorização
+preparar_banco()
+
+# Sistema de ML para categorização (um modelo por número)
 class CategorizadorML:
-    def __init__(self):
+    VERSAO_ESTADO = 1
+    
+    def __init__(self, numero):
+        self.numero = numero
         self.palavras_chave = defaultdict(lambda: defaultdict(int))
         self.categorias_padrao = defaultdict(int)
         self.modelo_treinado = False
+        self.ultimo_id = 0  # Marca d'água: maior gastos.id já aprendido
+        # Distribuições normalizadas por palavra ({categoria: probabilidade}),
+        # invalidadas a cada observação e recalculadas na próxima previsão
+        self.distribuicoes = {}
+        self.categoria_mais_comum = None  # argmax de categorias_padrao em cache
         
-    def treinar_com_dados(self, conn):
+    @staticmethod
+    def _tokenizar(descricao):
+        # Ignora palavras muito curtas
+        return [palavra for palavra in (descricao or "").lower().split() if len(palavra) > 2]
+    
+    # Aprende um único gasto em O(palavras), sem reler a tabela
+    def observar(self, descricao, categoria, id_gasto=None):
+        if categoria is None:
+            return
+        for palavra in self._tokenizar(descricao):
+            self.palavras_chave[palavra][categoria] += 1
+            self.distribuicoes.pop(palavra, None)
+        self.categorias_padrao[categoria] += 1
+        if (self.categoria_mais_comum is None or
+                self.categorias_padrao[categoria] > self.categorias_padrao[self.categoria_mais_comum]):
+            self.categoria_mais_comum = categoria
+        if id_gasto is not None and id_gasto > self.ultimo_id:
+            self.ultimo_id = id_gasto
+        self.modelo_treinado = True
+    
+    # Desfaz a contribuição de um gasto removido
+    def esquecer(self, descricao, categoria, id_gasto=None):
+        if categoria is None:
+            return
+        # Gastos ainda não aprendidos não têm o que desfazer
+        if id_gasto is not None and id_gasto > self.ultimo_id:
+            return
+        for palavra in self._tokenizar(descricao):
+            contagens = self.palavras_chave.get(palavra)
+            if not contagens or categoria not in contagens:
+                continue
+            self.distribuicoes.pop(palavra, None)
+            contagens[categoria] -= 1
+            if contagens[categoria] <= 0:
+                del contagens[categoria]
+            if not contagens:
+                del self.palavras_chave[palavra]
+        if categoria in self.categorias_padrao:
+            self.categorias_padrao[categoria] -= 1
+            if self.categorias_padrao[categoria] <= 0:
+                del self.categorias_padrao[categoria]
+            if categoria == self.categoria_mais_comum:
+                self.categoria_mais_comum = (max(self.categorias_padrao.items(), key=lambda x: x[1])[0]
+                                             if self.categorias_padrao else None)
+    
+    # Treinamento incremental: aprende apenas os gastos após a marca d'água
+    @cronometrado("CategorizadorML.atualizar_com_dados")
+    def atualizar_com_dados(self, conn):
         c = conn.cursor()
-        c.execute("SELECT descricao, categoria FROM gastos WHERE categoria IS NOT NULL")
-        dados = c.fetchall()
+        c.execute("""SELECT id, descricao, categoria FROM gastos_historico
+                     WHERE numero = ? AND id > ? AND categoria IS NOT NULL ORDER BY id""",
+                 (self.numero, self.ultimo_id))
         
-        for descricao, categoria in dados:
-            palavras = descricao.lower().split()
-            for palavra in palavras:
-                if len(palavra) > 2:  # Ignora palavras muito curtas
-                    self.palavras_chave[palavra][categoria] += 1
-            self.categorias_padrao[categoria] += 1
+        # Percorre o cursor sem materializar (importações trazem muitos gastos de uma vez)
+        aprendidos = 0
+        for id_gasto, descricao, categoria in c:
+            self.observar(descricao, categoria, id_gasto)
+            aprendidos += 1
         
         self.modelo_treinado = True
-        return len(dados)
+        return aprendidos
+    
+    # Reconstrução completa do modelo (usada pelo comando treinar_ml)
+    @cronometrado("CategorizadorML.treinar_com_dados")
+    def treinar_com_dados(self, conn):
+        self.palavras_chave = defaultdict(lambda: defaultdict(int))
+        self.categorias_padrao = defaultdict(int)
+        self.distribuicoes = {}
+        self.categoria_mais_comum = None
+        self.ultimo_id = 0
+        return self.atualizar_com_dados(conn)
+    
+    # Estado serializável para snapshots na tabela ml_model
+    def exportar_estado(self):
+        return {
+            "versao": self.VERSAO_ESTADO,
+            "ultimo_id": self.ultimo_id,
+            "palavras_chave": {palavra: dict(contagens) for palavra, contagens in self.palavras_chave.items()},
+            "categorias_padrao": dict(self.categorias_padrao),
+        }
+    
+    def importar_estado(self, estado):
+        self.palavras_chave = defaultdict(lambda: defaultdict(int))
+        for palavra, contagens in estado["palavras_chave"].items():
+            self.palavras_chave[palavra].update(contagens)
+        self.categorias_padrao = defaultdict(int, estado["categorias_padrao"])
+        self.distribuicoes = {}
+        self.categoria_mais_comum = (max(self.categorias_padrao.items(), key=lambda x: x[1])[0]
+                                     if self.categorias_padrao else None)
+        self.ultimo_id = estado["ultimo_id"]
+        self.modelo_treinado = True
+    
+    def _distribuicao(self, palavra):
+        distribuicao = self.distribuicoes.get(palavra)
+        if distribuicao is None:
+            contagens = self.palavras_chave.get(palavra)
+            if not contagens:
+                return None
+            total = sum(contagens.values())
+            distribuicao = {categoria: count / total for categoria, count in contagens.items()}
+            self.distribuicoes[palavra] = distribuicao
+        return distribuicao
     
+    @cronometrado("CategorizadorML.prever_categoria")
     def prever_categoria(self, descricao):
         if not self.modelo_treinado:
             return "outros"
@@ -111,125 +894,747 @@ class CategorizadorML:
         scores = defaultdict(float)
         
         for palavra in palavras:
-            if palavra in self.palavras_chave:
-                total = sum(self.palavras_chave[palavra].values())
-                for categoria, count in self.palavras_chave[palavra].items():
-                    scores[categoria] += count / total
+            distribuicao = self._distribuicao(palavra)
+            if distribuicao:
+                for categoria, probabilidade in distribuicao.items():
+                    scores[categoria] += probabilidade
         
         if scores:
             return max(scores.items(), key=lambda x: x[1])[0]
         else:
             # Fallback para categorias mais comuns
-            if self.categorias_padrao:
-                return max(self.categorias_padrao.items(), key=lambda x: x[1])[0]
-            return "outros"
+            return self.categoria_mais_comum or "outros"
+    
+    # Previsão em lote: monta a matriz palavras x categorias só com o vocabulário
+    # presente no lote e soma as distribuições de todas as descrições de uma vez
+    @cronometrado("CategorizadorML.prever_categorias")
+    def prever_categorias(self, lista_descricoes):
+        lista_descricoes = list(lista_descricoes)
+        if not self.modelo_treinado or not self.categorias_padrao:
+            return ["outros"] * len(lista_descricoes)
+        fallback = self.categoria_mais_comum or "outros"
+        
+        categorias = list(self.categorias_padrao)
+        indice_categoria = {categoria: i for i, categoria in enumerate(categorias)}
+        vocabulario = {}
+        linhas, colunas = [], []
+        
+        for i, descricao in enumerate(lista_descricoes):
+            for palavra in (descricao or "").lower().split():
+                if palavra in self.palavras_chave:
+                    linhas.append(i)
+                    colunas.append(vocabulario.setdefault(palavra, len(vocabulario)))
+        
+        pesos = np.zeros((len(vocabulario), len(categorias)))
+        for palavra, j in vocabulario.items():
+            for categoria, probabilidade in self._distribuicao(palavra).items():
+                pesos[j, indice_categoria[categoria]] = probabilidade
+        
+        scores = np.zeros((len(lista_descricoes), len(categorias)))
+        linhas = np.asarray(linhas, dtype=np.intp)
+        np.add.at(scores, linhas, pesos[np.asarray(colunas, dtype=np.intp)])
+        tem_palavras = np.zeros(len(lista_descricoes), dtype=bool)
+        tem_palavras[linhas] = True
+        
+        melhores = scores.argmax(axis=1)
+        return [categorias[melhores[i]] if tem_palavras[i] else fallback
+                for i in range(len(lista_descricoes))]
+    
+    # Forma compacta para o modo compartilhado: vocabulário ordenado, matriz
+    # palavras x categorias com as contagens e o total de cada categoria
+    def exportar_arrays(self):
+        categorias = list(self.categorias_padrao)
+        indice_categoria = {categoria: i for i, categoria in enumerate(categorias)}
+        palavras = sorted(self.palavras_chave)
+        contagens = np.zeros((len(palavras), len(categorias)), dtype=np.int32)
+        for i, palavra in enumerate(palavras):
+            for categoria, quantidade in self.palavras_chave[palavra].items():
+                if categoria in indice_categoria:
+                    contagens[i, indice_categoria[categoria]] = quantidade
+        vocabulario = np.array(palavras, dtype=str) if palavras else np.zeros(0, dtype="U1")
+        totais = np.array([self.categorias_padrao[categoria] for categoria in categorias], dtype=np.int64)
+        return categorias, {"vocabulario": vocabulario, "contagens": contagens, "totais_categorias": totais}
+
+# Categorizador somente leitura sobre os arrays de CategorizadorML.exportar_arrays
+# (mapeados do arquivo compartilhado); mesma previsão, sem dicionários por processo
+class CategorizadorCompacto:
+    def __init__(self, numero, categorias, vocabulario, contagens, totais_categorias, ultimo_id=0):
+        self.numero = numero
+        self.categorias = categorias
+        self.vocabulario = vocabulario
+        self.contagens = contagens
+        self.ultimo_id = ultimo_id
+        self.modelo_treinado = bool(categorias)
+        self.categoria_mais_comum = categorias[int(np.argmax(totais_categorias))] if categorias else None
+    
+    def prever_categoria(self, descricao):
+        return self.prever_categorias([descricao])[0]
+    
+    def prever_categorias(self, lista_descricoes):
+        lista_descricoes = list(lista_descricoes)
+        if not self.modelo_treinado:
+            return ["outros"] * len(lista_descricoes)
+        fallback = self.categoria_mais_comum or "outros"
+        
+        palavras, donos = [], []
+        for i, descricao in enumerate(lista_descricoes):
+            for palavra in (descricao or "").lower().split():
+                palavras.append(palavra)
+                donos.append(i)
+        
+        scores = np.zeros((len(lista_descricoes), len(self.categorias)))
+        tem_palavras = np.zeros(len(lista_descricoes), dtype=bool)
+        if palavras and len(self.vocabulario):
+            palavras = np.asarray(palavras)
+            posicoes = np.minimum(np.searchsorted(self.vocabulario, palavras), len(self.vocabulario) - 1)
+            encontradas = self.vocabulario[posicoes] == palavras
+            linhas = self.contagens[posicoes[encontradas]].astype(float)
+            donos = np.asarray(donos, dtype=np.intp)[encontradas]
+            np.add.at(scores, donos, linhas / linhas.sum(axis=1, keepdims=True))
+            tem_palavras[donos] = True
+        
+        melhores = scores.argmax(axis=1)
+        return [self.categorias[melhores[i]] if tem_palavras[i] else fallback
+                for i in range(len(lista_descricoes))]
 
 # Sistema de previsão de gastos
+# Série diária densa em NumPy: totais_diarios[i] é o gasto do dia (dia_inicial + i)
 class PredictorML:
-    def __init__(self):
-        self.historico_gastos = []
+    VERSAO_ESTADO = 1
+    JANELA = 7
+    ALFA_EWMA = 2 / (7 + 1)
+    
+    def __init__(self, numero):
+        self.numero = numero
+        self.dia_inicial = None
+        self.totais_diarios = np.zeros(0)
+        self.ultimo_id = 0  # Marca d'água: maior gastos.id já acumulado
+        self.carregado = False
+        self.dia_referencia = None  # Último dia considerado nas estatísticas
         self.media_movel = 0
         self.tendencia = 0
+        self.ewma = 0
+        self.sazonalidade = np.ones(7)  # Fator por dia da semana (segunda = 0)
+    
+    def _acumular(self, dia, valor):
+        if self.dia_inicial is None:
+            self.dia_inicial = dia
+            self.totais_diarios = np.zeros(1)
+        elif dia < self.dia_inicial:
+            self.totais_diarios = np.concatenate([np.zeros(self.dia_inicial - dia), self.totais_diarios])
+            self.dia_inicial = dia
         
-    def analisar_historico(self, conn):
+        posicao = dia - self.dia_inicial
+        if posicao >= len(self.totais_diarios):
+            self.totais_diarios = np.concatenate([self.totais_diarios, np.zeros(posicao - len(self.totais_diarios) + 1)])
+        self.totais_diarios[posicao] += valor
+    
+    # Acumula um gasto novo na série sem reler a tabela
+    def observar(self, dia, valor, id_gasto=None):
+        if dia is None or valor is None:
+            return
+        self._acumular(dia, valor)
+        if id_gasto is not None and id_gasto > self.ultimo_id:
+            self.ultimo_id = id_gasto
+    
+    # Desconta um gasto removido que já estava na série
+    def esquecer(self, dia, valor, id_gasto=None):
+        if dia is None or valor is None or self.dia_inicial is None:
+            return
+        if id_gasto is not None and id_gasto > self.ultimo_id:
+            return
+        self._acumular(dia, -valor)
+    
+    # Carga completa: totais por dia agregados no próprio SQL
+    @cronometrado("PredictorML.carregar_historico")
+    def carregar_historico(self, conn):
         c = conn.cursor()
-        c.execute("SELECT valor, data FROM gastos ORDER BY data")
+        c.execute("SELECT MAX(id) FROM gastos_historico WHERE numero = ?", (self.numero,))
+        ultimo_id = c.fetchone()[0] or 0
+        c.execute("""SELECT dia, SUM(valor) FROM gastos_historico
+                     WHERE numero = ? AND id <= ? AND dia IS NOT NULL GROUP BY dia ORDER BY dia""",
+                 (self.numero, ultimo_id))
         dados = c.fetchall()
         
-        self.historico_gastos = []
-        for valor, data_str in dados:
-            try:
-                data = datetime.strptime(data_str.split('T')[0], "%Y-%m-%d")
-                self.historico_gastos.append((data, valor))
-            except:
-                continue
+        self.dia_inicial = None
+        self.totais_diarios = np.zeros(0)
+        if dados:
+            dias = np.fromiter((dia for dia, _ in dados), dtype=np.int64, count=len(dados))
+            valores = np.fromiter((total or 0 for _, total in dados), dtype=float, count=len(dados))
+            self.dia_inicial = int(dias[0])
+            self.totais_diarios = np.zeros(int(dias[-1] - dias[0]) + 1)
+            self.totais_diarios[dias - dias[0]] = valores
         
-        if len(self.historico_gastos) < 7:
+        self.ultimo_id = ultimo_id
+        self.carregado = True
+    
+    # Acumula apenas os gastos inseridos após a marca d'água
+    def atualizar_historico(self, conn):
+        c = conn.cursor()
+        c.execute("SELECT id, dia, valor FROM gastos_historico WHERE numero = ? AND id > ? ORDER BY id",
+                 (self.numero, self.ultimo_id))
+        for id_gasto, dia, valor in c:
+            self.observar(dia, valor, id_gasto)
+            self.ultimo_id = max(self.ultimo_id, id_gasto)
+    
+    def exportar_estado(self):
+        return {
+            "versao": self.VERSAO_ESTADO,
+            "ultimo_id": self.ultimo_id,
+            "dia_inicial": self.dia_inicial,
+            "totais_diarios": self.totais_diarios.tolist(),
+        }
+    
+    def importar_estado(self, estado):
+        self.dia_inicial = estado["dia_inicial"]
+        self.totais_diarios = np.asarray(estado["totais_diarios"], dtype=float)
+        self.ultimo_id = estado["ultimo_id"]
+        self.carregado = True
+    
+    # A série pode ser um array somente leitura (modo compartilhado): só analisar_historico()
+    # e prever_proximos_dias são usados sobre ela
+    def importar_arrays(self, dia_inicial, totais_diarios, ultimo_id):
+        self.dia_inicial = dia_inicial
+        self.totais_diarios = totais_diarios
+        self.ultimo_id = ultimo_id
+        self.carregado = True
+        self.analisar_historico()
+    
+    @cronometrado("PredictorML.analisar_historico")
+    def analisar_historico(self, conn=None):
+        if conn is not None:
+            if self.carregado:
+                self.atualizar_historico(conn)
+            else:
+                self.carregar_historico(conn)
+        
+        if self.dia_inicial is None or np.count_nonzero(self.totais_diarios) < self.JANELA:
             return False
-            
-        # Calcula média móvel dos últimos 7 dias
-        ultimos_7_dias = [v for d, v in self.historico_gastos[-7:]]
-        self.media_movel = sum(ultimos_7_dias) / len(ultimos_7_dias)
-        
-        # Calcula tendência (últimos 7 dias vs anteriores 7 dias)
-        if len(self.historico_gastos) >= 14:
-            anteriores_7_dias = [v for d, v in self.historico_gastos[-14:-7]]
-            media_anteriores = sum(anteriores_7_dias) / len(anteriores_7_dias)
+        
+        # Série completa até hoje (dias sem gastos contam como zero)
+        hoje = dia_numero(datetime.now().isoformat())
+        serie = self.totais_diarios
+        if hoje >= self.dia_inicial + len(serie):
+            serie = np.concatenate([serie, np.zeros(hoje - self.dia_inicial - len(serie) + 1)])
+        self.dia_referencia = self.dia_inicial + len(serie) - 1
+        
+        # Média móvel dos últimos 7 dias
+        self.media_movel = float(serie[-self.JANELA:].mean())
+        
+        # Tendência (últimos 7 dias vs anteriores 7 dias)
+        self.tendencia = 0
+        if len(serie) >= 2 * self.JANELA:
+            media_anteriores = float(serie[-2 * self.JANELA:-self.JANELA].mean())
             self.tendencia = ((self.media_movel - media_anteriores) / media_anteriores) * 100 if media_anteriores > 0 else 0
         
+        # Média móvel exponencial do gasto diário
+        pesos = (1 - self.ALFA_EWMA) ** np.arange(len(serie) - 1, -1, -1)
+        self.ewma = float(serie @ pesos / pesos.sum())
+        
+        # Sazonalidade semanal: média de cada dia da semana relativa à média geral
+        dias_semana = (np.arange(self.dia_inicial, self.dia_inicial + len(serie)) + 3) % 7  # 01/01/1970 foi quinta
+        soma_por_dia = np.bincount(dias_semana, weights=serie, minlength=7)
+        dias_por_semana = np.bincount(dias_semana, minlength=7)
+        media_geral = serie.mean()
+        if media_geral > 0:
+            self.sazonalidade = (soma_por_dia / np.maximum(dias_por_semana, 1)) / media_geral
+        else:
+            self.sazonalidade = np.ones(7)
+        
         return True
     
+    @cronometrado("PredictorML.prever_proximos_dias")
     def prever_proximos_dias(self, dias=7):
-        if not self.historico_gastos:
+        if self.dia_referencia is None:
             return None
-            
-        previsao = self.media_movel * dias
+        
+        proximos = (np.arange(self.dia_referencia + 1, self.dia_referencia + 1 + dias) + 3) % 7
+        previsao = float(self.ewma * self.sazonalidade[proximos].sum())
         return previsao, self.tendencia
 
 # Sistema de recomendação inteligente
+# Agregados de tamanho fixo (quantidade, soma, soma dos quadrados) por dia da
+# semana e por categoria, atualizados gasto a gasto
 class RecomendadorML:
-    def __init__(self):
-        self.padroes_gastos = defaultdict(list)
+    VERSAO_ESTADO = 1
+    
+    def __init__(self, numero):
+        self.numero = numero
+        self.por_dia_semana = np.zeros((7, 3))
+        self.por_categoria = {}
+        self.ultimo_id = 0  # Marca d'água: maior gastos.id já agregado
+        self.carregado = False
         self.recomendacoes = []
-        
+    
+    def _acumular(self, valor, dia, categoria, sinal):
+        if valor is None:
+            return
+        if dia is not None:
+            self.por_dia_semana[(dia + 3) % 7] += (sinal, sinal * valor, sinal * valor * valor)
+        if categoria is not None:
+            agregado = self.por_categoria.setdefault(categoria, [0, 0.0, 0.0])
+            agregado[0] += sinal
+            agregado[1] += sinal * valor
+            agregado[2] += sinal * valor * valor
+            if agregado[0] <= 0:
+                del self.por_categoria[categoria]
+    
+    # Agrega um gasto novo em O(1)
+    def observar(self, valor, dia, categoria, id_gasto=None):
+        self._acumular(valor, dia, categoria, 1)
+        if id_gasto is not None and id_gasto > self.ultimo_id:
+            self.ultimo_id = id_gasto
+    
+    # Desconta um gasto removido que já estava agregado
+    def esquecer(self, valor, dia, categoria, id_gasto=None):
+        if id_gasto is not None and id_gasto > self.ultimo_id:
+            return
+        self._acumular(valor, dia, categoria, -1)
+    
+    def estatisticas_categoria(self, categoria):
+        quantidade, soma, soma_quadrados = self.por_categoria.get(categoria, (0, 0.0, 0.0))
+        if quantidade <= 0:
+            return 0, 0.0, 0.0
+        media = soma / quantidade
+        desvio = math.sqrt(max(soma_quadrados / quantidade - media * media, 0.0))
+        return quantidade, media, desvio
+    
+    @cronometrado("RecomendadorML.analisar_padroes")
     def analisar_padroes(self, conn):
         c = conn.cursor()
         
-        # Padrões por dia da semana
-        c.execute("SELECT valor, data FROM gastos")
-        for valor, data_str in dados:
-            try:
-                data = datetime.strptime(data_str.split('T')[0], "%Y-%m-%d")
-                dia_semana = data.weekday()
-                self.padroes_gastos['dia_semana'].append((dia_semana, valor))
-            except:
-                continue
+        # Primeira carga percorre o cursor sem materializar a tabela; depois só gastos novos
+        if not self.carregado:
+            self.por_dia_semana = np.zeros((7, 3))
+            self.por_categoria = {}
+            self.ultimo_id = 0
+            self.carregado = True
         
-        # Padrões por categoria
-        c.execute("SELECT categoria, valor FROM gastos WHERE categoria IS NOT NULL")
-        for categoria, valor in c.fetchall():
-            self.padroes_gastos['categoria'].append((categoria, valor))
+        for id_gasto, valor, dia, categoria in c.execute(
+                "SELECT id, valor, dia, categoria FROM gastos_historico WHERE numero = ? AND id > ? ORDER BY id",
+                (self.numero, self.ultimo_id)):
+            self.observar(valor, dia, categoria, id_gasto)
         
         # Gera recomendações baseadas em padrões
         self._gerar_recomendacoes()
-        
+    
+    def exportar_estado(self):
+        return {
+            "versao": self.VERSAO_ESTADO,
+            "ultimo_id": self.ultimo_id,
+            "por_dia_semana": self.por_dia_semana.tolist(),
+            "por_categoria": self.por_categoria,
+        }
+    
+    def importar_estado(self, estado):
+        self.por_dia_semana = np.asarray(estado["por_dia_semana"], dtype=float).reshape(7, 3)
+        self.por_categoria = {categoria: list(agregado) for categoria, agregado in estado["por_categoria"].items()}
+        self.ultimo_id = estado["ultimo_id"]
+        self.carregado = True
+        self._gerar_recomendacoes()
+    
+    def exportar_arrays(self):
+        categorias = list(self.por_categoria)
+        agregados = np.array([self.por_categoria[categoria] for categoria in categorias], dtype=float).reshape(-1, 3)
+        return categorias, {"por_dia_semana": np.asarray(self.por_dia_semana, dtype=float), "por_categoria": agregados}
+    
+    def importar_arrays(self, categorias, por_dia_semana, por_categoria, ultimo_id):
+        self.por_dia_semana = np.array(por_dia_semana)
+        self.por_categoria = {categoria: [float(v) for v in agregado] for categoria, agregado in zip(categorias, por_categoria)}
+        self.ultimo_id = ultimo_id
+        self.carregado = True
+        self._gerar_recomendacoes()
+    
+    # Reconstrução completa (usada pelo comando treinar_ml)
+    def reconstruir(self, conn):
+        self.carregado = False
+        self.analisar_padroes(conn)
+    
     def _gerar_recomendacoes(self):
         self.recomendacoes = []
         
         # Análise de gastos por dia da semana
-        if 'dia_semana' in self.padroes_gastos:
-            gastos_por_dia = defaultdict(list)
-            for dia, valor in self.padroes_gastos['dia_semana']:
-                gastos_por_dia[dia].append(valor)
-            
-            dias_nomes = ['Segunda', 'Terça', 'Quarta', 'Quinta', 'Sexta', 'Sábado', 'Domingo']
-            for dia, gastos in gastos_por_dia.items():
-                if len(gastos) > 3:  # Padrão significativo
-                    media = sum(gastos) / len(gastos)
-                    self.recomendacoes.append(
-                        f"💡 Você gasta em média R$ {media:.2f} às {dias_nomes[dia]}s-feiras"
-                    )
+        dias_nomes = ['Segunda', 'Terça', 'Quarta', 'Quinta', 'Sexta', 'Sábado', 'Domingo']
+        for dia, (quantidade, soma, _) in enumerate(self.por_dia_semana):
+            if quantidade > 3:  # Padrão significativo
+                media = soma / quantidade
+                self.recomendacoes.append(
+                    f"💡 Você gasta em média R$ {media:.2f} às {dias_nomes[dia]}s-feiras"
+                )
         
         # Análise de gastos por categoria
-        if 'categoria' in self.padroes_gastos:
-            gastos_por_categoria = defaultdict(list)
-            for categoria, valor in self.padroes_gastos['categoria']:
-                gastos_por_categoria[categoria].append(valor)
-            
-            for categoria, gastos in gastos_por_categoria.items():
-                if len(gastos) > 5:  # Padrão significativo
-                    total = sum(gastos)
-                    self.recomendacoes.append(
-                        f"💡 Você já gastou R$ {total:.2f} com {categoria} este mês"
-                    )
+        for categoria, (quantidade, total, _) in self.por_categoria.items():
+            if quantidade > 5:  # Padrão significativo
+                self.recomendacoes.append(
+                    f"💡 Você já gastou R$ {total:.2f} com {categoria} ao todo"
+                )
     
     def obter_recomendacoes(self, limite=3):
         return random.sample(self.recomendacoes, min(limite, len(self.recomendacoes))) if self.recomendacoes else []
 
-# Instâncias dos modelos ML
-categorizador_ml = CategorizadorML()
-predictor_ml = PredictorML()
-recomendador_ml = RecomendadorML()
+# Modelos de cada número, carregados sob demanda e mantidos num LRU limitado; o
+# lock de cada conjunto protege o estado compartilhado com o worker de insights
+LIMITE_MODELOS_USUARIOS = int(os.environ.get("LIMITE_MODELOS_USUARIOS", "256"))
+
+class ModelosUsuario:
+    def __init__(self, numero):
+        self.numero = numero
+        self.categorizador = CategorizadorML(numero)
+        self.predictor = PredictorML(numero)
+        self.recomendador = RecomendadorML(numero)
+        self.lock = threading.RLock()
+        self.prontos = False
+        self.ultimo_snapshot = 0.0
+        self.info_treino = None  # Último treino do arquivo compartilhado (modo compartilhado)
+        self.geracao = 0  # geracao_modelos do número quando os modelos foram carregados
+
+_modelos_usuarios = OrderedDict()
+_lock_modelos_usuarios = threading.Lock()
+
+# Persistência dos modelos na tabela ml_model, um snapshot por (tipo, número). Cada
+# snapshot guarda o estado em JSON versionado com a marca d'água do modelo (ultimo_id)
+# e uma verificação (quantidade e soma dos gastos do número até ela): se algum desses
+# gastos foi removido depois, o snapshot é descartado e o modelo é treinado do zero.
+INTERVALO_SNAPSHOT = 300  # segundos mínimos entre snapshots automáticos
+
+def _modelos_persistidos(modelos):
+    # tipo -> (modelo, treinamento completo, atualização incremental)
+    categorizador, predictor, recomendador = modelos.categorizador, modelos.predictor, modelos.recomendador
+    return {
+        "categorizador": (categorizador, categorizador.treinar_com_dados, categorizador.atualizar_com_dados),
+        "predictor": (predictor, predictor.carregar_historico, predictor.analisar_historico),
+        "recomendador": (recomendador, recomendador.reconstruir, recomendador.analisar_padroes),
+    }
+
+def _verificacao_snapshot(c, numero, ultimo_id):
+    c.execute("SELECT COUNT(*), COALESCE(SUM(valor), 0) FROM gastos_historico WHERE numero = ? AND id <= ?",
+             (numero, ultimo_id))
+    return list(c.fetchone())
+
+def salvar_modelos(conn, modelos):
+    c = conn.cursor()
+    agora = datetime.now().isoformat()
+    
+    with modelos.lock:
+        for tipo, (modelo, _, _) in _modelos_persistidos(modelos).items():
+            estado = modelo.exportar_estado()
+            estado["verificacao"] = _verificacao_snapshot(c, modelos.numero, modelo.ultimo_id)
+            c.execute("DELETE FROM ml_model WHERE numero = ? AND tipo = ?", (modelos.numero, tipo))
+            c.execute("INSERT INTO ml_model (tipo, numero, parametros, precisao, data_treinamento) VALUES (?, ?, ?, ?, ?)",
+                     (tipo, modelos.numero, json.dumps(estado, separators=(",", ":")), None, agora))
+    conn.commit()
+    modelos.ultimo_snapshot = time.monotonic()
+
+def salvar_modelos_se_necessario(conn, modelos):
+    if time.monotonic() - modelos.ultimo_snapshot >= INTERVALO_SNAPSHOT:
+        salvar_modelos(conn, modelos)
+
+# Restaura os snapshots válidos e reaplica só os gastos inseridos depois deles
+@cronometrado("carregar_modelos")
+def carregar_modelos(conn, modelos):
+    c = conn.cursor()
+    restaurados = 0
+    
+    with modelos.lock:
+        # Lida antes dos gastos: uma remoção durante a carga provoca outra recarga
+        modelos.geracao = geracao_modelos(c, modelos.numero)
+        for tipo, (modelo, treinar, atualizar) in _modelos_persistidos(modelos).items():
+            c.execute("SELECT parametros FROM ml_model WHERE numero = ? AND tipo = ? ORDER BY id DESC LIMIT 1",
+                     (modelos.numero, tipo))
+            linha = c.fetchone()
+            estado = json.loads(linha[0]) if linha and linha[0] else None
+            
+            valido = False
+            if estado and estado.get("versao") == modelo.VERSAO_ESTADO:
+                quantidade, soma = _verificacao_snapshot(c, modelos.numero, estado["ultimo_id"])
+                quantidade_salva, soma_salva = estado["verificacao"]
+                valido = quantidade == quantidade_salva and abs(soma - soma_salva) <= 1e-6 * max(1.0, abs(soma))
+            
+            if valido:
+                modelo.importar_estado(estado)
+                atualizar(conn)
+                restaurados += 1
+            else:
+                treinar(conn)
+        
+        modelos.predictor.analisar_historico()
+        modelos.prontos = True
+    return restaurados
+
+# Geração dos gastos do número: remover_gasto a incrementa na mesma transação da remoção.
+# O worker que remove desfaz o gasto só nos próprios modelos; os demais encontram a
+# geração diferente da dos seus modelos e os recarregam (a verificação do snapshot
+# decide entre restaurar e retreinar).
+def geracao_modelos(c, numero):
+    c.execute("SELECT geracao FROM geracao_modelos WHERE numero = ?", (numero,))
+    linha = c.fetchone()
+    return linha[0] if linha else 0
+
+# Modelos do número, restaurados do snapshot na primeira vez que ele aparece; o menos
+# usado sai do LRU quando o limite é atingido (o snapshot dele continua no banco).
+# No modo compartilhado os workers nunca treinam: até o treinador publicar o arquivo
+# do número, recebem modelos vazios (categoria "outros", sem previsão)
+def obter_modelos(numero, conn=None):
+    if MODELOS_COMPARTILHADOS:
+        modelos = obter_modelos_compartilhados(numero)
+        if modelos is None:
+            modelos = ModelosUsuario(numero)
+            modelos.prontos = True
+        return modelos
+    
+    conn = conn or obter_conexao()
+    with _lock_modelos_usuarios:
+        modelos = _modelos_usuarios.get(numero)
+        if modelos is None:
+            modelos = _modelos_usuarios[numero] = ModelosUsuario(numero)
+            while len(_modelos_usuarios) > LIMITE_MODELOS_USUARIOS:
+                _modelos_usuarios.popitem(last=False)
+        else:
+            _modelos_usuarios.move_to_end(numero)
+    if modelos.prontos and modelos.geracao != geracao_modelos(conn.cursor(), numero):
+        # Outro worker removeu gastos do número: modelos novos no lugar destes
+        with _lock_modelos_usuarios:
+            atual = _modelos_usuarios.get(numero)
+            if atual is None or atual is modelos:
+                atual = _modelos_usuarios[numero] = ModelosUsuario(numero)
+            modelos = atual
+    if not modelos.prontos:
+        with modelos.lock:
+            if not modelos.prontos:
+                carregar_modelos(conn, modelos)
+    return modelos
+
+# Modelos já em memória, sem carregar (None se o número não está no LRU)
+def modelos_em_cache(numero):
+    with _lock_modelos_usuarios:
+        modelos = _modelos_usuarios.get(numero)
+    return modelos if modelos is not None and modelos.prontos else None
+
+# Pré-carrega os modelos dos números com conversa mais recente, do mais ativo para o
+# menos ativo até o prazo (segundos); com_snapshot=True ignora números sem snapshot,
+# cujo carregamento seria o histórico inteiro
+def aquecer_modelos(conn, limite=None, prazo=None, com_snapshot=False):
+    filtro = " AND EXISTS(SELECT 1 FROM ml_model m WHERE m.numero = contexto.numero)" if com_snapshot else ""
+    c = conn.cursor()
+    c.execute(f"SELECT numero FROM contexto WHERE numero IS NOT NULL{filtro} ORDER BY timestamp DESC LIMIT ?",
+             (limite or LIMITE_MODELOS_USUARIOS,))
+    numeros = [numero for numero, in c.fetchall()]
+    limite_tempo = time.monotonic() + prazo if prazo else None
+    carregados = []
+    for numero in numeros:
+        if limite_tempo is not None and time.monotonic() >= limite_tempo:
+            break
+        obter_modelos(numero, conn)
+        carregados.append(numero)
+    with _lock_modelos_usuarios:
+        for numero in reversed(carregados):  # o mais recente termina no fim do LRU
+            if numero in _modelos_usuarios:
+                _modelos_usuarios.move_to_end(numero)
+    return len(carregados)
+
+# Modo compartilhado (MODELOS_COMPARTILHADOS=1): um único processo treinador mantém os
+# modelos completos e publica, para cada número, um arquivo com a forma compacta (arrays
+# de CategorizadorML/PredictorML/RecomendadorML.exportar_arrays). Os workers mapeiam o
+# arquivo somente leitura com np.memmap, então as páginas são compartilhadas entre eles,
+# e trocam de versão quando o arquivo é substituído (os.replace é atômico; quem ainda
+# usa a versão anterior continua com o inode antigo). Inserções e remoções nos workers
+# viram arquivos marcadores que o treinador consome. O treinador é o primeiro processo a
+# obter o flock de MODELOS_DIR/.treinador.lock (ou o comando treinador-modelos).
+MODELOS_COMPARTILHADOS = os.environ.get("MODELOS_COMPARTILHADOS") == "1"
+MODELOS_DIR = os.environ.get("MODELOS_DIR", "modelos")
+INTERVALO_ELEICAO_TREINADOR = 30  # segundos entre tentativas de assumir o treino
+_MAGICA_MODELO = b"WBM1"
+_ALINHAMENTO_MODELO = 64
+
+_modelos_compartilhados = OrderedDict()  # numero -> ((st_ino, st_mtime_ns), ModelosUsuario)
+_modelos_treinador = OrderedDict()  # numero -> ModelosUsuario completo (só no treinador)
+_ultimo_treino_compartilhado = {}
+_trava_treinador = None
+_proxima_eleicao = (None, 0.0)  # (pid, instante)
+
+def _caminho_modelo(numero, extensao=".bin"):
+    return os.path.join(MODELOS_DIR, hashlib.sha1(numero.encode()).hexdigest() + extensao)
+
+def _alinhar(posicao):
+    return -(-posicao // _ALINHAMENTO_MODELO) * _ALINHAMENTO_MODELO
+
+# Formato: mágica, tamanho do cabeçalho JSON (uint32), cabeçalho, arrays alinhados
+def publicar_modelo_compartilhado(modelos, info):
+    categorias, arrays = modelos.categorizador.exportar_arrays()
+    categorias_recomendador, arrays_recomendador = modelos.recomendador.exportar_arrays()
+    arrays.update(arrays_recomendador)
+    arrays["totais_diarios"] = np.asarray(modelos.predictor.totais_diarios, dtype=float)
+    
+    layout, posicao = {}, 0
+    for nome, array in arrays.items():
+        array = arrays[nome] = np.ascontiguousarray(array)
+        layout[nome] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": posicao}
+        posicao = _alinhar(posicao + array.nbytes)
+    cabecalho = json.dumps({
+        "numero": modelos.numero,
+        "info": info,
+        "categorias": categorias,
+        "categorias_recomendador": categorias_recomendador,
+        "dia_inicial": modelos.predictor.dia_inicial,
+        "ultimo_id": {"categorizador": modelos.categorizador.ultimo_id, "predictor": modelos.predictor.ultimo_id,
+                      "recomendador": modelos.recomendador.ultimo_id},
+        "arrays": layout,
+    }).encode()
+    inicio_dados = _alinhar(8 + len(cabecalho))
+    
+    os.makedirs(MODELOS_DIR, exist_ok=True)
+    destino = _caminho_modelo(modelos.numero)
+    temporario = f"{destino}.{os.getpid()}.tmp"
+    with open(temporario, "wb") as arquivo:
+        arquivo.write(_MAGICA_MODELO + len(cabecalho).to_bytes(4, "little") + cabecalho)
+        for nome, array in arrays.items():
+            arquivo.seek(inicio_dados + layout[nome]["offset"])
+            arquivo.write(array.tobytes())
+        arquivo.truncate(max(inicio_dados + posicao, arquivo.tell()) or 1)
+        arquivo.flush()
+        os.fsync(arquivo.fileno())
+    os.replace(temporario, destino)
+
+def abrir_modelo_compartilhado(caminho):
+    with open(caminho, "rb") as arquivo:
+        estado = os.fstat(arquivo.fileno())
+        if arquivo.read(4) != _MAGICA_MODELO:
+            raise ValueError(f"Arquivo de modelo inválido: {caminho}")
+        cabecalho = json.loads(arquivo.read(int.from_bytes(arquivo.read(4), "little")))
+        inicio_dados = _alinhar(arquivo.tell())
+        mapa = np.memmap(arquivo, dtype=np.uint8, mode="r")
+    
+    arrays = {nome: np.ndarray(tuple(item["shape"]), dtype=np.dtype(item["dtype"]), buffer=mapa,
+                               offset=inicio_dados + item["offset"])
+              for nome, item in cabecalho["arrays"].items()}
+    ultimo_id = cabecalho["ultimo_id"]
+    
+    modelos = ModelosUsuario(cabecalho["numero"])
+    modelos.categorizador = CategorizadorCompacto(
+        modelos.numero, cabecalho["categorias"], arrays["vocabulario"], arrays["contagens"],
+        arrays["totais_categorias"], ultimo_id["categorizador"])
+    modelos.predictor.importar_arrays(cabecalho["dia_inicial"], arrays["totais_diarios"], ultimo_id["predictor"])
+    modelos.recomendador.importar_arrays(cabecalho["categorias_recomendador"], arrays["por_dia_semana"],
+                                         arrays["por_categoria"], ultimo_id["recomendador"])
+    modelos.info_treino = cabecalho["info"]
+    modelos.prontos = True
+    return (estado.st_ino, estado.st_mtime_ns), modelos
+
+# Versão atual do arquivo do número; None se o treinador ainda não o publicou
+def obter_modelos_compartilhados(numero):
+    _garantir_treinador_compartilhado()
+    caminho = _caminho_modelo(numero)
+    try:
+        estado = os.stat(caminho)
+    except FileNotFoundError:
+        if not os.path.exists(_caminho_modelo(numero, ".sujo")):
+            marcar_modelo_compartilhado(numero)
+        return None
+    
+    identidade = (estado.st_ino, estado.st_mtime_ns)
+    with _lock_modelos_usuarios:
+        item = _modelos_compartilhados.get(numero)
+        if item is not None and item[0] == identidade:
+            _modelos_compartilhados.move_to_end(numero)
+            return item[1]
+    
+    identidade, modelos = abrir_modelo_compartilhado(caminho)
+    with _lock_modelos_usuarios:
+        _modelos_usuarios.pop(numero, None)  # cópia local (completa) não é mais usada
+        _modelos_compartilhados[numero] = (identidade, modelos)
+        _modelos_compartilhados.move_to_end(numero)
+        while len(_modelos_compartilhados) > LIMITE_MODELOS_USUARIOS:
+            _modelos_compartilhados.popitem(last=False)
+    return modelos
+
+def marcar_modelo_compartilhado(numero, completo=False):
+    os.makedirs(MODELOS_DIR, exist_ok=True)
+    with open(_caminho_modelo(numero, ".completo" if completo else ".sujo"), "w", encoding="utf-8") as arquivo:
+        arquivo.write(numero)
+
+# Consome os marcadores: reconstruções completas logo, atualizações no máximo uma vez
+# a cada INTERVALO_TREINO por número
+def treinar_modelos_compartilhados(conn):
+    if not os.path.isdir(MODELOS_DIR):
+        return 0
+    agora = time.monotonic()
+    publicados = 0
+    for nome in sorted(os.listdir(MODELOS_DIR)):
+        base, extensao = os.path.splitext(nome)
+        if extensao not in (".sujo", ".completo"):
+            continue
+        completo = extensao == ".completo"
+        if not completo and agora - _ultimo_treino_compartilhado.get(base, float("-inf")) < INTERVALO_TREINO:
+            continue
+        caminho = os.path.join(MODELOS_DIR, nome)
+        try:
+            with open(caminho, encoding="utf-8") as arquivo:
+                numero = arquivo.read()
+            os.remove(caminho)  # marcações feitas durante o treino criam um novo marcador
+        except FileNotFoundError:
+            continue
+        
+        modelos = _modelos_treinador.get(numero)
+        if modelos is None:
+            modelos = _modelos_treinador[numero] = ModelosUsuario(numero)
+            while len(_modelos_treinador) > LIMITE_MODELOS_USUARIOS:
+                _modelos_treinador.popitem(last=False)
+        _modelos_treinador.move_to_end(numero)
+        
+        inicio = time.monotonic()
+        with modelos.lock:
+            if not modelos.prontos:
+                carregar_modelos(conn, modelos)
+            linhas = _treinar_modelos(conn, modelos, completo)
+        if completo:
+            salvar_modelos(conn, modelos)
+        else:
+            salvar_modelos_se_necessario(conn, modelos)
+        publicar_modelo_compartilhado(modelos, {
+            "ultimo_treino": datetime.now().isoformat(),
+            "duracao": time.monotonic() - inicio,
+            "linhas_treinadas": linhas,
+        })
+        _ultimo_treino_compartilhado[base] = time.monotonic()
+        publicados += 1
+    return publicados
+
+def _loop_treinador_compartilhado():
+    while True:
+        try:
+            treinar_modelos_compartilhados(obter_conexao())
+        except Exception as e:
+            print(f"Erro no treinador compartilhado: {str(e)}")
+            obter_conexao().rollback()
+        finally:
+            liberar_conexao()
+        time.sleep(1.0)
+
+def _assumir_treinador():
+    global _trava_treinador
+    import fcntl
+    os.makedirs(MODELOS_DIR, exist_ok=True)
+    arquivo = open(os.path.join(MODELOS_DIR, ".treinador.lock"), "w")
+    try:
+        fcntl.flock(arquivo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        arquivo.close()
+        return False
+    _trava_treinador = arquivo  # mantido aberto enquanto o processo viver
+    return True
+
+def _garantir_treinador_compartilhado():
+    global _proxima_eleicao
+    # Cada processo tenta assumir o treino de tempos em tempos (o treinador pode ter morrido)
+    pid, instante = _proxima_eleicao
+    if _trava_treinador is not None or (pid == os.getpid() and time.monotonic() < instante):
+        return
+    with _lock_modelos_usuarios:
+        if _proxima_eleicao != (pid, instante):
+            return
+        _proxima_eleicao = (os.getpid(), time.monotonic() + INTERVALO_ELEICAO_TREINADOR)
+    if _assumir_treinador():
+        threading.Thread(target=_loop_treinador_compartilhado, name="treinador", daemon=True).start()
 
 # Função para formatar data
 def formatar_data(data_str):
@@ -244,169 +1649,554 @@ def formatar_data(data_str):
         return data_str
 
 # Sistema de NLP avançado com ML
-def analisar_intencao_com_ml(mensagem, historico=None):
-    mensagem = mensagem.lower().strip()
-    
-    # Padrões com pesos baseados em aprendizado
-    padroes = {
-        'saudacao': (r'\b(oi|olá|ola|eae|hey|hello|como vai|tudo bem)\b', 0.95),
-        'adicionar_gasto': (r'\b(gastei|gasto|gastar|adicionar|add|registrar|comprei|paguei|investi|r\$|reais|valor|preço)\b', 0.90),
-        'consultar_gastos': (r'\b(ver|mostrar|listar|consultar|visualizar|gastos|despesas|compras)\b', 0.85),
-        'resumo_financeiro': (r'\b(total|soma|resumo|quanto gastei|extrato|finanças|financeiro)\b', 0.88),
-        'buscar_gastos': (r'\b(buscar|procurar|encontrar|filtrar|pesquisar|onde gastei)\b', 0.82),
-        'definir_orcamento': (r'\b(orçamento|orcamento|limite|definir|estabelecer|máximo|controlar)\b', 0.80),
-        'definir_meta': (r'\b(meta|objetivo|poupar|economizar|guardar|sonho|conseguir|alcançar)\b', 0.78),
-        'analise_categoria': (r'\b(categoria|categorias|por tipo|por área|onde mais gasto)\b', 0.75),
-        'previsao_gastos': (r'\b(previsão|previsao|futuro|próximo|próximos|esperar|projeção)\b', 0.77),
-        'comparativo_mensal': (r'\b(comparar|mês|meses|variação|variaçao|evolução|evolucao)\b', 0.76),
-        'recomendacao': (r'\b(dica|sugestão|sugestao|recomendação|recomendacao|como economizar|economia)\b', 0.72),
-        'remover_gasto': (r'\b(remover|excluir|deletar|apagar|eliminar|retirar|cancelar)\b', 0.85),
-        'configuracao': (r'\b(configurar|preferências|preferencias|alterar|mudar|personalizar)\b', 0.70),
-        'treinar_ml': (r'\b(treinar|aprender|melhorar|atualizar|inteligencia|ia|ml|machine learning)\b', 0.65),
-        'ajuda': (r'\b(ajuda|help|comandos|o que você faz|funcionalidades|como usar)\b', 0.90)
-    }
+# Padrões de intenção com pesos baseados em aprendizado (a ordem desempata pesos iguais)
+_PADROES_INTENCAO = [
+    ('saudacao', r'oi|olá|ola|eae|hey|hello|como vai|tudo bem', 0.95),
+    ('adicionar_gasto', r'gastei|gasto|gastar|adicionar|add|registrar|comprei|paguei|investi|r\$|reais|valor|preço', 0.90),
+    ('consultar_gastos', r'ver|mostrar|listar|consultar|visualizar|gastos|despesas|compras', 0.85),
+    ('resumo_financeiro', r'total|soma|resumo|quanto gastei|extrato|finanças|financeiro', 0.88),
+    ('buscar_gastos', r'buscar|procurar|encontrar|filtrar|pesquisar|onde gastei', 0.82),
+    ('definir_orcamento', r'orçamento|orcamento|limite|definir|estabelecer|máximo|controlar', 0.80),
+    ('definir_meta', r'meta|objetivo|poupar|economizar|guardar|sonho|conseguir|alcançar', 0.78),
+    ('analise_categoria', r'categoria|categorias|por tipo|por área|onde mais gasto', 0.75),
+    ('previsao_gastos', r'previsão|previsao|futuro|próximo|próximos|esperar|projeção', 0.77),
+    ('comparativo_mensal', r'comparar|mês|meses|variação|variaçao|evolução|evolucao', 0.76),
+    ('recomendacao', r'dica|sugestão|sugestao|recomendação|recomendacao|como economizar|economia', 0.72),
+    ('remover_gasto', r'remover|excluir|deletar|apagar|eliminar|retirar|cancelar', 0.85),
+    ('configuracao', r'configurar|preferências|preferencias|alterar|mudar|personalizar', 0.70),
+    ('treinar_ml', r'treinar|aprender|melhorar|atualizar|inteligencia|ia|ml|machine learning', 0.65),
+    ('ajuda', r'ajuda|help|comandos|o que você faz|funcionalidades|como usar', 0.90),
+]
+_PESOS_INTENCAO = {intencao: peso for intencao, _, peso in _PADROES_INTENCAO}
+
+# Um único scanner por tipo de dado, compilado na importação. As buscas ficam dentro
+# de lookaheads para que correspondências sobrepostas ("quanto gastei" e "gastei")
+# sejam todas encontradas numa só varredura, e o grupo nomeado indica qual padrão casou.
+_SCANNER_INTENCAO = re.compile(
+    r'(?=\b(?:' + '|'.join(f'(?P<{intencao}>{padrao})' for intencao, padrao, _ in _PADROES_INTENCAO) + r')\b)',
+    re.IGNORECASE)
+
+_NUMERO = r'\d+[\.,]?\d*'
+# v5_vazio reproduz as alternativas sem grupo de '(\d+)\s*no|\s*na|\s*com', que
+# invalidam aquele padrão quando aparecem antes do número
+_SCANNER_VALOR = re.compile(
+    rf'(?=r\$\s*(?P<v1>{_NUMERO})|(?P<v2>{_NUMERO})\s*reais|valor.*?(?P<v3>{_NUMERO})|gastei.*?(?P<v4>{_NUMERO})'
+    rf'|(?P<v5>{_NUMERO})\s*no|(?P<v5_vazio>\s*na|\s*com)|custa.*?(?P<v6>{_NUMERO}))',
+    re.IGNORECASE)
+_PRIORIDADE_VALOR = ('v1', 'v2', 'v3', 'v4', 'v5', 'v6')
+
+_SCANNER_ID = re.compile(
+    r'(?=remover\s+(?P<r1>\d+)|excluir\s+(?P<r2>\d+)|deletar\s+(?P<r3>\d+)|apagar\s+(?P<r4>\d+)'
+    r'|id\s+(?P<r5>\d+)|#(?P<r6>\d+)|(?P<r7>\d+)$)',
+    re.IGNORECASE)
+_PRIORIDADE_ID = ('r1', 'r2', 'r3', 'r4', 'r5', 'r6', 'r7')
+
+_LIMPEZA_NUMEROS = re.compile(_NUMERO)
+_LIMPEZA_PALAVRAS = re.compile(r'r\$|reais|valor|gastei|gasto|adicionar|add|registrar', re.IGNORECASE)
+_PALAVRAS_REMOVER = frozenset(['no', 'na', 'em', 'de', 'do', 'da', 'com', 'por', 'para', 'um', 'uma'])
+
+MensagemAnalisada = namedtuple('MensagemAnalisada', ['intencao', 'score', 'valor', 'descricao', 'id_remocao'])
+
+def _detectar_intencao(mensagem, historico=None):
+    encontradas = {correspondencia.lastgroup for correspondencia in _SCANNER_INTENCAO.finditer(mensagem)}
     
-    # Verifica correspondências com pesos
-    correspondencias = []
-    for intencao, (padrao, peso) in padroes.items():
-        if re.search(padrao, mensagem, re.IGNORECASE):
-            # Ajusta peso baseado no histórico do usuário
-            peso_ajustado = peso
-            if historico and intencao in historico:
-                # Aumenta peso para intenções frequentes
-                peso_ajustado *= 1.2
-            
-            correspondencias.append((intencao, peso_ajustado))
+    melhor, melhor_peso = None, 0.0
+    for intencao, _, peso in _PADROES_INTENCAO:
+        if intencao in encontradas:
+            # Aumenta peso para intenções frequentes no histórico do usuário
+            peso_ajustado = peso * 1.2 if historico and intencao in historico else peso
+            if melhor is None or peso_ajustado > melhor_peso:
+                melhor, melhor_peso = intencao, peso_ajustado
     
-    if correspondencias:
-        # Retorna a intenção com maior peso
-        return max(correspondencias, key=lambda x: x[1])[0]
+    if melhor:
+        return melhor, melhor_peso
     
     # Fallback: detecta se há valor numérico (provavelmente adicionar gasto)
+    mensagem = mensagem.lower()
     if any(char.isdigit() for char in mensagem) and ('r$' in mensagem or 'reais' in mensagem):
-        return "adicionar_gasto"
+        return "adicionar_gasto", 0.0
     
-    return "desconhecido"
+    return "desconhecido", 0.0
 
 # Funções de extração de dados
 def extrair_valor(texto):
-    padroes = [
-        r'r\$\s*(\d+[\.,]?\d*)',
-        r'(\d+[\.,]?\d*)\s*reais',
-        r'valor.*?(\d+[\.,]?\d*)',
-        r'gastei.*?(\d+[\.,]?\d*)',
-        r'(\d+[\.,]?\d*)\s*no|\s*na|\s*com',
-        r'custa.*?(\d+[\.,]?\d*)'
-    ]
-    
-    for padrao in padroes:
-        correspondencias = re.findall(padrao, texto, re.IGNORECASE)
-        if correspondencias:
+    primeiras = {}
+    for correspondencia in _SCANNER_VALOR.finditer(texto):
+        grupo = correspondencia.lastgroup
+        if grupo == 'v5_vazio':
+            # Conta como ocorrência do padrão v5, mas sem número
+            primeiras.setdefault('v5', '')
+        else:
+            primeiras.setdefault(grupo, correspondencia.group(grupo))
+    
+    for grupo in _PRIORIDADE_VALOR:
+        if grupo in primeiras:
             try:
-                valor_str = correspondencias[0].replace(',', '.')
-                return float(valor_str)
-            except:
+                return float(primeiras[grupo].replace(',', '.'))
+            except ValueError:
                 continue
     return None
 
 def extrair_descricao(texto):
-    texto_limpo = re.sub(r'\d+[\.,]?\d*', '', texto)
-    texto_limpo = re.sub(r'r\$|reais|valor|gastei|gasto|adicionar|add|registrar', '', texto_limpo, flags=re.IGNORECASE)
-    texto_limpo = re.sub(r'\s+', ' ', texto_limpo).strip()
-    
-    palavras_remover = ['no', 'na', 'em', 'de', 'do', 'da', 'com', 'por', 'para', 'um', 'uma']
-    palavras = [p for p in texto_limpo.split() if p.lower() not in palavras_remover]
-    
+    texto_limpo = _LIMPEZA_PALAVRAS.sub('', _LIMPEZA_NUMEROS.sub('', texto))
+    palavras = [p for p in texto_limpo.split() if p.lower() not in _PALAVRAS_REMOVER]
     return ' '.join(palavras) if palavras else None
 
 def extrair_id_remocao(texto):
-    padroes = [
-        r'remover\s+(\d+)',
-        r'excluir\s+(\d+)',
-        r'deletar\s+(\d+)',
-        r'apagar\s+(\d+)',
-        r'id\s+(\d+)',
-        r'#(\d+)',
-        r'(\d+)$'
-    ]
-    
-    for padrao in padroes:
-        correspondencias = re.findall(padrao, texto, re.IGNORECASE)
-        if correspondencias:
-            try:
-                return int(correspondencias[0])
-            except:
-                continue
+    primeiras = {}
+    for correspondencia in _SCANNER_ID.finditer(texto):
+        primeiras.setdefault(correspondencia.lastgroup, correspondencia.group(correspondencia.lastgroup))
+    
+    for grupo in _PRIORIDADE_ID:
+        if grupo in primeiras:
+            return int(primeiras[grupo])
     return None
 
+# Analisa a mensagem uma única vez: intenção, peso, valor, descrição e ID de remoção
+def analisar_mensagem(mensagem, historico=None):
+    intencao, score = _detectar_intencao(mensagem, historico)
+    return MensagemAnalisada(intencao, score, extrair_valor(mensagem), extrair_descricao(mensagem),
+                             extrair_id_remocao(mensagem))
+
+def analisar_intencao_com_ml(mensagem, historico=None):
+    return _detectar_intencao(mensagem, historico)[0]
+
 # Funções de contexto
-def salvar_contexto(numero, intencao, dados=None):
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    
-    dados_json = json.dumps(dados) if dados else None
+# O estado de cada conversa fica num cache LRU em memória; as alterações são gravadas
+# em lote por uma thread de escrita (write-behind) com upsert em contexto(numero).
+# Entradas expiram após TTL_CONTEXTO para reler o que outros workers gravaram.
+LIMITE_CACHE_CONTEXTO = 10000
+TTL_CONTEXTO = 120  # segundos
+INTERVALO_ESCRITA_CONTEXTO = 1.0  # segundos entre gravações em lote
+TAMANHO_HISTORICO_INTENCOES = 10
+app.config.setdefault("CONTEXTO_SINCRONO", os.environ.get("CONTEXTO_SINCRONO") == "1")
+
+class EstadoConversa:
+    def __init__(self, ultima_intencao=None, dados=None, intencoes=()):
+        self.ultima_intencao = ultima_intencao
+        self.dados = dados
+        self.intencoes = deque(intencoes, maxlen=TAMANHO_HISTORICO_INTENCOES)
+        self.carregado_em = time.monotonic()
     
-    c.execute("SELECT id FROM contexto WHERE numero = ?", (numero,))
-    existe = c.fetchone()
+    def linha(self, numero):
+        return (numero, self.ultima_intencao, json.dumps(self.dados) if self.dados else None,
+                datetime.now().isoformat(), json.dumps(list(self.intencoes)))
+
+_cache_contexto = OrderedDict()
+_contextos_pendentes = {}  # numero -> linha ainda não gravada
+_lock_contexto = threading.Lock()
+_escritor_contexto_pid = None
+
+def _estado_da_linha(ultima_intencao, dados_json, intencoes_json):
+    return EstadoConversa(ultima_intencao, json.loads(dados_json) if dados_json else None,
+                          json.loads(intencoes_json) if intencoes_json else ())
+
+# recarregar=True ignora o cache e relê o banco: usado pela navegação entre páginas, cujo
+# cursor pode ter sido gravado por outro worker na mensagem anterior
+def obter_estado_conversa(numero, recarregar=False):
+    with _lock_contexto:
+        estado = _cache_contexto.get(numero)
+        if not recarregar and estado is not None and time.monotonic() - estado.carregado_em < TTL_CONTEXTO:
+            _cache_contexto.move_to_end(numero)
+            return estado
+        
+        pendente = _contextos_pendentes.get(numero)
+        resultado = None
+        if pendente is None or recarregar:
+            c = obter_conexao().cursor()
+            c.execute("""SELECT ultima_intencao, dados_contexto, intencoes_recentes, timestamp
+                         FROM contexto WHERE numero = ?""", (numero,))
+            resultado = c.fetchone()
+        # Uma linha pendente é mais recente que o banco, a não ser que outro worker tenha
+        # gravado depois dela
+        if pendente is not None and (resultado is None or pendente[3] >= (resultado[3] or "")):
+            _, ultima_intencao, dados_json, _, intencoes_json = pendente
+            estado = _estado_da_linha(ultima_intencao, dados_json, intencoes_json)
+        else:
+            estado = _estado_da_linha(*resultado[:3]) if resultado else EstadoConversa()
+        
+        _cache_contexto[numero] = estado
+        while len(_cache_contexto) > LIMITE_CACHE_CONTEXTO:
+            _cache_contexto.popitem(last=False)
+        return estado
+
+def salvar_contexto(numero, intencao, dados=None):
+    estado = obter_estado_conversa(numero)
+    with _lock_contexto:
+        estado.ultima_intencao = intencao
+        estado.dados = dados
+        estado.intencoes.append(intencao)
+        _contextos_pendentes[numero] = estado.linha(numero)
     
-    if existe:
-        c.execute("UPDATE contexto SET ultima_intencao = ?, dados_contexto = ?, timestamp = ? WHERE numero = ?",
-                 (intencao, dados_json, datetime.now().isoformat(), numero))
+    # O cursor de paginação é gravado na hora: o "mais" seguinte pode cair em outro worker
+    if app.config["CONTEXTO_SINCRONO"] or (dados and "pagina" in dados):
+        descarregar_contextos()
     else:
-        c.execute("INSERT INTO contexto (numero, ultima_intencao, dados_contexto, timestamp) VALUES (?, ?, ?, ?)",
-                 (numero, intencao, dados_json, datetime.now().isoformat()))
-    
-    conn.commit()
-    conn.close()
+        _garantir_escritor_contexto()
 
 def recuperar_contexto(numero):
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    
-    c.execute("SELECT ultima_intencao, dados_contexto FROM contexto WHERE numero = ?", (numero,))
-    resultado = c.fetchone()
-    
-    conn.close()
+    estado = obter_estado_conversa(numero)
+    return estado.ultima_intencao, estado.dados
+
+# Grava todas as alterações pendentes numa única transação; a linha do banco só é
+# substituída por uma mais nova, para que a gravação atrasada de um worker não desfaça
+# a de outro que atendeu uma mensagem posterior
+def descarregar_contextos():
+    with _lock_contexto:
+        linhas = list(_contextos_pendentes.values())
+        _contextos_pendentes.clear()
+    if not linhas:
+        return 0
     
-    if resultado:
-        intencao, dados_json = resultado
-        dados = json.loads(dados_json) if dados_json else None
-        return intencao, dados
-    return None, None
+    conn = obter_conexao()
+    try:
+        conn.executemany("""INSERT INTO contexto (numero, ultima_intencao, dados_contexto, timestamp, intencoes_recentes)
+                            VALUES (?, ?, ?, ?, ?)
+                            ON CONFLICT(numero) DO UPDATE SET
+                            ultima_intencao = excluded.ultima_intencao, dados_contexto = excluded.dados_contexto,
+                            timestamp = excluded.timestamp, intencoes_recentes = excluded.intencoes_recentes
+                            WHERE excluded.timestamp >= contexto.timestamp OR contexto.timestamp IS NULL""",
+                         linhas)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        # Devolve à fila o que não foi substituído por uma alteração mais nova
+        with _lock_contexto:
+            for linha in linhas:
+                _contextos_pendentes.setdefault(linha[0], linha)
+        raise
+    return len(linhas)
+
+def _escrever_contextos():
+    while True:
+        time.sleep(INTERVALO_ESCRITA_CONTEXTO)
+        try:
+            descarregar_contextos()
+        except Exception as e:
+            print(f"Erro ao gravar contexto: {str(e)}")
+        finally:
+            liberar_conexao()
+
+def _garantir_escritor_contexto():
+    global _escritor_contexto_pid
+    # Uma thread de escrita por processo (threads não sobrevivem ao fork do gunicorn)
+    if _escritor_contexto_pid == os.getpid():
+        return
+    with _lock_contexto:
+        if _escritor_contexto_pid != os.getpid():
+            threading.Thread(target=_escrever_contextos, name="contexto", daemon=True).start()
+            _escritor_contexto_pid = os.getpid()
+
+atexit.register(descarregar_contextos)
 
 # Funções de gerenciamento de gastos
-def listar_gastos_para_remocao(conn, limite=10):
+# Listagem paginada do mais recente para o mais antigo com cursor (data, id): cada página
+# é uma busca em idx_gastos_numero_data a partir da borda da página anterior, sem OFFSET.
+# direcao="antes" segue para gastos mais antigos que o cursor, "depois" volta aos mais novos.
+TAMANHO_PAGINA_LISTAGEM = 10
+LIMITE_MENSAGEM = 1600  # caracteres por mensagem do WhatsApp no Twilio
+_COMANDOS_PAGINA = {"mais": "antes", "próxima": "antes", "proxima": "antes", "anterior": "depois", "voltar": "depois"}
+
+def listar_gastos(conn, numero, cursor=None, direcao="antes", limite=TAMANHO_PAGINA_LISTAGEM):
     c = conn.cursor()
-    c.execute("SELECT id, valor, descricao, categoria, data FROM gastos ORDER BY data DESC, id DESC LIMIT ?", (limite,))
-    return c.fetchall()
+    if cursor is None:
+        c.execute("""SELECT id, valor, descricao, categoria, data FROM gastos
+                     WHERE numero = ? ORDER BY data DESC, id DESC LIMIT ?""", (numero, limite + 1))
+    elif direcao == "antes":
+        c.execute("""SELECT id, valor, descricao, categoria, data FROM gastos
+                     WHERE numero = ? AND (data, id) < (?, ?) ORDER BY data DESC, id DESC LIMIT ?""",
+                 (numero, cursor[0], cursor[1], limite + 1))
+    else:
+        c.execute("""SELECT id, valor, descricao, categoria, data FROM gastos
+                     WHERE numero = ? AND (data, id) > (?, ?) ORDER BY data, id LIMIT ?""",
+                 (numero, cursor[0], cursor[1], limite + 1))
+    gastos = c.fetchall()
+    
+    # A linha extra só indica se há outra página na direção pedida
+    ha_mais = len(gastos) > limite
+    gastos = gastos[:limite]
+    if direcao == "depois" and cursor is not None:
+        gastos.reverse()
+    return gastos, ha_mais
+
+def _linha_gasto(id_gasto, valor, descricao, categoria, data):
+    return f"• #{id_gasto} | {formatar_data(data)} | {categoria} | R$ {valor:.2f} - {descricao}"
+
+# Junta as partes da mensagem sem passar do limite do WhatsApp (linhas que não cabem são omitidas)
+def montar_mensagem(cabecalho, linhas, rodape=""):
+    espaco = LIMITE_MENSAGEM - len(cabecalho) - len(rodape) - 2
+    incluidas = []
+    for linha in linhas:
+        espaco -= len(linha) + 1
+        if espaco < 0:
+            incluidas.append("…")
+            break
+        incluidas.append(linha)
+    return f"{cabecalho}\n\n" + "\n".join(incluidas) + rodape
+
+# Páginas renderizadas por número (mensagem e contexto de navegação), descartadas a cada
+# inserção ou remoção do número neste processo e, para alterações feitas em outros
+# workers, após TTL_PAGINAS
+TTL_PAGINAS = 60  # segundos
+LIMITE_CACHE_PAGINAS = 1024  # números
+LIMITE_PAGINAS_POR_NUMERO = 32
+
+_cache_paginas = OrderedDict()  # numero -> {chave: (criada_em, mensagem, contexto)}
+_lock_paginas = threading.Lock()
+
+def invalidar_paginas(numero):
+    with _lock_paginas:
+        _cache_paginas.pop(numero, None)
+
+def pagina_gastos(conn, numero, tipo, navegacao=None, direcao="antes"):
+    pagina = 1
+    cursor = None
+    if navegacao is not None:
+        pagina = navegacao["pagina"] + (1 if direcao == "antes" else -1)
+        cursor = navegacao["ultimo"] if direcao == "antes" else navegacao["primeiro"]
+    chave = (tipo, pagina, direcao, tuple(cursor) if cursor else None)
+    
+    with _lock_paginas:
+        paginas = _cache_paginas.get(numero)
+        if paginas is not None:
+            _cache_paginas.move_to_end(numero)
+            item = paginas.get(chave)
+            if item is not None and time.monotonic() - item[0] < TTL_PAGINAS:
+                return item[1], item[2]
+    
+    gastos, ha_mais = listar_gastos(conn, numero, cursor, direcao)
+    if not gastos:
+        mensagem = "Não há mais gastos para mostrar." if navegacao else (
+            "Nenhum gasto registrado ainda." if tipo == "consultar" else "Nenhum gasto registrado para remover.")
+        return mensagem, navegacao
+    
+    # Voltando, ha_mais diz se existem páginas mais novas; seguindo, se existem mais antigas
+    tem_anteriores = pagina > 1
+    tem_proximas = ha_mais if direcao == "antes" or cursor is None else True
+    contexto = {"pagina": pagina, "primeiro": [gastos[0][4], gastos[0][0]], "ultimo": [gastos[-1][4], gastos[-1][0]]}
+    
+    if tipo == "consultar":
+        cabecalho = f"📋 Seus gastos (página {pagina}):"
+        rodape = f"\n\n💰 Total da página: R$ {sum(gasto[1] for gasto in gastos):.2f}"
+    else:
+        cabecalho = f"📋 Seus gastos com IDs (página {pagina}):"
+        rodape = ""
+    if tem_proximas:
+        rodape += "\n➡️ Digite 'mais' para ver gastos mais antigos"
+    if tem_anteriores:
+        rodape += "\n⬅️ Digite 'anterior' para voltar"
+    rodape += "\n\n🗑️ Para remover um gasto, digite 'remover X' (onde X é o número do gasto)"
+    mensagem = montar_mensagem(cabecalho, [_linha_gasto(*gasto) for gasto in gastos], rodape)
+    
+    with _lock_paginas:
+        paginas = _cache_paginas.setdefault(numero, {})
+        _cache_paginas.move_to_end(numero)
+        if len(paginas) >= LIMITE_PAGINAS_POR_NUMERO:
+            paginas.clear()
+        paginas[chave] = (time.monotonic(), mensagem, contexto)
+        while len(_cache_paginas) > LIMITE_CACHE_PAGINAS:
+            _cache_paginas.popitem(last=False)
+    return mensagem, contexto
 
-def remover_gasto(conn, id_gasto):
+# Só remove gastos do próprio número
+def remover_gasto(conn, numero, id_gasto):
     c = conn.cursor()
-    c.execute("SELECT id, valor, descricao FROM gastos WHERE id = ?", (id_gasto,))
+    c.execute("SELECT id, valor, descricao, categoria, data, dia, meta_id FROM gastos WHERE id = ? AND numero = ?",
+             (id_gasto, numero))
     gasto = c.fetchone()
     
     if gasto:
+        id_removido, valor, descricao, categoria, data, dia, meta_id = gasto
         c.execute("DELETE FROM gastos WHERE id = ?", (id_gasto,))
+        if data:
+            atualizar_resumo_mensal(c, numero, data, categoria, valor, quantidade=-1)
+        if meta_id is not None:
+            atualizar_progresso_meta(c, meta_id, -valor)
+        c.execute("""INSERT INTO geracao_modelos (numero, geracao) VALUES (?, 1)
+                     ON CONFLICT(numero) DO UPDATE SET geracao = geracao_modelos.geracao + 1""", (numero,))
+        geracao = geracao_modelos(c, numero)
         conn.commit()
-        return True, gasto
+        invalidar_paginas(numero)
+        
+        # Remove a contribuição do gasto dos modelos de ML em memória; fora do LRU,
+        # a verificação do snapshot detecta a remoção na próxima carga. Se outra remoção
+        # (de outro worker) aconteceu no meio, a geração não é adiantada e os modelos
+        # são recarregados no próximo uso.
+        modelos = modelos_em_cache(numero)
+        if modelos is not None:
+            with modelos.lock:
+                modelos.categorizador.esquecer(descricao, categoria, id_removido)
+                modelos.predictor.esquecer(dia, valor, id_removido)
+                modelos.recomendador.esquecer(valor, dia, categoria, id_removido)
+                if modelos.geracao == geracao - 1:
+                    modelos.geracao = geracao
+        # O treinador compartilhado não vê o esquecer deste processo: reconstrói o número
+        marcar_modelos_sujos(numero, completo=MODELOS_COMPARTILHADOS)
+        return True, gasto[:3]
     return False, None
 
+# Orçamentos e metas. O total do mês por categoria já é mantido em resumo_mensal, então
+# conferir um orçamento depois de um gasto é uma leitura por chave; o progresso de cada
+# meta fica em metas.valor_atual, somado ou descontado junto com o gasto que contribuiu
+# para ela (gastos.meta_id). Nenhum dos dois relê a tabela gastos.
+LIMIARES_ORCAMENTO = (0.8, 1.0)
+_PALAVRAS_PLANEJAMENTO = _PALAVRAS_REMOVER | {
+    'definir', 'criar', 'nova', 'novo', 'estabelecer', 'orçamento', 'orcamento', 'limite', 'máximo', 'maximo',
+    'controlar', 'mensal', 'mês', 'mes', 'meta', 'metas', 'objetivo', 'poupar', 'economizar', 'guardar', 'sonho', 'reais', 'r',
+}
+_VALOR_PLANEJAMENTO = re.compile(r'\d[\d.,]*')
+_MENCAO_PLANEJAMENTO = re.compile(r'\b(?:(?P<meta>metas?)|orçamento|orcamento)\b', re.IGNORECASE)
+
+# ("alimentação", 500.0) de "Definir orçamento de R$ 500 para alimentação"
+def extrair_alvo_planejamento(texto):
+    numeros = _VALOR_PLANEJAMENTO.findall(texto)
+    valor = _converter_valor(numeros[0].rstrip('.,')) if numeros else None
+    palavras = [p for p in re.findall(r'[^\W\d_]+', texto.lower()) if p not in _PALAVRAS_PLANEJAMENTO]
+    return ' '.join(palavras) or None, valor
+
+# Orçamento mensal recorrente (mes_ano NULL vale para todos os meses)
+def definir_orcamento(conn, numero, categoria, limite):
+    c = conn.cursor()
+    c.execute("DELETE FROM orcamentos WHERE numero = ? AND categoria = ? AND mes_ano IS NULL", (numero, categoria))
+    c.execute("INSERT INTO orcamentos (categoria, limite_mensal, mes_ano, numero) VALUES (?, ?, NULL, ?)",
+             (categoria, limite, numero))
+    conn.commit()
+
+# Orçamentos valendo no mês com o gasto acumulado de cada um (um orçamento do próprio mês
+# tem precedência sobre o recorrente)
+def listar_orcamentos(conn, numero, mes_ano):
+    c = conn.cursor()
+    c.execute("""SELECT o.categoria, o.limite_mensal, COALESCE(r.total, 0) FROM orcamentos o
+                 LEFT JOIN resumo_mensal r ON r.numero = o.numero AND r.mes_ano = ? AND r.categoria = o.categoria
+                 WHERE o.numero = ? AND (o.mes_ano = ? OR o.mes_ano IS NULL)
+                 ORDER BY o.categoria, o.mes_ano IS NULL""", (mes_ano, numero, mes_ano))
+    orcamentos = {}
+    for categoria, limite, total in c.fetchall():
+        orcamentos.setdefault(categoria, (limite, total))
+    return [(categoria, limite, total) for categoria, (limite, total) in orcamentos.items()]
+
+# Alertas de limiar cruzados por este gasto; chamado depois de atualizar_resumo_mensal,
+# na mesma transação, comparando o total antes e depois do gasto
+def verificar_orcamento(c, numero, data, categoria, valor):
+    mes_ano = data[:7]
+    c.execute("""SELECT o.limite_mensal, r.total FROM orcamentos o
+                 JOIN resumo_mensal r ON r.numero = o.numero AND r.mes_ano = ? AND r.categoria = o.categoria
+                 WHERE o.numero = ? AND o.categoria = ? AND (o.mes_ano = ? OR o.mes_ano IS NULL)
+                 ORDER BY o.mes_ano IS NULL LIMIT 1""", (mes_ano, numero, categoria, mes_ano))
+    linha = c.fetchone()
+    if not linha or not linha[0]:
+        return []
+    limite, total = linha
+    anterior = total - valor
+    
+    alertas = []
+    for limiar in reversed(LIMIARES_ORCAMENTO):
+        if anterior < limite * limiar <= total:
+            if limiar >= 1.0:
+                alertas.append(f"🚨 Orçamento de {categoria} estourado: R$ {total:.2f} de R$ {limite:.2f}")
+            else:
+                alertas.append(f"⚠️ Você já usou {total / limite * 100:.0f}% do orçamento de {categoria} "
+                               f"(R$ {total:.2f} de R$ {limite:.2f})")
+            break
+    return alertas
+
+def definir_meta(conn, numero, objetivo, valor_alvo, data_limite=None):
+    c = conn.cursor()
+    c.execute("""INSERT INTO metas (objetivo, valor_alvo, valor_atual, data_limite, concluida, numero)
+                 VALUES (?, ?, 0, ?, 0, ?)""", (objetivo, valor_alvo, data_limite, numero))
+    conn.commit()
+
+def listar_metas(conn, numero):
+    c = conn.cursor()
+    c.execute("SELECT id, objetivo, valor_alvo, valor_atual, concluida FROM metas WHERE numero = ? ORDER BY id",
+             (numero,))
+    return c.fetchall()
+
+# Meta em aberto cujo objetivo aparece na descrição do gasto ("investi 200 na viagem")
+def meta_do_gasto(c, numero, descricao):
+    palavras = set(CategorizadorML._tokenizar(descricao))
+    if not palavras:
+        return None
+    c.execute("SELECT id, objetivo FROM metas WHERE numero = ? AND concluida = 0 ORDER BY id", (numero,))
+    for meta_id, objetivo in c.fetchall():
+        if palavras & set(CategorizadorML._tokenizar(objetivo)):
+            return meta_id
+    return None
+
+# Soma (ou desconta) a contribuição na meta e devolve o alerta de conclusão, se houver
+def atualizar_progresso_meta(c, meta_id, valor):
+    c.execute("""UPDATE metas SET valor_atual = COALESCE(valor_atual, 0) + ?,
+                 concluida = CASE WHEN COALESCE(valor_atual, 0) + ? >= valor_alvo THEN 1 ELSE 0 END
+                 WHERE id = ?""", (valor, valor, meta_id))
+    c.execute("SELECT objetivo, valor_alvo, valor_atual FROM metas WHERE id = ?", (meta_id,))
+    objetivo, valor_alvo, valor_atual = c.fetchone()
+    if valor <= 0:
+        return None
+    if valor_atual >= valor_alvo > valor_atual - valor:
+        return f"🏆 Meta '{objetivo}' alcançada: R$ {valor_atual:.2f} de R$ {valor_alvo:.2f}!"
+    return f"🎯 Meta '{objetivo}': R$ {valor_atual:.2f} de R$ {valor_alvo:.2f} ({valor_atual / valor_alvo * 100:.0f}%)"
+
+# Busca paginada: FTS5 com prefixo em cada palavra, restrita ao número pela coluna
+# numero do índice e ordenada por relevância (bm25, com peso zero para o número)
+TAMANHO_PAGINA_BUSCA = 10
+_COMANDOS_BUSCA = re.compile(r'(buscar|procurar|encontrar|filtrar|pesquisar)', re.IGNORECASE)
+_PALAVRAS_IGNORADAS_BUSCA = _PALAVRAS_REMOVER | {'gasto', 'gastos', 'gastei', 'onde', 'meus', 'minhas'}
+
+def extrair_termos_busca(texto):
+    termos = _COMANDOS_BUSCA.sub('', texto).split()
+    palavras = [p for p in termos if p.lower() not in _PALAVRAS_IGNORADAS_BUSCA]
+    return ' '.join(palavras or termos)
+
+def buscar_gastos(conn, numero, termos, pagina=1, por_pagina=TAMANHO_PAGINA_BUSCA):
+    c = conn.cursor()
+    deslocamento = (pagina - 1) * por_pagina
+    
+    if FTS_DISPONIVEL:
+        palavras = re.findall(r'\w+', termos)
+        tokens_numero = re.findall(r'\w+', numero or '')
+        if not palavras or not tokens_numero:
+            return [], 0, 0
+        consulta = 'numero : "{}" AND ({})'.format(
+            ' '.join(tokens_numero), ' '.join(f'"{palavra}"*' for palavra in palavras))
+        # CROSS JOIN fixa o FTS como tabela externa: com JOIN o SQLite pode partir de
+        # idx_gastos_numero_id e rodar o MATCH uma vez por gasto do número
+        c.execute("""SELECT COUNT(*), COALESCE(SUM(g.valor), 0) FROM gastos_fts f CROSS JOIN gastos g ON g.id = f.rowid
+                     WHERE gastos_fts MATCH ? AND g.numero = ?""", (consulta, numero))
+        quantidade, total = c.fetchone()
+        c.execute("""SELECT g.id, g.valor, g.descricao, g.categoria, g.data
+                     FROM gastos_fts f CROSS JOIN gastos g ON g.id = f.rowid
+                     WHERE gastos_fts MATCH ? AND g.numero = ?
+                     ORDER BY bm25(gastos_fts, 1.0, 1.0, 0.0), g.data DESC LIMIT ? OFFSET ?""",
+                 (consulta, numero, por_pagina, deslocamento))
+    else:
+        padrao = f'%{termos.lower()}%'
+        c.execute("""SELECT COUNT(*), COALESCE(SUM(valor), 0) FROM gastos
+                     WHERE numero = ? AND (LOWER(descricao) LIKE ? OR LOWER(categoria) LIKE ?)""",
+                 (numero, padrao, padrao))
+        quantidade, total = c.fetchone()
+        c.execute("""SELECT id, valor, descricao, categoria, data FROM gastos
+                     WHERE numero = ? AND (LOWER(descricao) LIKE ? OR LOWER(categoria) LIKE ?)
+                     ORDER BY data DESC LIMIT ? OFFSET ?""",
+                 (numero, padrao, padrao, por_pagina, deslocamento))
+    
+    return c.fetchall(), quantidade, total
+
 # Sistema de análise com ML
+@cronometrado("gerar_insights_ml")
 def gerar_insights_ml(conn, numero):
     c = conn.cursor()
     
-    # Atualiza modelos ML
-    dados_treinados = categorizador_ml.treinar_com_dados(conn)
-    predictor_ml.analisar_historico(conn)
-    recomendador_ml.analisar_padroes(conn)
+    # Usa os modelos como estão; gastos novos são aprendidos pelo agendador de treino
+    modelos = obter_modelos(numero, conn)
+    with modelos.lock:
+        tem_previsao = modelos.predictor.analisar_historico()
+        previsao = modelos.predictor.prever_proximos_dias(7) if tem_previsao else None
+        recomendacoes_ml = modelos.recomendador.obter_recomendacoes(2)
     
-    # Insights básicos
+    # Insights básicos (lidos do resumo mensal materializado)
     mes_atual = datetime.now().strftime("%Y-%m")
-    c.execute("SELECT SUM(valor) FROM gastos WHERE substr(data,1,7)=?", (mes_atual,))
-    total_mes = c.fetchone()[0] or 0
-    
-    c.execute("SELECT categoria, SUM(valor) FROM gastos WHERE substr(data,1,7)=? GROUP BY categoria ORDER BY SUM(valor) DESC", 
-             (mes_atual,))
+    c.execute("SELECT categoria, total FROM resumo_mensal WHERE numero = ? AND mes_ano = ? ORDER BY total DESC",
+             (numero, mes_atual))
     gastos_por_categoria = c.fetchall()
     
     insights = []
@@ -416,8 +2206,8 @@ def gerar_insights_ml(conn, numero):
         insights.append(f"💡 Sua maior despesa este mês foi em {categoria_maior[0]}: R$ {categoria_maior[1]:.2f}")
     
     # Previsão com ML
-    if predictor_ml.analisar_historico(conn):
-        previsao, tendencia = predictor_ml.prever_proximos_dias(7)
+    if previsao:
+        previsao, tendencia = previsao
         if previsao:
             if tendencia > 5:
                 insights.append(f"📈 Tendência de alta: seus gastos aumentaram {tendencia:.1f}% na última semana")
@@ -427,32 +2217,455 @@ def gerar_insights_ml(conn, numero):
             insights.append(f"🔮 Previsão para próxima semana: R$ {previsao:.2f}")
     
     # Recomendações com ML
-    recomendacoes_ml = recomendador_ml.obter_recomendacoes(2)
     insights.extend(recomendacoes_ml)
     
     return insights
 
+# Geração de insights fora do caminho da resposta: o webhook responde com os últimos
+# insights em cache e um worker por processo recalcula os insights depois do commit.
+# INSIGHTS_SINCRONOS=1 mantém o cálculo dentro da requisição (útil em testes).
+app.config.setdefault("INSIGHTS_SINCRONOS", os.environ.get("INSIGHTS_SINCRONOS") == "1")
+LIMITE_CACHE_INSIGHTS = 1024
+
+_cache_insights = OrderedDict()
+_insights_pendentes = set()
+_lock_insights = threading.Lock()
+_executor_insights = None
+_executor_pid = None
+
+def _guardar_insights(numero, insights):
+    with _lock_insights:
+        _cache_insights[numero] = insights
+        _cache_insights.move_to_end(numero)
+        while len(_cache_insights) > LIMITE_CACHE_INSIGHTS:
+            _cache_insights.popitem(last=False)
+
+def _atualizar_insights(numero):
+    try:
+        _guardar_insights(numero, gerar_insights_ml(obter_conexao(), numero))
+    except Exception as e:
+        print(f"Erro ao gerar insights: {str(e)}")
+        obter_conexao().rollback()
+    finally:
+        liberar_conexao()
+        with _lock_insights:
+            _insights_pendentes.discard(numero)
+
+def obter_insights(conn, numero):
+    global _executor_insights, _executor_pid
+    
+    if app.config["INSIGHTS_SINCRONOS"]:
+        insights = gerar_insights_ml(conn, numero)
+        _guardar_insights(numero, insights)
+        return insights
+    
+    with _lock_insights:
+        # Executor criado no próprio worker (threads não sobrevivem ao fork do gunicorn)
+        if _executor_insights is None or _executor_pid != os.getpid():
+            _executor_insights = ThreadPoolExecutor(max_workers=1, thread_name_prefix="insights")
+            _executor_pid = os.getpid()
+        # Pedidos repetidos do mesmo número enquanto um cálculo está na fila são agrupados
+        agendar = numero not in _insights_pendentes
+        _insights_pendentes.add(numero)
+        insights = _cache_insights.get(numero, [])
+    
+    if agendar:
+        _executor_insights.submit(_atualizar_insights, numero)
+    return insights
+
+# Retreino em segundo plano com debounce: inserções e remoções marcam o número como sujo
+# e uma thread por processo atualiza os modelos dele no máximo uma vez a cada
+# INTERVALO_TREINO segundos, ou antes disso quando LIMITE_LINHAS_TREINO gastos se
+# acumulam. Pedidos que chegam enquanto o número espera ou treina são agrupados.
+# TREINO_SINCRONO=1 treina dentro da própria chamada (útil em testes).
+INTERVALO_TREINO = float(os.environ.get("INTERVALO_TREINO", "30"))
+LIMITE_LINHAS_TREINO = int(os.environ.get("LIMITE_LINHAS_TREINO", "50"))
+LIMITE_STATUS_TREINO = 4096
+app.config.setdefault("TREINO_SINCRONO", os.environ.get("TREINO_SINCRONO") == "1")
+
+class StatusTreino:
+    def __init__(self):
+        self.linhas_pendentes = 0
+        self.completo = False  # Reconstrução completa pedida (treinar_ml)
+        self.em_execucao = False
+        self.ultimo_treino = None  # Data ISO do último treino concluído
+        self.ultimo_treino_monotonic = 0.0
+        self.duracao = None
+        self.linhas_treinadas = 0
+        self.erro = None
+    
+    def pendente(self):
+        return self.completo or self.linhas_pendentes > 0
+    
+    def devido(self, agora):
+        if self.em_execucao or not self.pendente():
+            return False
+        return (self.completo or self.linhas_pendentes >= LIMITE_LINHAS_TREINO or
+                agora - self.ultimo_treino_monotonic >= INTERVALO_TREINO)
+
+_status_treino = OrderedDict()
+_cond_treino = threading.Condition()
+_agendador_treino_pid = None
+
+def _status_do_numero(numero):
+    # Chamado com _cond_treino adquirido
+    status = _status_treino.get(numero)
+    if status is None:
+        status = _status_treino[numero] = StatusTreino()
+        if len(_status_treino) > LIMITE_STATUS_TREINO:
+            ocioso = next((n for n, s in _status_treino.items() if not s.pendente() and not s.em_execucao), None)
+            if ocioso is not None:
+                del _status_treino[ocioso]
+    return status
+
+def marcar_modelos_sujos(numero, linhas=1, completo=False):
+    if MODELOS_COMPARTILHADOS:
+        return marcar_modelo_compartilhado(numero, completo)
+    
+    with _cond_treino:
+        status = _status_do_numero(numero)
+        status.linhas_pendentes += linhas
+        status.completo = status.completo or completo
+        _cond_treino.notify()
+    
+    if app.config["TREINO_SINCRONO"]:
+        executar_treino(numero)
+    else:
+        _garantir_agendador_treino()
+
+# Pedido do comando treinar_ml: reconstrução completa na próxima volta do agendador
+def agendar_treino_completo(numero):
+    marcar_modelos_sujos(numero, linhas=0, completo=True)
+    return status_treino(numero)
+
+def status_treino(numero):
+    if MODELOS_COMPARTILHADOS:
+        modelos = obter_modelos_compartilhados(numero)
+        info = (modelos.info_treino if modelos is not None else None) or {}
+        return {
+            "ultimo_treino": info.get("ultimo_treino"),
+            "duracao": info.get("duracao"),
+            "linhas_treinadas": info.get("linhas_treinadas", 0),
+            "linhas_pendentes": 0,
+            "completo_pendente": os.path.exists(_caminho_modelo(numero, ".completo")),
+            "em_execucao": False,
+            "erro": None,
+        }
+    
+    with _cond_treino:
+        status = _status_treino.get(numero) or StatusTreino()
+        return {
+            "ultimo_treino": status.ultimo_treino,
+            "duracao": status.duracao,
+            "linhas_treinadas": status.linhas_treinadas,
+            "linhas_pendentes": status.linhas_pendentes,
+            "completo_pendente": status.completo,
+            "em_execucao": status.em_execucao,
+            "erro": status.erro,
+        }
+
+# Reconstrução completa ou só os gastos novos; chamado com modelos.lock adquirido
+def _treinar_modelos(conn, modelos, completo):
+    if completo:
+        linhas = modelos.categorizador.treinar_com_dados(conn)
+        modelos.predictor.carregar_historico(conn)
+        modelos.predictor.analisar_historico()
+        modelos.recomendador.reconstruir(conn)
+    else:
+        linhas = modelos.categorizador.atualizar_com_dados(conn)
+        modelos.predictor.analisar_historico(conn)
+        modelos.recomendador.analisar_padroes(conn)
+    return linhas
+
+# Treina os modelos do número agora com o que estiver pendente
+@cronometrado("executar_treino")
+def executar_treino(numero, conn=None, salvar_snapshot=False):
+    with _cond_treino:
+        status = _status_do_numero(numero)
+        if status.em_execucao:
+            # O treino em andamento pode não ver os gastos novos: repete logo depois dele
+            status.linhas_pendentes = max(status.linhas_pendentes, LIMITE_LINHAS_TREINO)
+            return False
+        completo, linhas_pendentes = status.completo, status.linhas_pendentes
+        status.completo, status.linhas_pendentes = False, 0
+        status.em_execucao = True
+    
+    conn = conn or obter_conexao()
+    inicio = time.monotonic()
+    erro, linhas = None, 0
+    try:
+        modelos = obter_modelos(numero, conn)
+        with modelos.lock:
+            linhas = _treinar_modelos(conn, modelos, completo)
+        if completo or salvar_snapshot:
+            salvar_modelos(conn, modelos)
+        else:
+            salvar_modelos_se_necessario(conn, modelos)
+        
+        # Insights em cache refletem os modelos atualizados
+        with _lock_insights:
+            tem_insights = numero in _cache_insights
+        if tem_insights:
+            _guardar_insights(numero, gerar_insights_ml(conn, numero))
+    except Exception as e:
+        conn.rollback()
+        erro = str(e)
+        print(f"Erro ao treinar modelos: {erro}")
+    finally:
+        with _cond_treino:
+            status.em_execucao = False
+            status.ultimo_treino_monotonic = time.monotonic()
+            status.duracao = status.ultimo_treino_monotonic - inicio
+            status.erro = erro
+            if erro is None:
+                status.ultimo_treino = datetime.now().isoformat()
+                status.linhas_treinadas = linhas
+            else:
+                # Devolve o pedido para a próxima janela
+                status.completo = status.completo or completo
+                status.linhas_pendentes += linhas_pendentes
+    return erro is None
+
+def _agendar_treinos():
+    while True:
+        with _cond_treino:
+            _cond_treino.wait(timeout=1.0)
+            agora = time.monotonic()
+            devidos = [numero for numero, status in _status_treino.items() if status.devido(agora)]
+        for numero in devidos:
+            try:
+                executar_treino(numero)
+            finally:
+                liberar_conexao()
+
+def _garantir_agendador_treino():
+    global _agendador_treino_pid
+    # Uma thread de treino por processo (threads não sobrevivem ao fork do gunicorn)
+    if _agendador_treino_pid == os.getpid():
+        return
+    with _cond_treino:
+        if _agendador_treino_pid != os.getpid():
+            threading.Thread(target=_agendar_treinos, name="treino", daemon=True).start()
+            _agendador_treino_pid = os.getpid()
+
+@app.teardown_request
+def _liberar_conexao_requisicao(exc):
+    liberar_conexao()
+
+# Idempotência do webhook: o Twilio reenvia o POST com o mesmo MessageSid quando a
+# resposta demora. A primeira entrega reserva o SID em mensagens_processadas e grava a
+# TwiML gerada; as repetições recebem essa resposta sem executar o handler de novo.
+# Os SIDs respondidos recentemente ficam também num LRU em memória.
+TTL_MENSAGENS = 24 * 3600  # segundos que um SID continua registrado
+PRAZO_PROCESSAMENTO = 30  # reserva sem resposta há mais tempo é considerada abandonada
+ESPERA_DUPLICADA = 10  # segundos que uma repetição aguarda a entrega original terminar
+INTERVALO_LIMPEZA_MENSAGENS = 300
+LIMITE_CACHE_MENSAGENS = 10000
+
+_cache_mensagens = OrderedDict()
+_lock_mensagens = threading.Lock()
+_ultima_limpeza_mensagens = 0.0
+
+def _guardar_resposta_mensagem(message_sid, resposta):
+    with _lock_mensagens:
+        _cache_mensagens[message_sid] = resposta
+        _cache_mensagens.move_to_end(message_sid)
+        while len(_cache_mensagens) > LIMITE_CACHE_MENSAGENS:
+            _cache_mensagens.popitem(last=False)
+
+def resposta_registrada(conn, message_sid):
+    with _lock_mensagens:
+        resposta = _cache_mensagens.get(message_sid)
+    if resposta is None:
+        c = conn.cursor()
+        c.execute("SELECT resposta FROM mensagens_processadas WHERE message_sid = ?", (message_sid,))
+        linha = c.fetchone()
+        if linha and linha[0] is not None:
+            resposta = linha[0]
+            _guardar_resposta_mensagem(message_sid, resposta)
+    return resposta
+
+# Reserva o SID para esta entrega; False se outra entrega já o atendeu ou ainda o processa
+def reservar_mensagem(conn, message_sid, numero):
+    agora = time.time()
+    c = conn.cursor()
+    c.execute("""INSERT INTO mensagens_processadas (message_sid, numero, criado_em) VALUES (?, ?, ?)
+                 ON CONFLICT(message_sid) DO UPDATE SET criado_em = excluded.criado_em
+                 WHERE mensagens_processadas.resposta IS NULL AND mensagens_processadas.criado_em < ?""",
+             (message_sid, numero, agora, agora - PRAZO_PROCESSAMENTO))
+    reservada = c.rowcount > 0
+    conn.commit()
+    limpar_mensagens_expiradas(conn, agora)
+    return reservada
+
+def registrar_resposta_mensagem(conn, message_sid, resposta):
+    conn.cursor().execute("UPDATE mensagens_processadas SET resposta = ? WHERE message_sid = ?",
+                          (resposta, message_sid))
+    conn.commit()
+    _guardar_resposta_mensagem(message_sid, resposta)
+
+# Desfaz a reserva de uma entrega que falhou, para que a repetição seja processada
+def liberar_mensagem(conn, message_sid):
+    conn.cursor().execute("DELETE FROM mensagens_processadas WHERE message_sid = ? AND resposta IS NULL",
+                          (message_sid,))
+    conn.commit()
+
+# Apaga SIDs mais antigos que o TTL, no máximo uma vez por intervalo em cada processo
+def limpar_mensagens_expiradas(conn, agora=None):
+    global _ultima_limpeza_mensagens
+    agora = agora or time.time()
+    if agora - _ultima_limpeza_mensagens < INTERVALO_LIMPEZA_MENSAGENS:
+        return 0
+    _ultima_limpeza_mensagens = agora
+    c = conn.cursor()
+    c.execute("DELETE FROM mensagens_processadas WHERE criado_em < ?", (agora - TTL_MENSAGENS,))
+    removidas = c.rowcount
+    conn.commit()
+    return removidas
+
+def aguardar_resposta_mensagem(conn, message_sid):
+    limite = time.monotonic() + ESPERA_DUPLICADA
+    while True:
+        resposta = resposta_registrada(conn, message_sid)
+        if resposta is not None or time.monotonic() >= limite:
+            return resposta
+        time.sleep(0.2)
+
+# Perfil por amostragem, opt-in: PERFIL_TAXA sorteia uma fração das requisições do webhook
+# e o cabeçalho X-Perfil com o valor de TOKEN_PERFIL liga o perfil de uma requisição. Uma
+# thread lê a pilha da thread da requisição a cada INTERVALO_AMOSTRA_PERFIL e grava as
+# pilhas em PERFIL_DIR no formato "collapsed" (flamegraph.pl, speedscope).
+app.config.setdefault("PERFIL_TAXA", float(os.environ.get("PERFIL_TAXA", "0")))
+TOKEN_PERFIL = os.environ.get("TOKEN_PERFIL")
+PERFIL_DIR = os.environ.get("PERFIL_DIR", "perfis")
+INTERVALO_AMOSTRA_PERFIL = 0.001
+
+class AmostradorPilhas:
+    def __init__(self, thread_id, intervalo=INTERVALO_AMOSTRA_PERFIL):
+        self.thread_id = thread_id
+        self.intervalo = intervalo
+        self.pilhas = defaultdict(int)
+        self._parar = threading.Event()
+        self._thread = threading.Thread(target=self._amostrar, name="perfil", daemon=True)
+    
+    def iniciar(self):
+        self._thread.start()
+        return self
+    
+    def _amostrar(self):
+        while not self._parar.wait(self.intervalo):
+            frame = sys._current_frames().get(self.thread_id)
+            quadros = []
+            while frame is not None:
+                quadros.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            if quadros:
+                self.pilhas[";".join(reversed(quadros))] += 1
+    
+    def parar(self, rotulo):
+        self._parar.set()
+        self._thread.join()
+        os.makedirs(PERFIL_DIR, exist_ok=True)
+        caminho = os.path.join(PERFIL_DIR, f"{datetime.now():%Y%m%d-%H%M%S-%f}-{rotulo}.txt")
+        with open(caminho, "w", encoding="utf-8") as arquivo:
+            for pilha, amostras in sorted(self.pilhas.items()):
+                arquivo.write(f"{pilha} {amostras}\n")
+        return caminho
+
+def _iniciar_perfil():
+    pedido = TOKEN_PERFIL and request.headers.get("X-Perfil") == TOKEN_PERFIL
+    taxa = app.config["PERFIL_TAXA"]
+    if pedido or (taxa and random.random() < taxa):
+        return AmostradorPilhas(threading.get_ident()).iniciar()
+    return None
+
 @app.route("/whatsapp", methods=["POST"])
 def whatsapp_bot():
+    amostrador = _iniciar_perfil()
+    if not app.config["METRICAS"] and amostrador is None:
+        return _atender_whatsapp()
+    
+    _sql_requisicao.consultas, _sql_requisicao.segundos, _sql_requisicao.ativo = 0, 0.0, True
+    inicio = time.perf_counter()
+    try:
+        return _atender_whatsapp()
+    finally:
+        _sql_requisicao.ativo = False
+        intencao = g.get("intencao_whatsapp", "desconhecido")
+        if app.config["METRICAS"]:
+            HIST_REQUISICAO.observar(intencao, time.perf_counter() - inicio)
+            HIST_SQL_CONSULTAS.observar(intencao, _sql_requisicao.consultas)
+            HIST_SQL_REQUISICAO.observar(intencao, _sql_requisicao.segundos)
+        if amostrador is not None:
+            amostrador.parar(intencao)
+
+def _atender_whatsapp():
+    _garantir_manutencao()
+    message_sid = request.form.get('MessageSid')
+    if not message_sid:
+        return processar_whatsapp()
+    
+    with _lock_mensagens:
+        resposta = _cache_mensagens.get(message_sid)
+    if resposta is not None:
+        g.intencao_whatsapp = "repetida"
+        return resposta
+    
+    conn = obter_conexao()
+    with etapa("idempotencia"):
+        reservada = reservar_mensagem(conn, message_sid, request.form.get('From'))
+    if not reservada:
+        g.intencao_whatsapp = "repetida"
+        # Repetição: devolve a resposta da entrega original (ou uma vazia, se ela não terminar a tempo)
+        resposta = aguardar_resposta_mensagem(conn, message_sid)
+        return resposta if resposta is not None else str(twiml.MessagingResponse())
+    
+    resposta = processar_whatsapp()
+    if g.get("erro_whatsapp"):
+        liberar_mensagem(obter_conexao(), message_sid)
+    else:
+        registrar_resposta_mensagem(obter_conexao(), message_sid, resposta)
+    return resposta
+
+def processar_whatsapp():
     try:
         msg_recebida = request.form.get('Body')
         numero = request.form.get('From')
-        resposta = MessagingResponse()
+        resposta = twiml.MessagingResponse()
 
-        conn = sqlite3.connect(db_file)
+        conn = obter_conexao()
         c = conn.cursor()
+        with etapa("modelos"):
+            modelos = obter_modelos(numero, conn)
+        
+        # Recupera o estado da conversa e o histórico de intenções para ML contextual
+        direcao_pagina = _COMANDOS_PAGINA.get(msg_recebida.strip().lower())
+        with etapa("contexto"):
+            estado = obter_estado_conversa(numero, recarregar=direcao_pagina is not None)
+        historico_intencoes = [i for i in estado.intencoes if i]
+        ultima_intencao, contexto = estado.ultima_intencao, estado.dados
         
-        # Recupera histórico de intenções para ML contextual
-        c.execute("SELECT ultima_intencao FROM contexto WHERE numero = ? ORDER BY timestamp DESC LIMIT 10", (numero,))
-        historico_intencoes = [row[0] for row in c.fetchall() if row[0]]
+        # Processa a mensagem com ML e extrai seus dados numa única análise
+        with etapa("analise"):
+            analise = analisar_mensagem(msg_recebida, historico_intencoes)
+        intencao = analise.intencao
+        dados_contexto = None
         
-        # Processa a mensagem com ML
-        intencao = analisar_intencao_com_ml(msg_recebida, historico_intencoes)
-        ultima_intencao, contexto = recuperar_contexto(numero)
+        # "mais"/"anterior" depois de uma busca ou listagem navegam entre as páginas
+        navegacao = (contexto if direcao_pagina and contexto is not None and "pagina" in contexto and
+                     ultima_intencao in ("buscar_gastos", "consultar_gastos", "remover_gasto") else None)
+        proxima_pagina = navegacao is not None and ultima_intencao == "buscar_gastos"
+        if navegacao is not None:
+            intencao = ultima_intencao
+        # "Definir meta ..." e "orçamento de R$ 500" também casam com padrões de peso maior
+        elif intencao in ("adicionar_gasto", "definir_orcamento"):
+            mencao = _MENCAO_PLANEJAMENTO.search(msg_recebida)
+            if mencao:
+                intencao = "definir_meta" if mencao.group("meta") else "definir_orcamento"
+        g.intencao_whatsapp = intencao
         
-        # Extrai dados da mensagem
-        valor = extrair_valor(msg_recebida)
-        descricao = extrair_descricao(msg_recebida)
+        valor = analise.valor
+        descricao = analise.descricao
         
         # Sistema de diálogo com ML
         if intencao == "saudacao":
@@ -462,57 +2675,56 @@ def whatsapp_bot():
         elif intencao == "adicionar_gasto":
             if valor:
                 # Usa ML para categorização
-                categoria = categorizador_ml.prever_categoria(descricao) if descricao else "outros"
+                with modelos.lock:
+                    categoria = modelos.categorizador.prever_categoria(descricao) if descricao else "outros"
                 
                 if not descricao:
                     salvar_contexto(numero, "aguardando_descricao", {"valor": valor})
                     resposta.message(f"💵 Valor identificado: R$ {valor:.2f}. Por favor, digite a descrição deste gasto.")
                 else:
                     hoje = datetime.now().isoformat()
-                    c.execute("INSERT INTO gastos (valor, descricao, categoria, data) VALUES (?, ?, ?, ?)",
-                             (valor, descricao, categoria, hoje))
-                    conn.commit()
+                    with etapa("gravar_gasto"):
+                        meta_id = meta_do_gasto(c, numero, descricao)
+                        c.execute("""INSERT INTO gastos (valor, descricao, categoria, data, dia, numero, meta_id)
+                                     VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                                 (valor, descricao, categoria, hoje, dia_numero(hoje), numero, meta_id))
+                        atualizar_resumo_mensal(c, numero, hoje, categoria, valor)
+                        alertas = verificar_orcamento(c, numero, hoje, categoria, valor)
+                        if meta_id is not None:
+                            alertas.append(atualizar_progresso_meta(c, meta_id, valor))
+                        conn.commit()
+                    invalidar_paginas(numero)
                     
-                    # Atualiza modelos ML com novo dado
-                    categorizador_ml.treinar_com_dados(conn)
-                    
-                    insights = gerar_insights_ml(conn, numero)
+                    # Os modelos aprendem o novo gasto no próximo treino agendado
+                    marcar_modelos_sujos(numero)
+                    with etapa("insights"):
+                        insights = obter_insights(conn, numero)
                     msg_insights = "\n".join(insights) if insights else ""
                     
-                    resposta.message(f"✅ Gasto de R$ {valor:.2f} adicionado em {categoria}: {descricao}\n\n{msg_insights}")
+                    msg_alertas = "".join(f"{alerta}\n" for alerta in alertas)
+                    resposta.message(f"✅ Gasto de R$ {valor:.2f} adicionado em {categoria}: {descricao}\n\n"
+                                     f"{msg_alertas}{msg_insights}")
             else:
                 resposta.message("Não consegui identificar o valor. Por favor, digite algo como:\n'Gastei 50 reais no almoço'")
         
         elif intencao == "consultar_gastos":
-            c.execute("SELECT id, valor, descricao, categoria, data FROM gastos ORDER BY data DESC, id DESC LIMIT 10")
-            gastos = c.fetchall()
-            
-            if gastos:
-                msg = "📋 Seus últimos 10 gastos:\n\n"
-                total = 0
-                
-                for id_gasto, v, d, cat, dt in gastos:
-                    data_formatada = formatar_data(dt)
-                    msg += f"• #{id_gasto} | {data_formatada} | {cat} | R$ {v:.2f} - {d}\n"
-                    total += v
-                
-                msg += f"\n💰 Total: R$ {total:.2f}"
-                msg += f"\n\n🗑️ Para remover um gasto, digite 'remover X' (onde X é o número do gasto)"
-                resposta.message(msg)
+            if navegacao is not None and direcao_pagina == "depois" and navegacao["pagina"] <= 1:
+                dados_contexto = navegacao
+                resposta.message("Você já está na primeira página.")
             else:
-                resposta.message("Nenhum gasto registrado ainda.")
+                msg, dados_contexto = pagina_gastos(conn, numero, "consultar", navegacao, direcao_pagina)
+                resposta.message(msg)
         
         elif intencao == "resumo_financeiro":
             # Gera relatório com insights de ML
-            insights = gerar_insights_ml(conn, numero)
+            with etapa("insights"):
+                insights = obter_insights(conn, numero)
             
             mes_atual = datetime.now().strftime("%Y-%m")
-            c.execute("SELECT SUM(valor) FROM gastos WHERE substr(data,1,7)=?", (mes_atual,))
-            total_mes = c.fetchone()[0] or 0
-            
-            c.execute("SELECT categoria, SUM(valor) FROM gastos WHERE substr(data,1,7)=? GROUP BY categoria", 
-                     (mes_atual,))
+            c.execute("SELECT categoria, total FROM resumo_mensal WHERE numero = ? AND mes_ano = ?",
+                     (numero, mes_atual))
             gastos_categorias = c.fetchall()
+            total_mes = sum(val for _, val in gastos_categorias)
             
             msg = f"📊 Resumo Financeiro - {mes_atual}\n\n"
             msg += f"💰 Total gasto: R$ {total_mes:.2f}\n\n"
@@ -524,15 +2736,18 @@ def whatsapp_bot():
                     msg += f"• {cat}: R$ {val:.2f} ({percentual:.1f}%)\n"
             
             if insights:
-                msg += f"\n🔍 Insights de IA:\n" + "\n".join(insights)
+                msg += "\n🔍 Insights de IA:\n" + "\n".join(insights)
             
             resposta.message(msg)
         
         elif intencao == "previsao_gastos":
-            if predictor_ml.analisar_historico(conn):
-                previsao_7_dias, tendencia = predictor_ml.prever_proximos_dias(7)
-                previsao_30_dias, _ = predictor_ml.prever_proximos_dias(30)
-                
+            with modelos.lock:
+                tem_previsao = modelos.predictor.analisar_historico()
+                if tem_previsao:
+                    previsao_7_dias, tendencia = modelos.predictor.prever_proximos_dias(7)
+                    previsao_30_dias, _ = modelos.predictor.prever_proximos_dias(30)
+            
+            if tem_previsao:
                 msg = "🔮 Previsão de Gastos (Machine Learning)\n\n"
                 msg += f"📊 Próximos 7 dias: R$ {previsao_7_dias:.2f}\n"
                 msg += f"📅 Próximos 30 dias: R$ {previsao_30_dias:.2f}\n"
@@ -555,63 +2770,99 @@ def whatsapp_bot():
                 resposta.message("📊 Preciso de mais dados para fazer previsões precisas. Continue registrando seus gastos!")
         
         elif intencao == "treinar_ml":
-            dados_treinados = categorizador_ml.treinar_com_dados(conn)
-            predictor_ml.analisar_historico(conn)
-            recomendador_ml.analisar_padroes(conn)
+            status = agendar_treino_completo(numero)
             
-            resposta.message(f"🤖 Modelos de ML treinados com {dados_treinados} registros!\n\nSistema de IA atualizado e melhorado.")
+            msg = "🤖 Treinamento dos modelos de ML agendado!"
+            if status["em_execucao"]:
+                msg += "\n\n⏳ Um treinamento já está em andamento."
+            if status["ultimo_treino"]:
+                msg += (f"\n\n📚 Último treino: {formatar_data(status['ultimo_treino'])} com "
+                        f"{status['linhas_treinadas']} registros em {status['duracao']:.2f}s")
+            resposta.message(msg)
         
         elif intencao == "buscar_gastos":
-            termos = re.sub(r'(buscar|procurar|encontrar|filtrar|pesquisar)', '', msg_recebida, flags=re.IGNORECASE)
-            termos = termos.strip()
+            if proxima_pagina:
+                termos = contexto["termos"]
+                pagina = max(1, contexto["pagina"] + (1 if direcao_pagina == "antes" else -1))
+            else:
+                termos, pagina = extrair_termos_busca(msg_recebida), 1
             
             if termos:
-                c.execute("SELECT id, valor, descricao, categoria, data FROM gastos WHERE descricao LIKE ? OR categoria LIKE ? ORDER BY data DESC", 
-                         (f'%{termos}%', f'%{termos}%'))
-                gastos = c.fetchall()
+                gastos, quantidade, total = buscar_gastos(conn, numero, termos, pagina)
+                total_paginas = max(1, math.ceil(quantidade / TAMANHO_PAGINA_BUSCA))
                 
                 if gastos:
-                    msg = f"🔍 Gastos encontrados com '{termos}':\n\n"
-                    total = 0
-                    
-                    for id_gasto, v, d, cat, dt in gastos:
-                        data_formatada = formatar_data(dt)
-                        msg += f"• #{id_gasto} | {data_formatada} | {cat} | R$ {v:.2f} - {d}\n"
-                        total += v
-                    
-                    msg += f"\n💰 Total: R$ {total:.2f}"
-                    msg += f"\n\n🗑️ Para remover um gasto, digite 'remover X' (onde X é o número do gasto)"
-                    resposta.message(msg)
+                    cabecalho = f"🔍 Gastos encontrados com '{termos}' (página {pagina} de {total_paginas}):"
+                    rodape = f"\n\n💰 Total: R$ {total:.2f} em {quantidade} gastos"
+                    if pagina < total_paginas:
+                        rodape += "\n➡️ Digite 'mais' para ver os próximos resultados"
+                    if pagina > 1:
+                        rodape += "\n⬅️ Digite 'anterior' para voltar"
+                    rodape += "\n\n🗑️ Para remover um gasto, digite 'remover X' (onde X é o número do gasto)"
+                    dados_contexto = {"termos": termos, "pagina": pagina}
+                    resposta.message(montar_mensagem(cabecalho, [_linha_gasto(*gasto) for gasto in gastos], rodape))
+                elif proxima_pagina:
+                    resposta.message(f"Não há mais gastos com '{termos}'.")
                 else:
                     resposta.message(f"Nenhum gasto encontrado com '{termos}'.")
             else:
                 resposta.message("Por favor, digite o que deseja buscar. Ex: 'buscar gastos com mercado'")
         
+        elif intencao == "definir_orcamento":
+            categoria, limite = extrair_alvo_planejamento(msg_recebida)
+            mes_atual = datetime.now().strftime("%Y-%m")
+            
+            if categoria and limite:
+                definir_orcamento(conn, numero, categoria, limite)
+                resposta.message(f"📌 Orçamento mensal de R$ {limite:.2f} definido para {categoria}.\n\n"
+                                 f"Aviso quando você chegar a 80% e a 100% do limite.")
+            else:
+                orcamentos = listar_orcamentos(conn, numero, mes_atual)
+                msg = ""
+                if orcamentos:
+                    msg = f"📌 Seus orçamentos - {mes_atual}\n\n"
+                    for cat, limite, total in orcamentos:
+                        msg += f"• {cat}: R$ {total:.2f} de R$ {limite:.2f} ({total / limite * 100 if limite else 0:.0f}%)\n"
+                    msg += "\n"
+                msg += "Para definir um orçamento, digite algo como:\n'Definir orçamento de 500 para alimentação'"
+                resposta.message(msg)
+        
+        elif intencao == "definir_meta":
+            objetivo, valor_alvo = extrair_alvo_planejamento(msg_recebida)
+            
+            if objetivo and valor_alvo:
+                definir_meta(conn, numero, objetivo, valor_alvo)
+                resposta.message(f"🎯 Meta '{objetivo}' criada: R$ {valor_alvo:.2f}.\n\n"
+                                 f"Gastos que mencionam '{objetivo}' contam para ela. Ex: 'Investi 200 reais na {objetivo}'")
+            else:
+                metas = listar_metas(conn, numero)
+                msg = ""
+                if metas:
+                    msg = "🎯 Suas metas:\n\n"
+                    for _, obj, alvo, atual, concluida in metas:
+                        marcador = "🏆" if concluida else "•"
+                        msg += f"{marcador} {obj}: R$ {atual or 0:.2f} de R$ {alvo:.2f}\n"
+                    msg += "\n"
+                msg += "Para criar uma meta, digite algo como:\n'Criar meta de viagem 3000'"
+                resposta.message(msg)
+        
         elif intencao == "remover_gasto":
-            id_gasto = extrair_id_remocao(msg_recebida)
+            id_gasto = analise.id_remocao
             
             if id_gasto:
-                sucesso, gasto = remover_gasto(conn, id_gasto)
+                sucesso, gasto = remover_gasto(conn, numero, id_gasto)
                 
                 if sucesso:
                     id_removido, valor_removido, descricao_removida = gasto
                     resposta.message(f"🗑️ Gasto removido com sucesso!\n\nID: #{id_removido}\nValor: R$ {valor_removido:.2f}\nDescrição: {descricao_removida}")
                 else:
                     resposta.message(f"❌ Não foi encontrado nenhum gasto com o ID #{id_gasto}.\n\nDigite 'listar' para ver seus gastos disponíveis.")
+            elif navegacao is not None and direcao_pagina == "depois" and navegacao["pagina"] <= 1:
+                dados_contexto = navegacao
+                resposta.message("Você já está na primeira página.")
             else:
-                gastos = listar_gastos_para_remocao(conn)
-                
-                if gastos:
-                    msg = "📋 Seus últimos gastos (com IDs):\n\n"
-                    
-                    for id_gasto, v, d, cat, dt in gastos:
-                        data_formatada = formatar_data(dt)
-                        msg += f"• #{id_gasto} | {data_formatada} | {cat} | R$ {v:.2f} - {d}\n"
-                    
-                    msg += f"\n🗑️ Para remover um gasto, digite 'remover X' (onde X é o número do gasto)"
-                    resposta.message(msg)
-                else:
-                    resposta.message("Nenhum gasto registrado para remover.")
+                msg, dados_contexto = pagina_gastos(conn, numero, "remover", navegacao, direcao_pagina)
+                resposta.message(msg)
         
         elif intencao == "ajuda":
             resposta.message(
@@ -638,23 +2889,476 @@ def whatsapp_bot():
             resposta.message(f"{random.choice(respostas_nao_reconhecidas)}\n\nDigite 'ajuda' para ver o que posso fazer.")
         
         # Salva o contexto da conversa
-        salvar_contexto(numero, intencao)
+        with etapa("salvar_contexto"):
+            salvar_contexto(numero, intencao, dados_contexto)
         
-        conn.close()
         return str(resposta)
     
     except Exception as e:
         print(f"Erro: {str(e)}")
-        resposta = MessagingResponse()
+        # Não deixa uma transação pela metade segurando o lock da conexão persistente
+        obter_conexao().rollback()
+        g.erro_whatsapp = True
+        resposta = twiml.MessagingResponse()
         resposta.message("😕 Ocorreu um erro inesperado. Por favor, tente novamente.")
         return str(resposta)
 
+# Importação em massa de extratos (CSV ou OFX): o arquivo é lido em streaming, cada
+# lote é categorizado de uma vez e inserido com executemany, tudo numa transação; o
+# resumo mensal recebe um upsert por mês/categoria no fim e os modelos do número fazem
+# uma única atualização incremental. A memória fica limitada ao tamanho do lote.
+TAMANHO_LOTE_IMPORTACAO = 1000
+TOKEN_IMPORTACAO = os.environ.get("TOKEN_IMPORTACAO")  # sem token o endpoint fica desligado
+
+_COLUNAS_IMPORTACAO = {
+    "data": ("data", "date", "dt"),
+    "valor": ("valor", "value", "amount", "quantia"),
+    "descricao": ("descricao", "descrição", "description", "historico", "histórico", "memo"),
+    "categoria": ("categoria", "category"),
+}
+_FORMATOS_DATA_IMPORTACAO = ("%Y-%m-%d", "%d/%m/%Y", "%d/%m/%y", "%Y%m%d")
+_TAG_OFX = re.compile(r'<(/?\w+)>([^<\r\n]*)')
+
+def _converter_data(texto):
+    texto = texto.strip().split('T')[0].split(' ')[0]
+    for formato in _FORMATOS_DATA_IMPORTACAO:
+        try:
+            return datetime.strptime(texto, formato).isoformat()
+        except ValueError:
+            continue
+    return None
+
+# Aceita "1234.56", "1.234,56", "1,234.56" e "R$ -12,90", mantendo o sinal: o último
+# separador ('.' ou ',') é o decimal e os anteriores separam milhares, a não ser que
+# ele se repita ("1.000.000") ou seja o único e venha seguido de três dígitos ("1.000")
+def _converter_valor(texto):
+    texto = texto.replace('R$', '').replace(' ', '').strip()
+    decimal = max(texto.rfind('.'), texto.rfind(','))
+    unico = decimal >= 0 and texto.count('.') + texto.count(',') == 1
+    if decimal >= 0 and (texto.count(texto[decimal]) > 1 or (unico and len(texto) - decimal == 4)):
+        texto = texto.replace('.', '').replace(',', '')
+    elif decimal >= 0:
+        texto = texto[:decimal].replace('.', '').replace(',', '') + '.' + texto[decimal + 1:]
+    try:
+        return float(texto)
+    except ValueError:
+        return None
+
+# Transações (data, valor, descricao, categoria) de um CSV com cabeçalho; linhas
+# inválidas viram None para serem contadas como ignoradas. Convenção de sinal: numa
+# planilha de gastos (padrão) os gastos são positivos; com extrato=True o arquivo segue
+# a convenção do banco e do OFX (débitos negativos). Nos dois casos as linhas com o
+# sinal oposto são créditos (salário, estorno, transferência recebida) e, como em
+# ler_ofx, são puladas.
+def ler_csv(arquivo, extrato=False):
+    primeira = arquivo.readline()
+    delimitador = max((';', ',', '\t'), key=primeira.count)
+    leitor = csv.reader(itertools.chain([primeira], arquivo), delimiter=delimitador)
+    cabecalho = [coluna.strip().lower() for coluna in next(leitor, [])]
+    posicoes = {}
+    for campo, nomes in _COLUNAS_IMPORTACAO.items():
+        posicoes[campo] = next((i for i, coluna in enumerate(cabecalho) if coluna in nomes), None)
+    if posicoes["data"] is None or posicoes["valor"] is None:
+        raise ValueError("O CSV precisa das colunas 'data' e 'valor'")
+    
+    for linha in leitor:
+        if not linha:
+            continue
+        campos = {campo: linha[i].strip() if i is not None and i < len(linha) else ""
+                  for campo, i in posicoes.items()}
+        data, valor = _converter_data(campos["data"]), _converter_valor(campos["valor"])
+        if data is None or not valor:
+            yield None
+            continue
+        if extrato:
+            valor = -valor
+        if valor > 0:  # créditos não são gastos
+            yield data, valor, campos["descricao"], campos["categoria"].lower() or None
+
+# Débitos de um extrato OFX (SGML 1.x ou XML 2.x), lidos tag a tag
+def ler_ofx(arquivo):
+    transacao = None
+    for linha in arquivo:
+        for tag, conteudo in _TAG_OFX.findall(linha):
+            tag = tag.upper()
+            if tag == "STMTTRN":
+                transacao = {}
+            elif tag == "/STMTTRN" and transacao is not None:
+                data = _converter_data(transacao.get("DTPOSTED", "")[:8])
+                try:
+                    valor = float(transacao.get("TRNAMT", "").replace(',', '.'))
+                except ValueError:
+                    valor = None
+                if data is None or valor is None:
+                    yield None
+                elif valor < 0:  # créditos não são gastos
+                    descricao = transacao.get("MEMO") or transacao.get("NAME") or ""
+                    yield data, -valor, descricao.strip(), None
+                transacao = None
+            elif transacao is not None and not tag.startswith('/'):
+                transacao[tag] = conteudo.strip()
+
+def importar_gastos(conn, numero, transacoes, tamanho_lote=TAMANHO_LOTE_IMPORTACAO):
+    modelos = obter_modelos(numero, conn)
+    c = conn.cursor()
+    resumo = defaultdict(lambda: [0.0, 0])  # (mes_ano, categoria) -> [total, quantidade]
+    importados = ignorados = 0
+    
+    try:
+        transacoes = iter(transacoes)
+        while True:
+            lote = list(itertools.islice(transacoes, tamanho_lote))
+            if not lote:
+                break
+            validas = [transacao for transacao in lote if transacao is not None]
+            ignorados += len(lote) - len(validas)
+            
+            # Só as transações sem categoria passam pelo modelo, todas numa chamada
+            with modelos.lock:
+                previstas = iter(modelos.categorizador.prever_categorias(
+                    [descricao for _, _, descricao, categoria in validas if not categoria]))
+            
+            linhas = []
+            for data, valor, descricao, categoria in validas:
+                categoria = categoria or next(previstas)
+                linhas.append((valor, descricao, categoria, data, dia_numero(data), numero))
+                agregado = resumo[(data[:7], categoria)]
+                agregado[0] += valor
+                agregado[1] += 1
+            c.executemany("INSERT INTO gastos (valor, descricao, categoria, data, dia, numero) VALUES (?, ?, ?, ?, ?, ?)",
+                         linhas)
+            importados += len(linhas)
+        
+        c.executemany(_SQL_RESUMO_MENSAL, [(numero, mes_ano, categoria, total, quantidade)
+                                           for (mes_ano, categoria), (total, quantidade) in resumo.items()])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    if importados:
+        invalidar_paginas(numero)
+        if MODELOS_COMPARTILHADOS:
+            marcar_modelos_sujos(numero, importados)
+        else:
+            executar_treino(numero, conn, salvar_snapshot=True)
+    return importados, ignorados
+
+def _leitor_importacao(nome_arquivo, formato=None, extrato=False):
+    formato = (formato or os.path.splitext(nome_arquivo or "")[1].lstrip('.') or "csv").lower()
+    if formato not in ("csv", "ofx"):
+        raise ValueError(f"Formato não suportado: {formato}")
+    return ler_ofx if formato == "ofx" else lambda arquivo: ler_csv(arquivo, extrato)
+
+@app.route("/importar", methods=["POST"])
+def importar_endpoint():
+    if not TOKEN_IMPORTACAO or request.headers.get("Authorization") != f"Bearer {TOKEN_IMPORTACAO}":
+        return jsonify({"erro": "não autorizado"}), 403
+    arquivo, numero = request.files.get("arquivo"), request.form.get("numero")
+    if arquivo is None or not numero:
+        return jsonify({"erro": "envie 'arquivo' e 'numero'"}), 400
+    
+    try:
+        ler = _leitor_importacao(arquivo.filename, request.form.get("formato"),
+                                 request.form.get("extrato") in ("1", "true"))
+        texto = io.TextIOWrapper(arquivo.stream, encoding=request.form.get("encoding", "utf-8-sig"),
+                                 errors="replace", newline="")
+        importados, ignorados = importar_gastos(obter_conexao(), numero, ler(texto))
+    except ValueError as e:
+        return jsonify({"erro": str(e)}), 400
+    return jsonify({"importados": importados, "ignorados": ignorados})
+
+@app.cli.command("importar-gastos")
+@click.argument("caminho", type=click.Path(exists=True, dir_okay=False))
+@click.option("--numero", required=True, help="Número (From do WhatsApp) dono dos gastos")
+@click.option("--formato", type=click.Choice(["csv", "ofx"]), help="Padrão: pela extensão do arquivo")
+@click.option("--encoding", default="utf-8-sig", show_default=True)
+@click.option("--extrato", is_flag=True, help="CSV de extrato bancário: débitos negativos, créditos positivos")
+def importar_gastos_comando(caminho, numero, formato, encoding, extrato):
+    """Importa gastos de um extrato CSV ou OFX."""
+    ler = _leitor_importacao(caminho, formato, extrato)
+    with open(caminho, encoding=encoding, errors="replace", newline="") as arquivo:
+        importados, ignorados = importar_gastos(obter_conexao(), numero, ler(arquivo))
+    print(f"Gastos importados: {importados} (linhas ignoradas: {ignorados})")
+
+# Exportação em streaming do histórico de um número (CSV ou NDJSON): os gastos são lidos
+# em lotes pela chave (data, id) sobre idx_gastos_numero_data, cada lote numa leitura curta,
+# então a memória fica limitada ao lote e nenhuma transação dura a exportação inteira
+TAMANHO_LOTE_EXPORTACAO = 5000
+TOKEN_EXPORTACAO = os.environ.get("TOKEN_EXPORTACAO") or TOKEN_IMPORTACAO
+_COLUNAS_EXPORTACAO = ("id", "data", "valor", "descricao", "categoria", "localizacao", "metodo_pagamento", "tags")
+
+# Lotes de linhas com as colunas de _COLUNAS_EXPORTACAO; inicio e fim são dias YYYY-MM-DD
+# inclusivos. Lê gastos_historico para que o backup inclua os gastos já arquivados.
+def iterar_gastos(numero, inicio=None, fim=None, categoria=None, tamanho_lote=TAMANHO_LOTE_EXPORTACAO):
+    filtros, parametros = ["numero = ?", "data IS NOT NULL"], [numero]
+    if inicio:
+        filtros.append("data >= ?")
+        parametros.append(inicio[:10])
+    if fim:
+        filtros.append("data < ?")
+        parametros.append((datetime.strptime(fim[:10], "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d"))
+    if categoria:
+        filtros.append("categoria = ?")
+        parametros.append(categoria)
+    sql = f"""SELECT {', '.join(_COLUNAS_EXPORTACAO)} FROM gastos_historico
+              WHERE {' AND '.join(filtros)} AND (data, id) > (?, ?) ORDER BY data, id LIMIT ?"""
+    
+    ultima_data, ultimo_id = "", 0
+    try:
+        while True:
+            c = obter_conexao().cursor()
+            c.execute(sql, parametros + [ultima_data, ultimo_id, tamanho_lote])
+            lote = c.fetchall()
+            if not lote:
+                break
+            ultimo_id, ultima_data = lote[-1][0], lote[-1][1]
+            yield lote
+            if len(lote) < tamanho_lote:
+                break
+    finally:
+        liberar_conexao()
+
+def _lote_csv(lote, cabecalho=False):
+    saida = io.StringIO()
+    escritor = csv.writer(saida)
+    if cabecalho:
+        escritor.writerow(_COLUNAS_EXPORTACAO)
+    escritor.writerows(lote)
+    return saida.getvalue()
+
+def _lote_ndjson(lote):
+    return "".join(json.dumps(dict(zip(_COLUNAS_EXPORTACAO, linha)), ensure_ascii=False) + "\n"
+                   for linha in lote)
+
+# Texto exportado em pedaços (um por lote); datas e formato são validados antes da
+# primeira leitura para que erros virem 400 e não uma resposta cortada
+def exportar_gastos(numero, formato="csv", inicio=None, fim=None, categoria=None):
+    if formato not in ("csv", "ndjson"):
+        raise ValueError(f"Formato não suportado: {formato}")
+    for data in (inicio, fim):
+        if data:
+            datetime.strptime(data[:10], "%Y-%m-%d")
+    
+    lotes = iterar_gastos(numero, inicio, fim, categoria)
+    if formato == "ndjson":
+        return (_lote_ndjson(lote) for lote in lotes)
+    
+    def gerar_csv():
+        yield _lote_csv([], cabecalho=True)
+        for lote in lotes:
+            yield _lote_csv(lote)
+    return gerar_csv()
+
+@app.route("/exportar", methods=["GET"])
+def exportar_endpoint():
+    if not TOKEN_EXPORTACAO or request.headers.get("Authorization") != f"Bearer {TOKEN_EXPORTACAO}":
+        return jsonify({"erro": "não autorizado"}), 403
+    numero = request.args.get("numero")
+    if not numero:
+        return jsonify({"erro": "informe 'numero'"}), 400
+    formato = request.args.get("formato", "csv").lower()
+    
+    try:
+        pedacos = exportar_gastos(numero, formato, request.args.get("inicio"), request.args.get("fim"),
+                                  request.args.get("categoria"))
+    except ValueError as e:
+        return jsonify({"erro": str(e)}), 400
+    tipo = "text/csv" if formato == "csv" else "application/x-ndjson"
+    return Response(pedacos, mimetype=tipo,
+                    headers={"Content-Disposition": f"attachment; filename=gastos.{formato}"})
+
+@app.cli.command("exportar-gastos")
+@click.option("--numero", required=True, help="Número (From do WhatsApp) dono dos gastos")
+@click.option("--formato", type=click.Choice(["csv", "ndjson"]), default="csv", show_default=True)
+@click.option("--inicio", help="Primeiro dia (YYYY-MM-DD)")
+@click.option("--fim", help="Último dia (YYYY-MM-DD)")
+@click.option("--categoria")
+@click.option("--saida", default="-", show_default=True, help="Arquivo de saída ('-' para stdout)")
+def exportar_gastos_comando(numero, formato, inicio, fim, categoria, saida):
+    """Exporta os gastos de um número em CSV ou NDJSON."""
+    with click.open_file(saida, "w", encoding="utf-8", newline="") as arquivo:
+        for pedaco in exportar_gastos(numero, formato, inicio, fim, categoria):
+            arquivo.write(pedaco)
+
+# Manutenção em passos pequenos, cada um numa transação curta para não segurar o lock de
+# escrita do webhook: expira conversas paradas, move gastos mais antigos que o horizonte
+# para gastos_arquivo (o resumo mensal não é alterado e os modelos leem gastos_historico,
+# então a contribuição deles continua contando) e compacta o arquivo SQLite com
+# incremental_vacuum, checkpoint passivo do WAL e PRAGMA optimize. Roda pelo comando
+# manutencao (cron) ou, com MANUTENCAO_AUTOMATICA=1, numa thread de cada processo.
+RETENCAO_GASTOS_DIAS = int(os.environ.get("RETENCAO_GASTOS_DIAS", "730"))  # 0 desliga o arquivamento
+TTL_CONTEXTO_INATIVO_DIAS = int(os.environ.get("TTL_CONTEXTO_INATIVO_DIAS", "90"))
+TAMANHO_LOTE_MANUTENCAO = 500
+PAGINAS_VACUUM_INCREMENTAL = 256
+PAUSA_MANUTENCAO = 0.05  # segundos entre passos, para o webhook pegar o lock
+INTERVALO_MANUTENCAO = 600
+MANUTENCAO_AUTOMATICA = os.environ.get("MANUTENCAO_AUTOMATICA") == "1"
+
+_manutencao_pid = None
+_lock_manutencao = threading.Lock()
+
+def expirar_contextos(conn, lote=TAMANHO_LOTE_MANUTENCAO):
+    limite = (datetime.now() - timedelta(days=TTL_CONTEXTO_INATIVO_DIAS)).isoformat()
+    c = conn.cursor()
+    c.execute("""DELETE FROM contexto WHERE id IN (
+                 SELECT id FROM contexto WHERE timestamp < ? ORDER BY timestamp LIMIT ?)""", (limite, lote))
+    removidos = c.rowcount
+    conn.commit()
+    return removidos
+
+def arquivar_gastos(conn, lote=TAMANHO_LOTE_MANUTENCAO):
+    if RETENCAO_GASTOS_DIAS <= 0:
+        return 0
+    limite = dia_numero(datetime.now().isoformat()) - RETENCAO_GASTOS_DIAS
+    c = conn.cursor()
+    c.execute("SELECT id, numero FROM gastos WHERE dia < ? ORDER BY dia, id LIMIT ?", (limite, lote))
+    linhas = c.fetchall()
+    if not linhas:
+        return 0
+    ids = [id_gasto for id_gasto, _ in linhas]
+    
+    marcadores = ", ".join("?" * len(ids))
+    try:
+        c.execute(f"""INSERT INTO gastos_arquivo ({_COLUNAS_ARQUIVO}, arquivado_em)
+                      SELECT {_COLUNAS_ARQUIVO}, ? FROM gastos WHERE id IN ({marcadores})""",
+                 [datetime.now().isoformat()] + ids)
+        c.execute(f"DELETE FROM gastos WHERE id IN ({marcadores})", ids)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    for numero in {numero for _, numero in linhas}:
+        invalidar_paginas(numero)
+    return len(ids)
+
+def compactar_banco(conn):
+    if USAR_POSTGRES:
+        return 0  # o autovacuum do Postgres cuida da compactação
+    c = conn.cursor()
+    liberadas = 0
+    c.execute("PRAGMA auto_vacuum")
+    if c.fetchone()[0] == 2:  # INCREMENTAL
+        c.execute("PRAGMA freelist_count")
+        livres = c.fetchone()[0]
+        c.execute(f"PRAGMA incremental_vacuum({PAGINAS_VACUUM_INCREMENTAL})")
+        c.fetchall()
+        liberadas = min(livres, PAGINAS_VACUUM_INCREMENTAL)
+    c.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    c.fetchall()
+    c.execute("PRAGMA analysis_limit=400")
+    c.execute("PRAGMA optimize")
+    conn.commit()
+    return liberadas
+
+# Um ciclo: lotes até esvaziar cada tarefa ou atingir max_passos, com pausa entre eles
+def executar_manutencao(conn, max_passos=100):
+    resultado = {"contextos_expirados": 0, "gastos_arquivados": 0, "paginas_liberadas": 0}
+    for chave, tarefa in (("contextos_expirados", expirar_contextos), ("gastos_arquivados", arquivar_gastos)):
+        for _ in range(max_passos):
+            feitos = tarefa(conn)
+            resultado[chave] += feitos
+            if feitos < TAMANHO_LOTE_MANUTENCAO:
+                break
+            time.sleep(PAUSA_MANUTENCAO)
+    resultado["paginas_liberadas"] = compactar_banco(conn)
+    return resultado
+
+def _manter_banco():
+    while True:
+        time.sleep(INTERVALO_MANUTENCAO)
+        try:
+            executar_manutencao(obter_conexao())
+        except Exception as e:
+            print(f"Erro na manutenção: {str(e)}")
+            obter_conexao().rollback()
+        finally:
+            liberar_conexao()
+
+def _garantir_manutencao():
+    global _manutencao_pid
+    if not MANUTENCAO_AUTOMATICA or _manutencao_pid == os.getpid():
+        return
+    with _lock_manutencao:
+        if _manutencao_pid != os.getpid():
+            threading.Thread(target=_manter_banco, name="manutencao", daemon=True).start()
+            _manutencao_pid = os.getpid()
+
+@app.route("/metrics", methods=["GET"])
+def metricas_endpoint():
+    linhas = []
+    for histograma in HISTOGRAMAS:
+        linhas.extend(histograma.exportar())
+    return Response("\n".join(linhas) + "\n", mimetype="text/plain; version=0.0.4")
+
+@app.cli.command("treinador-modelos")
+def treinador_modelos_comando():
+    """Treina e publica os modelos compartilhados (MODELOS_COMPARTILHADOS=1) em primeiro plano."""
+    if not _assumir_treinador():
+        raise click.ClickException("Outro processo já é o treinador dos modelos compartilhados")
+    print(f"Treinando modelos compartilhados em {MODELOS_DIR}")
+    _loop_treinador_compartilhado()
+
+@app.cli.command("manutencao")
+@click.option("--passos", default=100, show_default=True, help="Lotes máximos por tarefa neste ciclo")
+@click.option("--habilitar-vacuum-incremental", is_flag=True,
+              help="Converte o banco para auto_vacuum=INCREMENTAL (um VACUUM completo, uma única vez)")
+def manutencao_comando(passos, habilitar_vacuum_incremental):
+    """Expira contextos, arquiva gastos antigos e compacta o banco em lotes."""
+    conn = obter_conexao()
+    if habilitar_vacuum_incremental and not USAR_POSTGRES:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    print(json.dumps(executar_manutencao(conn, passos), indent=2))
+
+@app.cli.command("reconstruir-resumo")
+def reconstruir_resumo_comando():
+    """Recalcula a tabela resumo_mensal a partir dos gastos."""
+    linhas = reconstruir_resumo_mensal(obter_conexao())
+    print(f"Resumo mensal reconstruído: {linhas} linhas")
+
+@app.cli.command("migrar-banco")
+def migrar_banco_comando():
+    """Aplica as migrações pendentes do esquema (fase de release, antes dos workers)."""
+    preparar_banco()
+    print(f"Esquema na versão {versao_esquema(obter_conexao())}")
+    liberar_conexao()
+
+# Aquecimento do worker (post_worker_init em gunicorn.conf.py e execução direta):
+# importa os módulos tardios e passa uma mensagem pela análise para preencher os
+# caches, o que é rápido. Os modelos dos números mais ativos que já têm snapshot são
+# carregados depois, até PRAZO_AQUECIMENTO segundos; no gunicorn isso roda numa thread,
+# porque post_worker_init é chamado antes de o worker começar a mandar heartbeats e um
+# aquecimento longo faria o arbiter matá-lo pelo timeout.
+MODELOS_AQUECIMENTO = int(os.environ.get("MODELOS_AQUECIMENTO", "64"))
+PRAZO_AQUECIMENTO = float(os.environ.get("PRAZO_AQUECIMENTO", "20"))
+
+def _aquecer_modelos_worker(limite, prazo):
+    inicio = time.perf_counter()
+    try:
+        modelos = aquecer_modelos(obter_conexao(), limite, prazo, com_snapshot=True)
+        print(f"Aquecimento: {modelos} modelos em {time.perf_counter() - inicio:.2f}s")
+        return modelos
+    except Exception as e:
+        print(f"Erro no aquecimento dos modelos: {str(e)}")
+        return 0
+    finally:
+        liberar_conexao()
+
+def aquecer_worker(limite=MODELOS_AQUECIMENTO, prazo=PRAZO_AQUECIMENTO, em_segundo_plano=False):
+    inicio = time.perf_counter()
+    np.zeros(0)
+    twiml.MessagingResponse()
+    analisar_mensagem("gastei 10 reais no mercado")
+    if limite > 0:
+        if em_segundo_plano:
+            threading.Thread(target=_aquecer_modelos_worker, args=(limite, prazo),
+                             name="aquecimento", daemon=True).start()
+        else:
+            _aquecer_modelos_worker(limite, prazo)
+    return time.perf_counter() - inicio
+
 if __name__ == "__main__":
-    # Treina modelos ML inicialmente
-    conn = sqlite3.connect(db_file)
-    categorizador_ml.treinar_com_dados(conn)
-    predictor_ml.analisar_historico(conn)
-    recomendador_ml.analisar_padroes(conn)
-    conn.close()
+    aquecer_worker()
     
     app.run(debug=True, port=5000)
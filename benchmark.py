@@ -0,0 +1,304 @@
+"""Benchmarks do webhook /whatsapp e das funções de ML.
+
+Gera um histórico sintético de gastos num banco descartável, reenvia uma mistura de
+mensagens do Twilio (Body, From, MessageSid) pelo test client do Flask e, com
+--gunicorn, contra um gunicorn local, e mede as funções mais chamadas por mensagem.
+O resultado (latências p50/p95/p99 e requisições por segundo por intenção) vai para
+um JSON, para comparar execuções. O tempo de `import app` num interpretador novo é
+conferido contra um orçamento: acima dele, ou se numpy/twilio forem importados na
+inicialização, o comando termina com erro depois de gravar o resultado.
+
+    python benchmark.py --linhas 100000 --requisicoes 2000 --saida resultado.json
+    python benchmark.py --linhas 1000000 --gunicorn --workers 4 --concorrencia 16
+"""
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import click
+import numpy as np
+
+DESCRICOES = {
+    "alimentação": ["almoço restaurante", "mercado", "padaria", "ifood jantar", "lanche", "açougue", "feira"],
+    "transporte": ["uber", "gasolina posto", "ônibus", "estacionamento", "metrô", "pedágio"],
+    "moradia": ["aluguel", "condomínio", "conta de luz", "conta de água", "internet", "gás"],
+    "saúde": ["farmácia", "consulta médica", "academia", "plano de saúde", "dentista"],
+    "lazer": ["cinema", "bar com amigos", "show", "streaming", "livraria", "viagem"],
+    "educação": ["curso online", "material escolar", "mensalidade faculdade"],
+}
+FAIXAS_VALOR = {
+    "alimentação": (8, 250), "transporte": (5, 180), "moradia": (60, 2500),
+    "saúde": (15, 600), "lazer": (20, 400), "educação": (30, 1200),
+}
+
+# (intenção pretendida, modelo da mensagem, peso na mistura); as amostras são rotuladas
+# com a intenção que o parser do app de fato detecta, não com a pretendida
+MISTURA = [
+    ("adicionar_gasto", "Gastei {valor} reais no {descricao}", 50),
+    ("consultar_gastos", "mostrar meus gastos", 15),
+    ("resumo_financeiro", "resumo financeiro", 10),
+    ("buscar_gastos", "buscar {palavra}", 10),
+    ("previsao_gastos", "previsão do próximo mês", 5),
+    ("saudacao", "oi", 4),
+    ("ajuda", "ajuda", 3),
+    ("definir_orcamento", "definir orçamento de {limite} para {categoria}", 3),
+]
+
+
+def numero_sintetico(i):
+    return f"whatsapp:+5511900{i:06d}"
+
+
+def gerar_transacoes(rng, linhas, dias):
+    inicio = datetime.now() - timedelta(days=dias)
+    categorias = list(DESCRICOES)
+    for _ in range(linhas):
+        categoria = rng.choice(categorias)
+        minimo, maximo = FAIXAS_VALOR[categoria]
+        data = (inicio + timedelta(days=rng.randrange(dias), seconds=rng.randrange(86400))).isoformat()
+        yield data, round(rng.uniform(minimo, maximo), 2), rng.choice(DESCRICOES[categoria]), categoria
+
+
+def gerar_historico(app, rng, linhas, usuarios, dias):
+    conn = app.obter_conexao()
+    por_usuario = max(1, linhas // usuarios)
+    inicio = time.perf_counter()
+    for i in range(usuarios):
+        app.importar_gastos(conn, numero_sintetico(i), gerar_transacoes(rng, por_usuario, dias))
+    return time.perf_counter() - inicio
+
+
+def gerar_mensagens(app, rng, quantidade, usuarios):
+    intencoes = [intencao for intencao, _, _ in MISTURA]
+    pesos = [peso for _, _, peso in MISTURA]
+    modelos = {intencao: modelo for intencao, modelo, _ in MISTURA}
+    for _ in range(quantidade):
+        intencao = rng.choices(intencoes, pesos)[0]
+        categoria = rng.choice(list(DESCRICOES))
+        descricao = rng.choice(DESCRICOES[categoria])
+        corpo = modelos[intencao].format(
+            valor=rng.randrange(*FAIXAS_VALOR[categoria]), descricao=descricao, palavra=descricao.split()[0],
+            limite=rng.randrange(200, 3000, 50), categoria=categoria)
+        yield app.analisar_mensagem(corpo).intencao, {
+            "Body": corpo,
+            "From": numero_sintetico(rng.randrange(usuarios)),
+            "MessageSid": "SM" + uuid.uuid4().hex,
+        }
+
+
+def percentis(amostras):
+    if not amostras:
+        return {}
+    valores = np.asarray(amostras) * 1000
+    p50, p95, p99 = np.percentile(valores, [50, 95, 99])
+    return {
+        "n": len(amostras),
+        "media_ms": float(valores.mean()),
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+        "max_ms": float(valores.max()),
+    }
+
+
+# Latências por intenção; rps por intenção considera só o tempo gasto nela
+def resumir(latencias, duracao):
+    resultado = {"total": dict(percentis([t for ts in latencias.values() for t in ts]))}
+    resultado["total"]["rps"] = sum(map(len, latencias.values())) / duracao if duracao else 0.0
+    for intencao, amostras in sorted(latencias.items()):
+        resultado[intencao] = percentis(amostras)
+        resultado[intencao]["rps"] = len(amostras) / sum(amostras) if amostras else 0.0
+    return resultado
+
+
+def replay_test_client(app, mensagens):
+    cliente = app.app.test_client()
+    latencias = defaultdict(list)
+    inicio = time.perf_counter()
+    for intencao, formulario in mensagens:
+        t0 = time.perf_counter()
+        resposta = cliente.post("/whatsapp", data=formulario)
+        latencias[intencao].append(time.perf_counter() - t0)
+        if resposta.status_code != 200:
+            raise click.ClickException(f"/whatsapp respondeu {resposta.status_code} para {formulario['Body']!r}")
+    return resumir(latencias, time.perf_counter() - inicio)
+
+
+def _porta_livre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _aguardar_porta(porta, processo, prazo=30):
+    limite = time.monotonic() + prazo
+    while time.monotonic() < limite:
+        if processo.poll() is not None:
+            raise click.ClickException("gunicorn terminou antes de aceitar conexões")
+        try:
+            with socket.create_connection(("127.0.0.1", porta), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise click.ClickException("gunicorn não aceitou conexões a tempo")
+
+
+def replay_gunicorn(mensagens, banco, workers, concorrencia):
+    porta = _porta_livre()
+    ambiente = dict(os.environ, GASTOS_DB=banco)
+    processo = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-w", str(workers), "--threads", str(max(1, concorrencia // workers)),
+         "-b", f"127.0.0.1:{porta}", "app:app"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=ambiente,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _aguardar_porta(porta, processo)
+        url = f"http://127.0.0.1:{porta}/whatsapp"
+
+        def enviar(item):
+            intencao, formulario = item
+            dados = urllib.parse.urlencode(formulario).encode()
+            t0 = time.perf_counter()
+            with urllib.request.urlopen(url, data=dados, timeout=60) as resposta:
+                resposta.read()
+            return intencao, time.perf_counter() - t0
+
+        latencias = defaultdict(list)
+        inicio = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concorrencia) as executor:
+            for intencao, duracao in executor.map(enviar, mensagens):
+                latencias[intencao].append(duracao)
+        return resumir(latencias, time.perf_counter() - inicio)
+    finally:
+        processo.terminate()
+        processo.wait(timeout=30)
+
+
+# Mediana de `import app` em interpretadores novos, com o banco já migrado (caso de
+# um worker novo); a primeira execução só aquece o cache de bytecode e é descartada
+def medir_importacao(banco, repeticoes, orcamento_ms):
+    codigo = ("import sys, time; inicio = time.perf_counter(); import app; "
+              "print(time.perf_counter() - inicio, *(modulo in sys.modules for modulo in ('numpy', 'twilio')))")
+    ambiente = dict(os.environ, GASTOS_DB=banco)
+    amostras = []
+    tardios_carregados = set()
+    for i in range(repeticoes + 1):
+        saida = subprocess.run([sys.executable, "-c", codigo], cwd=os.path.dirname(os.path.abspath(__file__)),
+                               env=ambiente, capture_output=True, text=True, check=True).stdout.split()
+        if i:
+            amostras.append(float(saida[0]))
+        tardios_carregados.update(modulo for modulo, carregado in zip(("numpy", "twilio"), saida[1:])
+                                  if carregado == "True")
+    resultado = percentis(amostras)
+    resultado["orcamento_ms"] = orcamento_ms
+    resultado["modulos_tardios_carregados"] = sorted(tardios_carregados)
+    resultado["dentro_do_orcamento"] = resultado["p50_ms"] <= orcamento_ms and not tardios_carregados
+    return resultado
+
+
+def medir(funcao, argumentos, repeticoes):
+    amostras = []
+    for i in range(repeticoes):
+        args = argumentos[i % len(argumentos)]
+        t0 = time.perf_counter()
+        funcao(*args)
+        amostras.append(time.perf_counter() - t0)
+    return percentis(amostras)
+
+
+def micro_benchmarks(app, rng, repeticoes):
+    conn = app.obter_conexao()
+    numero = numero_sintetico(0)
+    modelos = app.obter_modelos(numero, conn)
+    frases = [formulario["Body"] for _, formulario in gerar_mensagens(app, rng, 200, 1)]
+    descricoes = [(rng.choice(lista),) for lista in DESCRICOES.values() for _ in range(20)]
+
+    return {
+        "analisar_intencao_com_ml": medir(app.analisar_intencao_com_ml, [(f,) for f in frases], repeticoes),
+        "extrair_valor": medir(app.extrair_valor, [(f,) for f in frases], repeticoes),
+        "CategorizadorML.prever_categoria": medir(modelos.categorizador.prever_categoria, descricoes, repeticoes),
+        "PredictorML.analisar_historico": medir(modelos.predictor.analisar_historico, [()], repeticoes),
+        "gerar_insights_ml": medir(app.gerar_insights_ml, [(conn, numero)], max(1, repeticoes // 10)),
+    }
+
+
+@click.command()
+@click.option("--linhas", default=10000, show_default=True, help="Gastos sintéticos (10k a 1M)")
+@click.option("--usuarios", default=10, show_default=True, help="Números entre os quais os gastos são divididos")
+@click.option("--dias", default=365, show_default=True, help="Período coberto pelo histórico")
+@click.option("--requisicoes", default=1000, show_default=True, help="Mensagens reenviadas ao webhook")
+@click.option("--repeticoes", default=2000, show_default=True, help="Chamadas por micro-benchmark")
+@click.option("--gunicorn", "usar_gunicorn", is_flag=True, help="Também mede contra um gunicorn local")
+@click.option("--workers", default=2, show_default=True)
+@click.option("--concorrencia", default=8, show_default=True, help="Requisições simultâneas no gunicorn")
+@click.option("--banco", type=click.Path(dir_okay=False), help="Banco SQLite a usar (padrão: temporário)")
+@click.option("--orcamento-importacao", default=400.0, show_default=True,
+              help="Tempo máximo (ms, mediana) de `import app` num interpretador novo")
+@click.option("--semente", default=42, show_default=True)
+@click.option("--saida", type=click.Path(dir_okay=False), help="Arquivo JSON com os resultados (padrão: stdout)")
+def main(linhas, usuarios, dias, requisicoes, repeticoes, usar_gunicorn, workers, concorrencia, banco,
+         orcamento_importacao, semente, saida):
+    rng = random.Random(semente)
+    diretorio = None
+    if not banco:
+        diretorio = tempfile.mkdtemp(prefix="whats-bot-bench-")
+        banco = os.path.join(diretorio, "gastos_bench.db")
+    # O app lê GASTOS_DB na importação
+    os.environ["GASTOS_DB"] = banco
+    os.environ.pop("DATABASE_URL", None)
+
+    try:
+        import app
+
+        resultado = {
+            "meta": {
+                "data": datetime.now().isoformat(),
+                "linhas": linhas,
+                "usuarios": usuarios,
+                "requisicoes": requisicoes,
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "plataforma": platform.platform(),
+            },
+        }
+        resultado["meta"]["geracao_s"] = gerar_historico(app, rng, linhas, usuarios, dias)
+        resultado["importacao"] = medir_importacao(banco, 5, orcamento_importacao)
+        resultado["micro"] = micro_benchmarks(app, rng, repeticoes)
+        resultado["webhook"] = {"test_client": replay_test_client(app, gerar_mensagens(app, rng, requisicoes, usuarios))}
+        if usar_gunicorn:
+            app.descarregar_contextos()
+            resultado["webhook"]["gunicorn"] = replay_gunicorn(
+                list(gerar_mensagens(app, rng, requisicoes, usuarios)), banco, workers, concorrencia)
+    finally:
+        if diretorio:
+            shutil.rmtree(diretorio, ignore_errors=True)
+
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    if saida:
+        with open(saida, "w", encoding="utf-8") as arquivo:
+            arquivo.write(texto + "\n")
+    else:
+        click.echo(texto)
+    importacao = resultado["importacao"]
+    if not importacao["dentro_do_orcamento"]:
+        raise click.ClickException(
+            f"import app levou {importacao['p50_ms']:.0f} ms (orçamento {orcamento_importacao:.0f} ms); "
+            f"módulos tardios carregados: {', '.join(importacao['modulos_tardios_carregados']) or 'nenhum'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+# Lido pelo gunicorn a partir do diretório de trabalho (Procfile: gunicorn app:app)
+
+def post_worker_init(worker):
+    # Roda no worker já com o app importado e antes de aceitar conexões. Só a parte
+    # rápida é síncrona; os modelos são carregados numa thread, com prazo, enquanto o
+    # worker já atende (e manda heartbeats ao arbiter)
+    from app import aquecer_worker
+    duracao = aquecer_worker(em_segundo_plano=True)
+    worker.log.info("Worker %s aquecido em %.2fs; modelos carregando em segundo plano", worker.pid, duracao)
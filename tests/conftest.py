@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# app.py cria o esquema na importação: os testes usam um banco SQLite descartável
+os.environ.setdefault("GASTOS_DB", os.path.join(tempfile.mkdtemp(prefix="whats-bot-testes-"), "gastos.db"))
+os.environ.pop("DATABASE_URL", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
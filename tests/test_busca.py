@@ -0,0 +1,49 @@
+"""Busca de gastos (buscar_gastos) no índice FTS5.
+
+A consulta precisa partir do gastos_fts: se o SQLite começar por idx_gastos_numero_id,
+o MATCH roda uma vez por gasto do número e a busca fica linear no histórico.
+"""
+from datetime import datetime
+
+import pytest
+
+import app
+
+pytestmark = pytest.mark.skipif(not app.FTS_DISPONIVEL, reason="SQLite sem FTS5")
+
+
+def _popular(conn, numero):
+    agora = datetime.now().isoformat()
+    app.importar_gastos(conn, numero, [(agora, 10.0, "mercado da esquina", "alimentacao")] * 3
+                        + [(agora, 5.0, "uber centro", "transporte")] * 20)
+
+
+def test_busca_filtra_por_numero_e_termo():
+    conn = app.obter_conexao()
+    _popular(conn, "whatsapp:+5500100000001")
+    _popular(conn, "whatsapp:+5500100000002")
+
+    resultados, quantidade, total = app.buscar_gastos(conn, "whatsapp:+5500100000001", "mercado")
+
+    assert quantidade == 3
+    assert total == pytest.approx(30.0)
+    assert {descricao for _, _, descricao, _, _ in resultados} == {"mercado da esquina"}
+
+
+def test_busca_parte_do_indice_fts():
+    conn = app.obter_conexao()
+    numero = "whatsapp:+5500100000003"
+    _popular(conn, numero)
+    consultas = []
+    conn.set_trace_callback(consultas.append)
+    try:
+        app.buscar_gastos(conn, numero, "mercado")
+    finally:
+        conn.set_trace_callback(None)
+
+    consultas = [sql for sql in consultas if "gastos_fts MATCH" in sql]
+    assert len(consultas) == 2
+    for sql in consultas:
+        plano = conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall()
+        assert "VIRTUAL TABLE" in plano[0][-1]
+        assert not any("idx_gastos_numero_id" in linha[-1] for linha in plano)
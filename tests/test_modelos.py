@@ -0,0 +1,67 @@
+"""Treino incremental dos modelos de ML.
+
+esquecer precisa desfazer exatamente o observar do mesmo gasto: remover um gasto recém
+aprendido devolve o modelo ao estado anterior (só a marca d'água continua adiantada).
+"""
+import pytest
+
+import app
+
+GASTOS = [
+    (1, 20000, 35.0, "mercado da esquina", "alimentacao"),
+    (2, 20000, 12.5, "uber centro", "transporte"),
+    (3, 20002, 80.0, "mercado atacado", "alimentacao"),
+    (4, 20005, 22.0, "farmacia", "saude"),
+]
+
+
+def _sem_marca_dagua(estado):
+    return {chave: valor for chave, valor in estado.items() if chave != "ultimo_id"}
+
+
+def _modelos_treinados():
+    modelos = app.ModelosUsuario("whatsapp:+5500300000001")
+    for id_gasto, dia, valor, descricao, categoria in GASTOS:
+        modelos.categorizador.observar(descricao, categoria, id_gasto)
+        modelos.predictor.observar(dia, valor, id_gasto)
+        modelos.recomendador.observar(valor, dia, categoria, id_gasto)
+    return modelos
+
+
+@pytest.mark.parametrize("gasto", [
+    (5, 20002, 47.3, "padaria nova", "alimentacao"),  # palavra e dia já conhecidos
+    (5, 20005, 300.0, "consulta medica", "lazer"),  # palavras e categoria novas
+])
+def test_esquecer_desfaz_observar(gasto):
+    modelos = _modelos_treinados()
+    antes = [_sem_marca_dagua(modelo.exportar_estado())
+             for modelo in (modelos.categorizador, modelos.predictor, modelos.recomendador)]
+    mais_comum = modelos.categorizador.categoria_mais_comum
+
+    id_gasto, dia, valor, descricao, categoria = gasto
+    modelos.categorizador.observar(descricao, categoria, id_gasto)
+    modelos.predictor.observar(dia, valor, id_gasto)
+    modelos.recomendador.observar(valor, dia, categoria, id_gasto)
+    modelos.categorizador.esquecer(descricao, categoria, id_gasto)
+    modelos.predictor.esquecer(dia, valor, id_gasto)
+    modelos.recomendador.esquecer(valor, dia, categoria, id_gasto)
+
+    categorizador, predictor, recomendador = antes
+    assert _sem_marca_dagua(modelos.categorizador.exportar_estado()) == categorizador
+    assert modelos.categorizador.categoria_mais_comum == mais_comum
+    estado = _sem_marca_dagua(modelos.predictor.exportar_estado())
+    assert estado["dia_inicial"] == predictor["dia_inicial"]
+    assert estado["totais_diarios"] == pytest.approx(predictor["totais_diarios"])
+    estado = _sem_marca_dagua(modelos.recomendador.exportar_estado())
+    assert estado["por_dia_semana"] == [pytest.approx(linha) for linha in recomendador["por_dia_semana"]]
+    assert estado["por_categoria"] == {categoria: pytest.approx(agregado)
+                                       for categoria, agregado in recomendador["por_categoria"].items()}
+
+
+def test_esquecer_ignora_gasto_nao_aprendido():
+    modelos = _modelos_treinados()
+    antes = modelos.categorizador.exportar_estado()
+
+    modelos.categorizador.esquecer("mercado da esquina", "alimentacao", 99)
+
+    assert modelos.categorizador.exportar_estado() == antes
@@ -0,0 +1,44 @@
+"""Modo compartilhado (MODELOS_COMPARTILHADOS=1): os workers só leem o arquivo publicado.
+
+Antes da publicação o worker responde com modelos vazios em vez de treinar uma cópia
+própria; depois dela, qualquer cópia local do número é descartada.
+"""
+from datetime import datetime
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def compartilhado(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "MODELOS_COMPARTILHADOS", True)
+    monkeypatch.setattr(app, "MODELOS_DIR", str(tmp_path))
+    # O treino roda no teste, não numa thread de treinador eleita
+    monkeypatch.setattr(app, "_garantir_treinador_compartilhado", lambda: None)
+
+
+def test_worker_sem_arquivo_publicado_nao_treina(compartilhado):
+    conn = app.obter_conexao()
+    numero = "whatsapp:+5500200000001"
+    app.importar_gastos(conn, numero, [(datetime.now().isoformat(), 10.0, "uber centro", "transporte")] * 5)
+
+    modelos = app.obter_modelos(numero, conn)
+
+    assert modelos.prontos
+    assert not modelos.categorizador.modelo_treinado
+    assert modelos.categorizador.prever_categoria("uber") == "outros"
+    assert numero not in app._modelos_usuarios
+
+
+def test_arquivo_publicado_substitui_copia_local(compartilhado):
+    conn = app.obter_conexao()
+    numero = "whatsapp:+5500200000002"
+    app.importar_gastos(conn, numero, [(datetime.now().isoformat(), 10.0, "uber centro", "transporte")] * 5)
+    app._modelos_usuarios[numero] = app.ModelosUsuario(numero)
+
+    assert app.treinar_modelos_compartilhados(conn) >= 1
+    modelos = app.obter_modelos(numero, conn)
+
+    assert isinstance(modelos.categorizador, app.CategorizadorCompacto)
+    assert numero not in app._modelos_usuarios
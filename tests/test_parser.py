@@ -0,0 +1,32 @@
+"""Corpus dourado do parser de mensagens.
+
+golden_mensagens.jsonl foi gerado com o parser anterior aos scanners compilados
+(analisar_intencao_com_ml, extrair_valor, extrair_descricao e extrair_id_remocao, um
+re.search por padrão): mensagens fixas dos fluxos do bot e combinações aleatórias das
+palavras-chave, com e sem histórico de intenções. analisar_mensagem precisa reproduzir
+cada resultado.
+"""
+import json
+import os
+
+import pytest
+
+import app
+
+with open(os.path.join(os.path.dirname(__file__), "golden_mensagens.jsonl"), encoding="utf-8") as arquivo:
+    CASOS = [json.loads(linha) for linha in arquivo]
+
+
+@pytest.mark.parametrize("caso", CASOS, ids=[caso["mensagem"] or "<vazia>" for caso in CASOS])
+def test_analisar_mensagem_reproduz_parser_anterior(caso):
+    analisada = app.analisar_mensagem(caso["mensagem"], caso["historico"])
+    assert (analisada.intencao, analisada.valor, analisada.descricao, analisada.id_remocao) == (
+        caso["intencao"], caso["valor"], caso["descricao"], caso["id_remocao"])
+
+
+def test_funcoes_avulsas_concordam_com_analisar_mensagem():
+    for caso in CASOS:
+        assert app.analisar_intencao_com_ml(caso["mensagem"], caso["historico"]) == caso["intencao"]
+        assert app.extrair_valor(caso["mensagem"]) == caso["valor"]
+        assert app.extrair_descricao(caso["mensagem"]) == caso["descricao"]
+        assert app.extrair_id_remocao(caso["mensagem"]) == caso["id_remocao"]
@@ -0,0 +1,61 @@
+"""Resumo mensal materializado (resumo_mensal).
+
+Cada caminho que altera gastos mantém o resumo na mesma transação; depois de qualquer
+um deles o resumo precisa coincidir com o recalculado do zero por reconstruir_resumo_mensal.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import app
+
+NUMERO = "whatsapp:+5500400000001"
+
+
+def _resumo(conn):
+    c = conn.cursor()
+    c.execute("SELECT mes_ano, categoria, total, quantidade FROM resumo_mensal WHERE numero = ? AND quantidade > 0",
+              (NUMERO,))
+    return {(mes_ano, categoria): (total, quantidade) for mes_ano, categoria, total, quantidade in c.fetchall()}
+
+
+def _confere_com_reconstrucao(conn):
+    mantido = _resumo(conn)
+    app.reconstruir_resumo_mensal(conn)
+    reconstruido = _resumo(conn)
+    assert mantido.keys() == reconstruido.keys()
+    for chave, (total, quantidade) in reconstruido.items():
+        assert mantido[chave] == (pytest.approx(total), quantidade)
+
+
+def test_resumo_mensal_acompanha_alteracoes():
+    conn = app.obter_conexao()
+    cliente = app.app.test_client()
+    hoje = datetime.now()
+    antigo = (hoje - timedelta(days=app.RETENCAO_GASTOS_DIAS + 40)).isoformat()
+
+    # Inserção pelo chat
+    for mensagem in ("gastei 50 no mercado", "gastei 12,90 no uber", "gastei 7 no cafe"):
+        assert cliente.post("/whatsapp", data={"From": NUMERO, "Body": mensagem}).status_code == 200
+    assert sum(quantidade for _, quantidade in _resumo(conn).values()) == 3
+    _confere_com_reconstrucao(conn)
+
+    # Importação, com gastos antigos o bastante para serem arquivados
+    app.importar_gastos(conn, NUMERO, [
+        (hoje.isoformat(), 30.0, "farmacia", "saude"),
+        (antigo, 100.0, "aluguel", "moradia"),
+        (antigo, 45.5, "mercado", "alimentacao"),
+    ])
+    _confere_com_reconstrucao(conn)
+
+    # Remoção
+    c = conn.cursor()
+    c.execute("SELECT id FROM gastos WHERE numero = ? AND descricao LIKE '%uber%'", (NUMERO,))
+    id_uber, = c.fetchone()
+    assert app.remover_gasto(conn, NUMERO, id_uber)[0]
+    _confere_com_reconstrucao(conn)
+
+    # Arquivamento: os gastos saem de gastos, mas continuam no resumo
+    assert app.arquivar_gastos(conn) >= 2
+    _confere_com_reconstrucao(conn)
+    assert _resumo(conn)[(antigo[:7], "moradia")] == (pytest.approx(100.0), 1)
@@ -0,0 +1,46 @@
+"""Valores digitados no chat (orçamentos e metas) e lidos de planilhas CSV.
+
+Um separador único seguido de três dígitos é de milhar ("1.000"); nos demais casos o
+último separador é o decimal.
+"""
+import io
+
+import pytest
+
+import app
+
+CASOS = [
+    ("1.000", 1000.0),
+    ("3.000", 3000.0),
+    ("1.000,50", 1000.5),
+    ("1,234.56", 1234.56),
+    ("1.000.000", 1000000.0),
+    ("12,5", 12.5),
+    ("12,50", 12.5),
+    ("1234.56", 1234.56),
+    ("R$ -12,90", -12.9),
+    ("abc", None),
+]
+
+
+@pytest.mark.parametrize("texto,esperado", CASOS)
+def test_converter_valor(texto, esperado):
+    assert app._converter_valor(texto) == esperado
+
+
+@pytest.mark.parametrize("mensagem,alvo,valor", [
+    ("Definir orçamento de 1.000 para outros", "outros", 1000.0),
+    ("Criar meta de viagem 3.000", "viagem", 3000.0),
+    ("Definir orçamento de 1.000,50 para mercado", "mercado", 1000.5),
+    ("Definir orçamento de 12,5 para cafe", "cafe", 12.5),
+])
+def test_extrair_alvo_planejamento(mensagem, alvo, valor):
+    assert app.extrair_alvo_planejamento(mensagem) == (alvo, valor)
+
+
+def test_ler_csv_valores_com_milhar():
+    arquivo = io.StringIO("data;valor;descricao\n"
+                          "2024-01-05;1.000;aluguel\n"
+                          "2024-01-06;1.000,50;notebook\n"
+                          "2024-01-07;12,5;cafe\n")
+    assert [valor for _, valor, _, _ in app.ler_csv(arquivo)] == [1000.0, 1000.5, 12.5]
@@ -0,0 +1,70 @@
+"""Webhook /whatsapp pelo cliente de testes do Flask."""
+import re
+from datetime import datetime, timedelta
+
+import app
+
+
+def _enviar(cliente, numero, mensagem, message_sid=None):
+    dados = {"From": numero, "Body": mensagem}
+    if message_sid:
+        dados["MessageSid"] = message_sid
+    resposta = cliente.post("/whatsapp", data=dados)
+    assert resposta.status_code == 200
+    return resposta.get_data(as_text=True)
+
+
+def _quantidade_gastos(numero):
+    c = app.obter_conexao().cursor()
+    c.execute("SELECT COUNT(*) FROM gastos WHERE numero = ?", (numero,))
+    return c.fetchone()[0]
+
+
+def test_message_sid_repetido_registra_o_gasto_uma_vez():
+    cliente = app.app.test_client()
+    numero = "whatsapp:+5500500000001"
+
+    primeira = _enviar(cliente, numero, "gastei 20 no mercado", "SM00000000000000000000000000000001")
+    repetida = _enviar(cliente, numero, "gastei 20 no mercado", "SM00000000000000000000000000000001")
+    _enviar(cliente, numero, "gastei 20 no mercado", "SM00000000000000000000000000000002")
+
+    assert repetida == primeira
+    assert _quantidade_gastos(numero) == 2
+
+
+def test_message_sid_repetido_em_outro_worker_registra_o_gasto_uma_vez():
+    cliente = app.app.test_client()
+    numero = "whatsapp:+5500500000002"
+
+    primeira = _enviar(cliente, numero, "gastei 35 na farmacia", "SM00000000000000000000000000000003")
+    with app._lock_mensagens:
+        app._cache_mensagens.clear()  # a repetição chega a um worker sem a resposta em memória
+    repetida = _enviar(cliente, numero, "gastei 35 na farmacia", "SM00000000000000000000000000000003")
+
+    assert repetida == primeira
+    assert _quantidade_gastos(numero) == 1
+
+
+def _ids(resposta):
+    return [int(id_gasto) for id_gasto in re.findall(r"#(\d+)", resposta)]
+
+
+def test_paginas_mais_e_anterior():
+    cliente = app.app.test_client()
+    numero = "whatsapp:+5500500000003"
+    inicio = datetime(2024, 3, 1)
+    # Dois gastos por dia: o desempate por id também precisa ser respeitado
+    app.importar_gastos(app.obter_conexao(), numero, [
+        ((inicio + timedelta(days=i // 2)).isoformat(), 10.0 + i, f"gasto {i}", "outros") for i in range(25)])
+    c = app.obter_conexao().cursor()
+    c.execute("SELECT id FROM gastos WHERE numero = ? ORDER BY data DESC, id DESC", (numero,))
+    esperados = [id_gasto for id_gasto, in c.fetchall()]
+    tamanho = app.TAMANHO_PAGINA_LISTAGEM
+
+    assert _ids(_enviar(cliente, numero, "ver meus gastos")) == esperados[:tamanho]
+    assert _ids(_enviar(cliente, numero, "mais")) == esperados[tamanho:2 * tamanho]
+    ultima = _enviar(cliente, numero, "mais")
+    assert _ids(ultima) == esperados[2 * tamanho:]
+    assert "'mais'" not in ultima
+    assert _ids(_enviar(cliente, numero, "anterior")) == esperados[tamanho:2 * tamanho]
+    assert _ids(_enviar(cliente, numero, "anterior")) == esperados[:tamanho]